@@ -0,0 +1,290 @@
+"""
+End to end benchmarks of MicropedeClient / MicropedeAsync over a broker.
+
+Uses the broker at --host/--port when one is listening there, otherwise
+starts the pure-Python stand-in from benchmarks/broker.py. Results are
+printed (or written to --output) as JSON so runs can be compared between
+commits.
+
+    python benchmarks/bench_client.py [--transport asyncio] [--output out.json]
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.abspath(os.path.join(HERE, '..')))
+
+from micropede.client import DEFAULT_PORT, MicropedeClient, start_loop_thread
+
+MicropedeAsync = importlib.import_module('micropede.async').MicropedeAsync
+
+APP_NAME = 'bench'
+
+
+def port_open(host, port):
+    try:
+        with socket.create_connection((host, port), timeout=0.5):
+            return True
+    except OSError:
+        return False
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_broker():
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, 'broker.py'), '--port', str(port)],
+        stdout=subprocess.DEVNULL)
+    for i in range(100):
+        if port_open('127.0.0.1', port):
+            return process, port
+        time.sleep(0.05)
+    process.kill()
+    raise Exception('broker stand-in did not start')
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))]
+    return {
+        'count': len(samples),
+        'mean': sum(samples) / len(samples),
+        'p50': pick(0.5),
+        'p90': pick(0.9),
+        'p99': pick(0.99),
+        'max': samples[-1],
+    }
+
+
+class Echo(MicropedeClient):
+    """ Plugin answering the echo trigger """
+
+    def listen(self):
+        self.on_trigger_msg('echo', self.echo)
+
+    def echo(self, payload, params):
+        return self.notify_sender(payload, 'echo', 'echo')
+
+
+class Counter(MicropedeClient):
+    """ Counts the messages received on its subscriptions """
+
+    def __init__(self, *args, **kwargs):
+        self.received = 0
+        self.expected = None
+        self.done = None
+        super().__init__(*args, **kwargs)
+
+    def on_value(self, payload, params):
+        self.received += 1
+        if self.received == self.expected and not self.done.done():
+            self.done.set_result(time.perf_counter())
+
+    def expect(self, n):
+        self.received = 0
+        self.expected = n
+        self.done = asyncio.Future(loop=self.loop)
+        return self.done
+
+
+class Bench(object):
+
+    def __init__(self, host, port, transport):
+        self.host = host
+        self.port = port
+        self.transport = transport
+        self.loop = start_loop_thread()
+        self.clients = []
+
+    def run(self, awaitable, timeout=300):
+        """ Wait for a coroutine or future of the client loop """
+        async def wait():
+            return await awaitable
+        return asyncio.run_coroutine_threadsafe(wait(), self.loop).result(timeout)
+
+    def client(self, cls=MicropedeClient, name=None):
+        client = cls(APP_NAME, host=self.host, port=self.port, name=name,
+                     loop=self.loop, transport=self.transport)
+        self.clients.append(client)
+        self.run(self.connected(client))
+        return client
+
+    async def connected(self, client, timeout=10):
+        deadline = time.perf_counter() + timeout
+        while not (client.connected and not client._subacks):
+            if time.perf_counter() > deadline:
+                raise Exception(f'{client.name} did not connect')
+            await asyncio.sleep(0.01)
+
+    def close(self):
+        for client in self.clients:
+            try:
+                self.run(client.disconnect_client(), timeout=10)
+            except Exception:
+                pass
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def publish_throughput(self, count, qos, size):
+        """ Messages per second published (and acked) by one client """
+        publisher = self.client(name=f'publisher-{qos}')
+        payload = {'value': 'x' * size}
+
+        async def run():
+            start = time.perf_counter()
+            futures = [publisher.send_message(
+                f'{APP_NAME}/publisher/state/value', dict(payload), qos=qos)
+                for i in range(count)]
+            await asyncio.gather(*futures)
+            return time.perf_counter() - start
+
+        seconds = self.run(run())
+        return {'messages': count, 'qos': qos, 'payload_bytes': size,
+                'seconds': seconds, 'rate': count / seconds}
+
+    def call_action_latency(self, count):
+        """ Round trip of MicropedeAsync.call_action to a plugin (ms) """
+        self.client(Echo, name='echo')
+        caller = MicropedeAsync(APP_NAME, host=self.host, port=self.port,
+                                loop=self.loop, persistent=True,
+                                transport=self.transport)
+        self.clients.append(caller.client)
+
+        async def run():
+            await caller.trigger_plugin('echo', 'echo', {})
+            samples = []
+            for i in range(count):
+                start = time.perf_counter()
+                await caller.trigger_plugin('echo', 'echo', {})
+                samples.append((time.perf_counter() - start) * 1000)
+            return samples
+
+        return percentiles(self.run(run()))
+
+    def fan_out(self, subscribers, count):
+        """ Time to deliver count messages to every subscriber """
+        clients = [self.client(Counter, name=f'fan-{i}')
+                   for i in range(subscribers)]
+        for c in clients:
+            self.run(c.add_subscription(f'{APP_NAME}/fan-source/state/value',
+                                        c.on_value))
+        publisher = self.client(name='fan-source')
+
+        async def run():
+            done = [c.expect(count) for c in clients]
+            start = time.perf_counter()
+            for i in range(count):
+                publisher.send_message(f'{APP_NAME}/fan-source/state/value',
+                                       {'value': i})
+            ends = await asyncio.wait_for(asyncio.gather(*done), 60)
+            return max(ends) - start
+
+        seconds = self.run(run())
+        return {'subscribers': subscribers, 'messages': count,
+                'seconds': seconds,
+                'deliveries_per_second': subscribers * count / seconds}
+
+    def subscription_scaling(self, size, count):
+        """ SUBSCRIBE time and dispatch rate with size routes """
+        client = self.client(Counter, name=f'subscriber-{size}')
+        publisher = self.client(name=f'scaling-source-{size}')
+        channels = [f'{APP_NAME}/scaling-source-{size}/state/prop-{i}'
+                    for i in range(size)]
+
+        async def run():
+            start = time.perf_counter()
+            await client.add_subscriptions(
+                [(channel, client.on_value) for channel in channels],
+                timeout=60000)
+            subscribe = time.perf_counter() - start
+
+            done = client.expect(count)
+            start = time.perf_counter()
+            for i in range(count):
+                publisher.send_message(channels[i % size], {'value': i})
+            end = await asyncio.wait_for(done, 60)
+            return subscribe, end - start
+
+        (subscribe, dispatch) = self.run(run())
+        return {'routes': size, 'subscribe_seconds': subscribe,
+                'messages': count, 'dispatch_rate': count / dispatch}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--stand-in', action='store_true',
+                        help='always use the stand-in broker')
+    parser.add_argument('--transport', default='paho')
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--calls', type=int, default=500)
+    parser.add_argument('--subscribers', default='1,10,50')
+    parser.add_argument('--routes', default='10,1000,10000')
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    process = None
+    host, port = args.host, args.port
+    if args.stand_in or not port_open(host, port):
+        process, port = start_broker()
+        host = '127.0.0.1'
+
+    bench = Bench(host, port, args.transport)
+    try:
+        results = {}
+        print('publish throughput', file=sys.stderr)
+        results['publish'] = [bench.publish_throughput(args.messages, qos, 100)
+                              for qos in (0, 1)]
+        print('call_action latency', file=sys.stderr)
+        results['call_action_ms'] = bench.call_action_latency(args.calls)
+        print('fan out', file=sys.stderr)
+        results['fan_out'] = [bench.fan_out(int(n), max(1, args.messages // 10))
+                              for n in args.subscribers.split(',')]
+        print('subscription scaling', file=sys.stderr)
+        results['subscriptions'] = [
+            bench.subscription_scaling(int(n), args.messages)
+            for n in args.routes.split(',')]
+    finally:
+        bench.close()
+        if process is not None:
+            process.kill()
+
+    report = {
+        'revision': git_revision(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'transport': args.transport,
+        'broker': 'stand-in' if process is not None else f'{host}:{port}',
+        'results': results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""
+Import time and per-message client overhead.
+
+Import times are measured in fresh interpreters (best of --runs), along
+with which heavy optional dependencies the import pulled in. Per-message
+costs time send_message, on_message dispatch (decode included) and
+notify_sender in the client loop, against the stand-in broker.
+
+    python benchmarks/bench_overhead.py [--transport asyncio] [--output out.json]
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+from bench_client import APP_NAME, Bench, git_revision
+import broker
+
+from micropede.recorder import Record
+
+HEAVY = ['pydash', 'jsonschema', 'paho.mqtt.client', 'onoff', 'http.server']
+
+IMPORT = '''
+import importlib, json, sys, time
+start = time.perf_counter()
+importlib.import_module(sys.argv[1])
+print(json.dumps({"seconds": time.perf_counter() - start,
+                  "loaded": [m for m in sys.argv[2:] if m in sys.modules]}))
+'''
+
+
+def import_time(module, runs):
+    """ Best import time of module over runs fresh interpreters """
+    env = dict(os.environ)
+    root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+    env['PYTHONPATH'] = os.pathsep.join(
+        [root] + [p for p in [env.get('PYTHONPATH')] if p])
+    results = []
+    for i in range(runs):
+        output = subprocess.check_output(
+            [sys.executable, '-c', IMPORT, module] + HEAVY, env=env)
+        results.append(json.loads(output))
+    best = min(results, key=lambda r: r['seconds'])
+    return {'module': module, 'ms': best['seconds'] * 1000,
+            'loaded': best['loaded']}
+
+
+class Overhead(Bench):
+
+    def timed(self, count, call):
+        """ Microseconds per call of call(i), run in the client loop """
+        async def run():
+            start = time.perf_counter()
+            for i in range(count):
+                call(i)
+            return (time.perf_counter() - start) / count * 1e6
+        return self.run(run())
+
+    def send_message(self, count):
+        client = self.client(name='overhead-sender')
+        topic = f'{APP_NAME}/overhead-sender/state/value'
+        us = self.timed(count, lambda i: client.send_message(topic, {'i': i}))
+        self.run(client.send_message(topic, {}))
+        return us
+
+    def on_message(self, count):
+        client = self.client(name='overhead-receiver')
+        received = []
+        self.run(client.add_subscription(
+            f'{APP_NAME}/{{sender}}/state/{{prop}}',
+            lambda payload, params: received.append(payload)))
+        messages = [Record(0, f'{APP_NAME}/sender/state/value',
+                           json.dumps({'i': i}).encode(), 0, False)
+                    for i in range(count)]
+        return self.timed(
+            count, lambda i: client.on_message(None, None, messages[i]))
+
+    def notify_sender(self, count):
+        client = self.client(name='overhead-notifier')
+        request = {'__head__': {'plugin_name': 'caller', 'request_id': 'x'}}
+        us = self.timed(
+            count, lambda i: client.notify_sender(request, i, 'overhead'))
+        # Publishes are acked in order, wait for the backlog to drain
+        self.run(client.send_message(f'{APP_NAME}/overhead-notifier/done'))
+        return us
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--transport', default='paho')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    results = {}
+    print('import time', file=sys.stderr)
+    results['import'] = [import_time(module, args.runs) for module in
+                         ('micropede.client', 'micropede.async')]
+
+    (stand_in, port) = broker.start()
+    bench = Overhead('127.0.0.1', port, args.transport)
+    try:
+        print('per message', file=sys.stderr)
+        results['per_message_us'] = {
+            'send_message': bench.send_message(args.messages),
+            'on_message': bench.on_message(args.messages),
+            'notify_sender': bench.notify_sender(args.messages),
+        }
+    finally:
+        bench.close()
+
+    report = {
+        'revision': git_revision(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'transport': args.transport,
+        'results': results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
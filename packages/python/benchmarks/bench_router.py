@@ -0,0 +1,83 @@
+"""
+Compare TopicRouter with wheezy.routing's PathRouter (used previously by
+MicropedeClient.on_message).
+
+    python benchmarks/bench_router.py [--sizes 10,1000,100000]
+"""
+import argparse
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from micropede.router import TopicRouter
+
+
+def channels(n):
+    """ Mix of the channel shapes produced by the Topics mixins """
+    kinds = [
+        'microdrop/trigger/plugin-{i}/{{action}}',
+        'microdrop/put/plugin-{i}/{{prop}}',
+        'microdrop/{{sender}}/state/prop-{i}',
+        'microdrop/plugin-{i}/notify/{{receiver}}/{{topic}}',
+    ]
+    return [kinds[i % len(kinds)].format(i=i) for i in range(n)]
+
+
+def topics(n, count=1000):
+    rand = random.Random(0)
+    out = []
+    for j in range(count):
+        i = rand.randrange(n)
+        out.append([
+            f'microdrop/trigger/plugin-{i}/ping',
+            f'microdrop/put/plugin-{i}/value',
+            f'microdrop/sender/state/prop-{i}',
+            f'microdrop/plugin-{i}/notify/receiver/ping',
+        ][i % 4])
+    return out
+
+
+def bench(router, topics, number):
+    match = router.match
+    def run():
+        for topic in topics:
+            match(topic)
+    seconds = min(timeit.repeat(run, number=number, repeat=3))
+    return len(topics) * number / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='10,1000,100000')
+    parser.add_argument('--number', type=int, default=5)
+    args = parser.parse_args()
+
+    try:
+        from wheezy.routing import PathRouter
+    except ImportError:
+        PathRouter = None
+
+    print(f'{"routes":>8} {"TopicRouter":>16} {"PathRouter":>16}')
+    for n in [int(s) for s in args.sizes.split(',')]:
+        sample = topics(n)
+        trie = TopicRouter()
+        for channel in channels(n):
+            trie.add_route(channel, print)
+        trie_rate = bench(trie, sample, args.number)
+
+        path_rate = float('nan')
+        if PathRouter is not None:
+            router = PathRouter()
+            for i, channel in enumerate(channels(n)):
+                router.add_route(channel, print, name=str(i))
+            # PathRouter is linear in the number of routes, keep runs short
+            path_rate = bench(router, sample[:max(10, 10000 // n)], 1)
+
+        print(f'{n:>8} {trie_rate:>12.0f} m/s {path_rate:>12.0f} m/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Validations per second with jsonschema.validate (as validate_schema used
+to do) versus the cached validator from micropede.client.get_validator.
+
+    python benchmarks/bench_schema.py [schema.json payload.json ...]
+
+Pairs of schema / payload files can be given to benchmark real plugin
+schemas; otherwise a device-model style schema is used.
+"""
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import jsonschema
+
+from micropede.client import get_validator, validate
+
+
+def sample():
+    schema = {
+        'type': 'object',
+        'definitions': {
+            'electrode': {
+                'type': 'object',
+                'properties': {
+                    'id': {'type': 'string', 'pattern': '^electrode[0-9]+$'},
+                    'channels': {'type': 'array', 'items': {'type': 'integer'}},
+                    'area': {'type': 'number', 'minimum': 0},
+                },
+                'required': ['id', 'channels'],
+            },
+        },
+        'properties': {
+            'active-electrodes': {
+                'type': 'array', 'items': {'type': 'string'}, 'default': []},
+            'voltage': {'type': 'number', 'minimum': 0, 'maximum': 200},
+            'frequency': {'type': 'number', 'minimum': 100},
+            'electrodes': {
+                'type': 'array', 'items': {'$ref': '#/definitions/electrode'}},
+        },
+    }
+    payload = {
+        'active-electrodes': [f'electrode{i:03d}' for i in range(20)],
+        'voltage': 100,
+        'frequency': 10000,
+        'electrodes': [{'id': f'electrode{i:03d}', 'channels': [i], 'area': 1.5}
+                       for i in range(100)],
+    }
+    return [('device-model', schema, payload)]
+
+
+def load(paths):
+    cases = []
+    for schema_path, payload_path in zip(paths[::2], paths[1::2]):
+        with open(schema_path) as f:
+            schema = json.load(f)
+        with open(payload_path) as f:
+            payload = json.load(f)
+        cases.append((os.path.basename(schema_path), schema, payload))
+    return cases
+
+
+def rates(funcs, repeat=7):
+    """
+    Calls per second of each function: best of repeat runs of at least
+    0.2s each. Runs are interleaved so that load changes on the machine
+    affect every function alike.
+    """
+    timers = [timeit.Timer(func) for func in funcs]
+    numbers = [timer.autorange()[0] for timer in timers]
+    best = [float('inf')] * len(timers)
+    for _ in range(repeat):
+        for i, (timer, number) in enumerate(zip(timers, numbers)):
+            best[i] = min(best[i], timer.timeit(number) / number)
+    return [1 / seconds for seconds in best]
+
+
+def main():
+    cases = load(sys.argv[1:]) if len(sys.argv) > 1 else sample()
+    print(f'{"schema":>20} {"validate()":>14} {"cached":>14}')
+    for name, schema, payload in cases:
+        validator = get_validator(schema)
+        before, compiled, after = rates([
+            lambda: jsonschema.validate(payload, schema),
+            lambda: validate(validator, payload),
+            lambda: validate(get_validator(schema), payload)])
+        print(f'{name:>20} {before:>10.0f} v/s {compiled:>10.0f} v/s '
+              f'({after:.0f} v/s including the cache lookup)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+"""
+Minimal MQTT 3.1.1 broker standing in for packages/broker (mosca) in the
+benchmarks. It keeps no sessions between connections, delivers every
+message at QoS 0 and, like MicropedeBroker, publishes
+{app}/{name}/signal/connected and .../disconnected for every client.
+Wills and shared subscriptions ($share/{group}/{filter}, delivered round
+robin) are supported.
+
+    python benchmarks/broker.py [--port 1884]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from micropede.router import TopicRouter
+from micropede.transport import (CONNACK, CONNECT, DISCONNECT, PINGREQ,
+                                 PINGRESP, PUBACK, PUBCOMP, PUBLISH, PUBREC,
+                                 PUBREL, SUBACK, SUBSCRIBE, UNSUBACK,
+                                 UNSUBSCRIBE, PacketReader, decode_string,
+                                 encode_string, fixed_header, packet)
+
+
+class Session(asyncio.Protocol):
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.reader = PacketReader()
+        self.transport = None
+        self.client_id = None
+        self.filters = set()
+        self.will = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        for (packet_type, flags, body) in self.reader.feed(data):
+            self.handle(packet_type, flags, body)
+
+    def connection_lost(self, exc):
+        if self.will is not None and self in self.broker.sessions:
+            self.broker.publish(*self.will)
+        self.broker.remove(self)
+
+    def send(self, topic, payload, retain=False):
+        variable = encode_string(topic)
+        self.transport.writelines([
+            fixed_header(PUBLISH, 1 if retain else 0,
+                         len(variable) + len(payload)),
+            variable, payload])
+
+    def handle(self, packet_type, flags, body):
+        if packet_type == PUBLISH:
+            qos = (flags >> 1) & 0x3
+            topic, offset = decode_string(body, 0)
+            if qos:
+                mid = body[offset:offset + 2]
+                offset += 2
+                self.transport.write(
+                    packet(PUBACK if qos == 1 else PUBREC, 0, mid))
+            self.broker.publish(topic, body[offset:], bool(flags & 0x1))
+        elif packet_type == PUBREL:
+            self.transport.write(packet(PUBCOMP, 0, body[:2]))
+        elif packet_type == SUBSCRIBE:
+            offset, filters = 2, []
+            while offset < len(body):
+                sub, offset = decode_string(body, offset)
+                offset += 1
+                filters.append(sub)
+            self.transport.write(packet(SUBACK, 0, body[:2] + bytes(len(filters))))
+            self.broker.subscribe(self, filters)
+        elif packet_type == UNSUBSCRIBE:
+            offset, filters = 2, []
+            while offset < len(body):
+                sub, offset = decode_string(body, offset)
+                filters.append(sub)
+            self.broker.unsubscribe(self, filters)
+            self.transport.write(packet(UNSUBACK, 0, body[:2]))
+        elif packet_type == PINGREQ:
+            self.transport.write(packet(PINGRESP))
+        elif packet_type == CONNECT:
+            # Protocol name, level, flags and keepalive precede the client id
+            protocol, offset = decode_string(body, 0)
+            flags = body[offset + 1]
+            self.client_id, offset = decode_string(body, offset + 4)
+            if flags & 0x04:
+                topic, offset = decode_string(body, offset)
+                length = int.from_bytes(body[offset:offset + 2], 'big')
+                payload = bytes(body[offset + 2:offset + 2 + length])
+                self.will = (topic, payload, bool(flags & 0x20))
+            self.transport.write(packet(CONNACK, 0, b'\x00\x00'))
+            self.broker.add(self)
+        elif packet_type == DISCONNECT:
+            self.will = None
+            self.transport.close()
+
+
+class SharedGroup(object):
+    """ Sessions of one $share/{group}/{filter}, served in turn """
+
+    def __init__(self):
+        self.sessions = []
+        self.next = 0
+
+    def pick(self):
+        self.next = (self.next + 1) % len(self.sessions)
+        return self.sessions[self.next]
+
+
+def parse_shared(sub):
+    """ (group, filter) of a shared subscription, or None """
+    if sub.startswith('$share/'):
+        (share, group, sub) = sub.split('/', 2)
+        return (group, sub)
+
+
+class Broker(object):
+
+    def __init__(self):
+        self.sessions = set()
+        self.router = TopicRouter()
+        self.retained = {}
+        self.shared = {}
+
+    def add(self, session):
+        self.sessions.add(session)
+        self.signal(session, 'connected')
+
+    def remove(self, session):
+        if session not in self.sessions:
+            return
+        self.sessions.discard(session)
+        self.unsubscribe(session, list(session.filters))
+        self.signal(session, 'disconnected')
+
+    def signal(self, session, topic):
+        try:
+            (name, path, app_name, uid) = session.client_id.split('>>')
+        except ValueError:
+            return
+        self.publish(f'{app_name}/{name}/signal/{topic}', b'{}')
+
+    def subscribe(self, session, filters):
+        for sub in filters:
+            if sub in session.filters:
+                continue
+            session.filters.add(sub)
+            shared = parse_shared(sub)
+            if shared is None:
+                self.router.add_route(sub, session)
+                continue
+            group = self.shared.get(shared)
+            if group is None:
+                group = self.shared[shared] = SharedGroup()
+                self.router.add_route(shared[1], group)
+            group.sessions.append(session)
+        probe = TopicRouter()
+        for sub in filters:
+            # Shared subscriptions get no retained messages
+            if parse_shared(sub) is None:
+                probe.add_route(sub, None)
+        for topic, payload in list(self.retained.items()):
+            if probe.match(topic):
+                session.send(topic, payload, retain=True)
+
+    def unsubscribe(self, session, filters):
+        for sub in filters:
+            if sub not in session.filters:
+                continue
+            session.filters.discard(sub)
+            shared = parse_shared(sub)
+            if shared is None:
+                self.router.remove_route(sub, session)
+                continue
+            group = self.shared[shared]
+            group.sessions.remove(session)
+            if not group.sessions:
+                del self.shared[shared]
+                self.router.remove_route(shared[1], group)
+
+    def publish(self, topic, payload, retain=False):
+        if retain:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+        delivered = set()
+        for (session, params) in self.router.match(topic):
+            if isinstance(session, SharedGroup):
+                session = session.pick()
+            if session not in delivered:
+                delivered.add(session)
+                session.send(topic, payload)
+
+
+def start(host='127.0.0.1', port=0):
+    """ Run a Broker on a background thread, returns (broker, port) """
+    loop = asyncio.new_event_loop()
+    broker = Broker()
+    server = loop.run_until_complete(
+        loop.create_server(lambda: Session(broker), host, port))
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    return broker, server.sockets[0].getsockname()[1]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1884)
+    args = parser.parse_args()
+
+    loop = asyncio.new_event_loop()
+    broker = Broker()
+    server = loop.run_until_complete(
+        loop.create_server(lambda: Session(broker), args.host, args.port))
+    print(f'Listening on {args.host}:{args.port}')
+    loop.run_until_complete(server.serve_forever())
+
+
+if __name__ == '__main__':
+    main()
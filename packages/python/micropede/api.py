@@ -1,5 +1,15 @@
 from onoff import OnOffMixin
 
+from .batch import BATCH
+from .delta import DeltaReceiver
+
+
+def skip_batch(method):
+    def _method(payload, params):
+        if BATCH not in params.values():
+            return method(payload, params)
+    return _method
+
 
 class Topics(OnOffMixin):
     """
@@ -11,14 +21,25 @@ class Topics(OnOffMixin):
        and the expected retain behaviour.
     """
 
-    def on_state_msg(self, sender, val, method):
-        return self.add_subscription(f'{self.app_name}/{sender}/state/{val}', method)
+    def on_state_msg(self, sender, val, method, raw=False, delta=False):
+        channel = f'{self.app_name}/{sender}/state/{val}'
+        if delta:
+            # Rebuild values published with configure_state_deltas
+            receiver = DeltaReceiver(self, method)
+            return self.add_subscriptions(receiver.channels(channel), raw=True)
+        return self.add_subscription(channel, method, raw)
 
     def bind_state_msg(self, val, event, persist=True):
-        return self.add_binding(f'{self.app_name}/{self.name}/state/{val}', event, persist)
+        return self.add_binding(f'{self._state_prefix}{val}', event, persist)
 
-    def on_put_msg(self, val, method):
-        return self.add_subscription(f'{self.app_name}/put/{self.name}/{val}', method)
+    def on_put_msg(self, val, method, validate=False):
+        if validate:
+            method = self.validated(val, method)
+        if '{' in val:
+            # Batches are applied by the client, not by prop wildcards
+            method = skip_batch(method)
+        return self.add_subscription(f'{self._put_prefix}{val}', method,
+                                     balanced=True)
 
     def bind_put_msg(self, receiver, val, event):
         return self.add_binding(f'{self.app_name}/put/{receiver}/{val}', event)
@@ -27,7 +48,7 @@ class Topics(OnOffMixin):
         return self.add_subscription(f'{self.app_name}/{sender}/notify/{self.name}/{topic}', method)
 
     def bind_notify_msg(self, receiver, topic, event):
-        return self.add_binding(f'{self.app_name}/{self.name}/notify/{receiver}/{topic}', event)
+        return self.add_binding(f'{self._notify_prefix}{receiver}/{topic}', event)
 
     def on_status_msg(self, sender, method):
         return self.add_subscription(f'{self.app_name}/status/{sender}', method)
@@ -36,7 +57,8 @@ class Topics(OnOffMixin):
         return self.add_binding(f'{self.app_name}/status/{self.name}', event)
 
     def on_trigger_msg(self, action, method):
-        return self.add_subscription(f'{self.app_name}/trigger/{self.name}/{action}', method)
+        return self.add_subscription(f'{self._trigger_prefix}{action}', method,
+                                     balanced=True)
 
     def bind_trigger_msg(self, receiver, action, event):
         return self.add_binding(f'{self.app_name}/trigger/{receiver}/{action}', event)
@@ -1,23 +1,85 @@
 import asyncio
+import functools
 import json
 import uuid
 
-import pydash as _
+from . import codecs
+from .batch import BATCH
+from .client import (MicropedeClient, generate_client_id, get_head, noop,
+                     set_head)
+from .lazy import lazy_import
+from .presence import PresenceIndex
+from .state import StateCache
 
-from .client import MicropedeClient, generate_client_id, set_timeout
+_ = lazy_import('pydash')
 
 DEFAULT_TIMEOUT = 5000
 
+# What call_action does when the receiver is known to be offline
+OFFLINE_FAIL = 'fail'
+OFFLINE_WAIT = 'wait'
+
+
+def put_payload(prop, val):
+    """ A put_plugin value as a put payload, e.g. 5 -> {prop: 5} """
+    if (not _.is_dict(val)):
+        msg = {}
+        _.set_(msg, prop, val)
+        val = msg
+    return val
+
+
 class MicropedeAsync():
-    def __init__(self, app_name, host='localhost', port=None, version='0.0.0', loop=None):
+    """
+       Request / response helpers built ontop of MicropedeClient.
+
+       By default every request opens a fresh connection. With
+       persistent=True a single connection and a single wildcard notify
+       subscription are kept open, and replies are matched to requests
+       using the request_id stored in __head__ (so many requests can be in
+       flight at once).
+
+       With state_cache=True (which implies persistent=True) the retained
+       state of every plugin is mirrored locally, so get_state is served
+       from memory and watch_state can follow changes. state_deltas=True
+       also rebuilds state published as deltas (configure_state_deltas).
+
+       With presence=True (which implies persistent=True) connected plugins
+       are tracked (see presence.PresenceIndex): live_plugins lists them and
+       requests to a plugin known to be offline fail at once (offline='fail')
+       or wait for it to connect (offline='wait'), within the timeout.
+       offline sets the default for every request, call_action can
+       override it.
+    """
+
+    def __init__(self, app_name, host='localhost', port=None, version='0.0.0',
+                 loop=None, persistent=False, content_type=codecs.JSON,
+                 state_cache=False, state_cache_size=None, transport='paho',
+                 state_deltas=False, presence=False, offline=None):
         try:
             if (app_name is None):
                 raise(Exception("app_name is None"))
             name = f'micropede-async-{uuid.uuid1()}-{uuid.uuid4()}'
+            self.persistent = persistent or state_cache or presence
             self.client = MicropedeClient(app_name, host=host, port=port,
-                                          name=name, version=version, loop=loop)
+                                          name=name, version=version, loop=loop,
+                                          content_type=content_type,
+                                          transport=transport)
             self.safe = self.client.safe
-            self.client.listen = _.noop
+            self.client.listen = noop
+
+            # Persistent mode bookkeeping
+            self._channel = None
+            self._pending = {}
+            self._state_waiters = {}
+            self.state = None
+            if state_cache:
+                self.state = StateCache(self.client, state_cache_size,
+                                        state_deltas)
+            self.presence = None
+            self.offline = offline
+            if presence:
+                self.presence = PresenceIndex(self.client)
         except Exception as e:
             raise Exception(self.dump_stack(self.client.name, e))
 
@@ -31,10 +93,205 @@ class MicropedeAsync():
         await self.client.connect_client(self.client.client_id, host, port)
         return
 
+    async def open_channel(self):
+        """ Connect once and subscribe to all notify replies (persistent mode) """
+        if self._channel is None:
+            self._channel = asyncio.ensure_future(self._open_channel(),
+                                                  loop=self.client.loop)
+        try:
+            return await asyncio.shield(self._channel)
+        except Exception:
+            self._channel = None
+            raise
+
+    async def _open_channel(self):
+        await self.reset()
+        with self.client.batch_subscriptions():
+            futures = [self.client.on_notify_msg('{sender}', '{action}',
+                                                 self._on_reply)]
+            if self.state is not None:
+                futures.append(self.state.start())
+            if self.presence is not None:
+                futures.append(self.presence.start())
+        await asyncio.gather(*futures)
+        return self.client
+
+    async def close(self):
+        """ Fail any pending requests and disconnect the persistent channel """
+        for request_id in list(self._pending):
+            future = self._pending.pop(request_id)[0]
+            if not future.done():
+                future.set_exception(
+                    self.dump_stack(self.client.name, 'client closed'))
+        self._channel = None
+        await self.client.disconnect_client()
+
+    def _on_reply(self, payload, params):
+        request_id = get_head(payload, 'request_id')
+        if request_id is None:
+            # Plugins that do not echo request_id: fall back to the oldest
+            # pending request for the same receiver and action
+            for key, (future, receiver, action, label) in self._pending.items():
+                if (receiver == params.get('sender') and
+                        action == params.get('action')):
+                    request_id = key
+                    break
+            if request_id is None:
+                return
+        elif request_id not in self._pending:
+            # A late reply to a request that timed out or was cancelled
+            return
+
+        future, receiver, action, label = self._pending.pop(request_id)
+        if future.done():
+            return
+
+        status = payload.get('status') if isinstance(payload, dict) else None
+        if status is None:
+            print("WARNING: ", label, 'message did not contain status')
+        elif status != 'success':
+            future.set_exception(self.dump_stack(label, status))
+            return
+        future.set_result(payload)
+
+    def _on_state(self, key, payload, params):
+        for future in self._state_waiters.pop(key, []):
+            if not future.done():
+                future.set_result(payload)
+        self.client.remove_subscription(key)
+
+    async def _persistent_get_state(self, topic, label, timeout):
+        await self.open_channel()
+        future = asyncio.Future(loop=self.client.loop)
+        waiters = self._state_waiters.setdefault(topic, [])
+        waiters.append(future)
+        if len(waiters) == 1:
+            await self.client.add_subscription(
+                topic, functools.partial(self._on_state, topic))
+
+        def on_timeout():
+            if future.done():
+                return
+            waiters = self._state_waiters.get(topic, [])
+            if future in waiters:
+                waiters.remove(future)
+            if len(waiters) == 0:
+                self._state_waiters.pop(topic, None)
+                self.client.remove_subscription(topic)
+            future.set_exception(
+                self.dump_stack(label, [topic, f'timeout {timeout}ms']))
+
+        self.client.set_timeout(on_timeout, timeout, future)
+        return await future
+
+    async def _persistent_call_action(self, topic, receiver, action, val,
+                                      label, timeout, offline=None):
+        await self.open_channel()
+        if offline is None:
+            offline = self.offline
+        if (offline is not None and self.presence is not None and
+                self.presence.is_offline(receiver)):
+            if offline != OFFLINE_WAIT:
+                raise self.dump_stack(label, [topic, f'{receiver} is offline'])
+            started = self.client.loop.time()
+            try:
+                await self.presence.wait_online(receiver, timeout)
+            except Exception as e:
+                raise self.dump_stack(label, [topic, e])
+            if timeout != -1:
+                waited = (self.client.loop.time() - started) * 1000
+                timeout = max(timeout - waited, 0)
+
+        request_id = uuid.uuid4().hex
+        set_head(val, 'request_id', request_id)
+        future = asyncio.Future(loop=self.client.loop)
+        self._pending[request_id] = (future, receiver, action, label)
+
+        self.client.send_message(topic, val)
+
+        if timeout != -1:
+            def on_timeout():
+                self._pending.pop(request_id, None)
+                if future.done():
+                    return
+                future.set_exception(
+                    self.dump_stack(label, [topic, f'timeout {timeout}ms']))
+            self.client.set_timeout(on_timeout, timeout, future)
+
+        try:
+            return await future
+        finally:
+            # Cancelled requests (see gather_action) stop waiting for a reply
+            self._pending.pop(request_id, None)
+
+    async def gather_action(self, receivers, action, val={}, msg_type='trigger',
+                            timeout=DEFAULT_TIMEOUT, quorum=None, offline=None):
+        """
+        Call action on every receiver at once and wait for the replies
+        Returns {receiver: payload} with an Exception for receivers that
+        failed or timed out. With quorum, returns once that many receivers
+        replied successfully (receivers still pending are left out).
+        """
+        results = {}
+        async for receiver, result in self.iter_gather_action(
+                receivers, action, val, msg_type, timeout, quorum, offline):
+            results[receiver] = result
+        return results
+
+    async def iter_gather_action(self, receivers, action, val={},
+                                 msg_type='trigger', timeout=DEFAULT_TIMEOUT,
+                                 quorum=None, offline=None):
+        """
+        Async iterator over (receiver, payload or Exception) in the order
+        the replies arrive, see gather_action
+        async for receiver, result in iter_gather_action(plugins, 'ping'): ...
+        """
+        # Replies are collected on the persistent notify subscription
+        await self.open_channel()
+        label = f'{self.client.app_name}::gatherAction::{msg_type}::{action}'
+        tasks = {}
+        for receiver in dict.fromkeys(receivers):
+            request = dict(val)
+            request['__head__'] = dict(val.get('__head__') or {})
+            request['__head__']['plugin_name'] = self.client.name
+            request['__head__']['version'] = self.client.version
+            topic = f'{self.client.app_name}/{msg_type}/{receiver}/{action}'
+            task = asyncio.ensure_future(self._persistent_call_action(
+                topic, receiver, action, request, label, timeout, offline))
+            tasks[task] = receiver
+
+        succeeded = 0
+        try:
+            while tasks:
+                done, pending = await asyncio.wait(
+                    tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    receiver = tasks.pop(task)
+                    if task.exception() is not None:
+                        yield receiver, task.exception()
+                    else:
+                        succeeded += 1
+                        yield receiver, task.result()
+                    if quorum is not None and succeeded >= quorum:
+                        return
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if not self.persistent:
+                await self.close()
+
     async def get_state(self, sender, prop, timeout=DEFAULT_TIMEOUT):
         label = f'{self.client.app_name}::get_state'
         topic = f'{self.client.app_name}/{sender}/state/{prop}'
         timer = None
+        if self.state is not None:
+            await self.open_channel()
+            if (sender, prop) in self.state:
+                return self.state.get(sender, prop)
+        if self.persistent:
+            return await self._persistent_get_state(topic, label, timeout)
+
         future = asyncio.Future(loop=self.client.loop)
 
         try:
@@ -61,28 +318,71 @@ class MicropedeAsync():
             f1 = self.client.disconnect_client()
             f1.add_done_callback(self.safe(on_disconnect))
 
-        set_timeout(self.safe(on_timeout), timeout)
+        self.client.set_timeout(on_timeout, timeout, future)
 
         return await future
 
+    async def watch_state(self, sender, prop):
+        """
+        Async iterator over the state of a plugin (requires state_cache=True)
+        async for value in watch_state('plugin', 'prop'): ...
+        """
+        if self.state is None:
+            raise self.dump_stack(self.client.name, 'state_cache is disabled')
+        await self.open_channel()
+        async for value in self.state.watch(sender, prop):
+            yield value
+
+    async def live_plugins(self, include_unknown=False):
+        """
+        [{name, status, version, connected_at, connections}] of the
+        connected plugins (requires presence=True), see PresenceIndex.live
+        """
+        if self.presence is None:
+            raise self.dump_stack(self.client.name, 'presence is disabled')
+        await self.open_channel()
+        return self.presence.live(include_unknown)
+
     async def get_subscriptions(self, receiver, timeout=DEFAULT_TIMEOUT):
         payload = await self.trigger_plugin(receiver, 'get-subscriptions', {}, timeout)
         return _.get(payload, 'response')
 
-    async def put_plugin(self, receiver, prop, val, timeout=DEFAULT_TIMEOUT):
-        if (not _.is_dict(val)):
-            msg = {}
-            _.set_(msg, prop, val)
-            val = msg
-        result = await self.call_action(receiver, prop, val,  'put', timeout)
+    async def put_plugin(self, receiver, prop, val, timeout=DEFAULT_TIMEOUT,
+                         offline=None):
+        val = put_payload(prop, val)
+        result = await self.call_action(receiver, prop, val,  'put', timeout,
+                                        offline)
         return result
 
-    async def trigger_plugin(self, receiver, action, val={}, timeout=DEFAULT_TIMEOUT):
-        result = await self.call_action(receiver, action, val, 'trigger', timeout)
+    async def put_plugins(self, receiver, values, timeout=DEFAULT_TIMEOUT,
+                          offline=None):
+        """
+        Put several properties of receiver in one message and one reply
+        values: {prop: val} (each val as for put_plugin)
+        Returns {prop: response} with an Exception for the properties the
+        plugin failed to put (see batch.PutBatch)
+        """
+        label = f'{self.client.app_name}::putPlugins'
+        puts = {prop: put_payload(prop, val) for prop, val in values.items()}
+        payload = await self.call_action(receiver, BATCH, {'puts': puts},
+                                         'put', timeout, offline)
+        results = {}
+        for prop, result in (_.get(payload, 'response') or {}).items():
+            if result.get('status') == 'success':
+                results[prop] = result.get('response')
+            else:
+                results[prop] = self.dump_stack(
+                    f'{label}::{prop}', result.get('response'))
+        return results
+
+    async def trigger_plugin(self, receiver, action, val={}, timeout=DEFAULT_TIMEOUT,
+                             offline=None):
+        result = await self.call_action(receiver, action, val, 'trigger', timeout,
+                                        offline)
         return result
 
     async def call_action(self, receiver, action, val={}, msg_type='trigger',
-                             timeout=DEFAULT_TIMEOUT):
+                             timeout=DEFAULT_TIMEOUT, offline=None):
         label = f'{self.client.app_name}::callAction::{msg_type}::{action}'
         future = asyncio.Future(loop=self.client.loop)
         # import pdb; pdb.set_trace()
@@ -93,9 +393,20 @@ class MicropedeAsync():
         if timeout is -1:
             no_timeout = True
 
-        _.set_(val, '__head__.plugin_name', self.client.name)
-        _.set_(val, '__head__.version', self.client.version)
+        if self.persistent:
+            # Requests run concurrently, so never share (or mutate) the
+            # caller's dict between them
+            val = dict(val)
+            val['__head__'] = dict(val.get('__head__') or {})
+
+        set_head(val, 'plugin_name', self.client.name)
+        set_head(val, 'version', self.client.version)
         topic = f'{self.client.app_name}/{msg_type}/{receiver}/{action}'
+
+        if self.persistent:
+            return await self._persistent_call_action(
+                topic, receiver, action, val, label, timeout, offline)
+
         try:
             self.enforce_single_subscription(label)
             await self.reset()
@@ -135,7 +446,7 @@ class MicropedeAsync():
                         self.dump_stack(label, [topic, f'timeout {timeout}ms']))
                 f1 = self.client.disconnect_client()
                 f1.add_done_callback(self.safe(on_disconnect))
-            set_timeout(self.safe(on_timeout), timeout)
+            self.client.set_timeout(on_timeout, timeout, future)
 
         return await future
 
@@ -0,0 +1,197 @@
+"""Apply several puts sent to a plugin in one message"""
+
+import asyncio
+import collections
+import uuid
+
+from . import codecs
+
+# {app}/put/{receiver}/__batch__ and {app}/{sender}/notify/{receiver}/__batch__
+BATCH = '__batch__'
+
+DEFAULT_BATCH_TIMEOUT = 5000
+
+
+class StateHold(object):
+    """
+       Holds back set_state calls while put batches are applied, so every
+       key is published once, with its newest value, when the last batch
+       releases the hold (once its handlers are done). Held set_state calls
+       return at once; published resolves once every held value is.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.pending = collections.OrderedDict()
+        self.holders = 0
+        self.published = asyncio.Future(loop=client.loop)
+
+    def hold(self, key, value):
+        self.pending[key] = value
+
+    def release(self):
+        self.holders -= 1
+        if self.holders > 0:
+            return
+        self.client._state_hold = None
+        futures = [asyncio.ensure_future(self.client._set_state(key, value),
+                                         loop=self.client.loop)
+                   for key, value in self.pending.items()]
+        self.pending.clear()
+        asyncio.gather(*futures, return_exceptions=True).add_done_callback(
+            lambda f: self.published.set_result(len(futures)))
+
+
+class PutBatch(object):
+    """
+       Applies a message received on {app}/put/{name}/__batch__:
+         {'puts': {prop: payload, ...}, '__head__': {...}}
+
+       Every payload goes to the put handlers of {app}/put/{name}/{prop}
+       as if it had been sent on its own (with the batch's __head__). The
+       replies those handlers send with notify_sender are collected instead
+       of published, and a single reply {prop: {status, response}} is sent
+       on .../notify/{sender}/__batch__ once every property is done (or
+       after timeout ms), after the state they set. A handler returning
+       without a reply counts as a success, one raising as failed. Handlers
+       run in an executor are not waited for, their replies are sent on
+       their own.
+
+       set_state calls made until the handlers are done are held back
+       (StateHold) so each state key is published once per batch.
+    """
+
+    def __init__(self, client, payload, timeout=DEFAULT_BATCH_TIMEOUT):
+        self.client = client
+        self.payload = payload
+        self.timeout = timeout
+        self.id = uuid.uuid4().hex
+        self.results = {}
+        self.running = collections.Counter()
+        self.dispatched = False
+        self.hold = None
+        self.released = False
+        self.future = asyncio.Future(loop=client.loop)
+
+    def apply(self):
+        client = self.client
+        puts = self.payload.get('puts') if isinstance(self.payload, dict) else None
+        if not isinstance(puts, dict):
+            return self.reply({'__batch__': {
+                'status': 'failed', 'response': ['puts must be a dict']}})
+
+        if client._state_hold is None:
+            client._state_hold = StateHold(client)
+        hold = self.hold = client._state_hold
+        hold.holders += 1
+        client._put_batches[self.id] = self
+        try:
+            for prop, value in puts.items():
+                self.dispatch(prop, value)
+        finally:
+            self.dispatched = True
+            self.release_when_idle()
+        hold.published.add_done_callback(self.on_released)
+        client.set_timeout(self.on_timeout, self.timeout, self.future)
+        return self.future
+
+    def release_when_idle(self):
+        """ Release the state hold once every handler is done """
+        if (self.hold is None or not self.dispatched or
+                any(self.running.values())):
+            return
+        hold, self.hold = self.hold, None
+        # Coroutines the handlers started run before the hold is released
+        self.client.loop.call_soon(hold.release)
+
+    def on_released(self, f):
+        self.released = True
+        self.check()
+
+    def dispatch(self, prop, value):
+        client = self.client
+        if prop == BATCH or not isinstance(value, dict):
+            self.results[prop] = {'status': 'failed',
+                                  'response': ['invalid put payload']}
+            return
+        topic = f'{client.app_name}/put/{client.name}/{prop}'
+        matches = client.router.match(topic)
+        if not matches:
+            self.results[prop] = {'status': 'failed',
+                                  'response': [f'no put handler for {prop}']}
+            return
+
+        head = dict(self.payload.get('__head__') or {})
+        head['batch_id'] = self.id
+        head['batch_prop'] = prop
+        value = dict(value, __head__=head)
+        message = codecs.Message(topic, codecs.encode(value))
+
+        workers = client.workers
+        if workers is not None:
+            # The batch was already balanced as a whole
+            workers.forced = True
+        try:
+            for method, params in matches:
+                try:
+                    result = method(message, params)
+                except Exception as e:
+                    self.done(prop, 'failed', [str(e)])
+                    continue
+                if isinstance(result, asyncio.Future) and not result.done():
+                    self.running[prop] += 1
+                    result.add_done_callback(
+                        lambda f, prop=prop: self.on_handler_done(prop, f))
+                elif isinstance(result, asyncio.Future):
+                    self.on_handler_done(prop, result, running=False)
+        finally:
+            if workers is not None:
+                workers.forced = False
+        if self.running[prop] == 0:
+            self.done(prop, 'success', None)
+
+    def on_handler_done(self, prop, f, running=True):
+        if running:
+            self.running[prop] -= 1
+        if not f.cancelled() and f.exception() is not None:
+            self.done(prop, 'failed', [str(f.exception())])
+        elif self.running[prop] == 0:
+            self.done(prop, 'success', None)
+        self.release_when_idle()
+        self.check()
+
+    def notify(self, payload, response, status):
+        """ Collect a reply sent by a handler with notify_sender """
+        prop = payload['__head__'].get('batch_prop')
+        self.done(prop, status, response)
+        self.check()
+        return response
+
+    def done(self, prop, status, response):
+        # The first reply (or failure) of a property wins
+        if prop not in self.results:
+            self.results[prop] = {'status': status, 'response': response}
+
+    def check(self):
+        puts = self.payload['puts']
+        if (self.released and not self.future.done() and
+                all(prop in self.results for prop in puts)):
+            self.reply(self.results)
+
+    def on_timeout(self):
+        if self.future.done():
+            return
+        if self.hold is not None:
+            # Publish what the handlers set so far
+            hold, self.hold = self.hold, None
+            hold.release()
+        for prop in self.payload['puts']:
+            self.done(prop, 'failed', [f'timeout {self.timeout}ms'])
+        self.reply(self.results)
+
+    def reply(self, results):
+        self.client._put_batches.pop(self.id, None)
+        self.client.notify_sender(self.payload, results, BATCH)
+        if not self.future.done():
+            self.future.set_result(results)
+        return self.future
@@ -3,6 +3,8 @@
 __version__ = '0.0.2'
 
 import asyncio
+import collections
+import contextlib
 import functools
 import inspect
 import json
@@ -12,24 +14,47 @@ import time
 import types
 import random
 import re
+import sys
 import urllib
 import uuid
 import threading
 from threading import Timer, Thread
 
-from jsonschema import validate
-import paho.mqtt.client as mqtt
-import pydash as _
-from wheezy.routing import PathRouter
-
+from . import codecs
 from .api import Topics
+from .batch import BATCH, PutBatch
+from .coalesce import PublishCoalescer
+from .delta import DEFAULT_SNAPSHOT_EVERY, DeltaPublisher
+from .executors import HandlerExecutor, INLINE
+from .lazy import lazy_import
+from .metrics import MetricsRegistry
+from .outbox import OfflineQueue
+from .recorder import Recorder, Replayer
+from .router import TopicRouter
+from .scheduler import InboundScheduler
+from .stream import (BROKER, DEFAULT_CHUNK_SIZE, DEFAULT_STREAM_TIMEOUT,
+                     DEFAULT_WINDOW, StreamReceiver, StreamSender)
+from .timers import TimerWheel, in_loop
+from .transport import AsyncioClient, err_no_conn
+from .workers import AUTO, WorkerGroup
+
+# Only imported once used (validation, the paho transport, error helpers)
+validators = lazy_import('jsonschema.validators')
+exceptions = lazy_import('jsonschema.exceptions')
+mqtt = lazy_import('paho.mqtt.client')
+_ = lazy_import('pydash')
 
 DEFAULT_PORT = 1884
 DEFAULT_TIMEOUT = 5000
+DEFAULT_MAX_INFLIGHT = 100
+DEFAULT_MAX_BACKLOG = 10000
+DEFAULT_MIN_RECONNECT_DELAY = 1
+DEFAULT_MAX_RECONNECT_DELAY = 120
 _underscorer1 = re.compile(r'(.)([A-Z][a-z]+)')
 _underscorer2 = re.compile('([a-z0-9])([A-Z])')
 
 def set_timeout(callback, timeout=DEFAULT_TIMEOUT):
+    # Spawns a thread per call, prefer MicropedeClient.set_timeout
     Timer(timeout/1000.0, callback).start()
 
 def camel_to_snake(s):
@@ -44,20 +69,35 @@ def get_class_name(self):
                               safe=safe_chars)
 
 
-def get_receiver(payload):
-    return _.get(payload, "__head__.plugin_name")
+def noop(*args, **kwargs):
+    pass
 
 
-def wrap_data(key, value, name, version):
-    msg = {}
-    if (_.is_object(value) and value is not None):
-        msg = value
-    else:
-        msg[key] = value
+def identity(value):
+    return value
+
 
-    _.set_(msg, "__head__.plugin_name", name)
-    _.set_(msg, "__head__.plugin_version", version)
+def get_head(payload, key):
+    """ payload['__head__'][key], or None """
+    head = payload.get('__head__') if isinstance(payload, dict) else None
+    return head.get(key) if isinstance(head, dict) else None
 
+
+def set_head(msg, key, value):
+    head = msg.get('__head__')
+    if not isinstance(head, dict):
+        head = msg['__head__'] = {}
+    head[key] = value
+
+
+def get_receiver(payload):
+    return get_head(payload, 'plugin_name')
+
+
+def wrap_data(key, value, name, version):
+    msg = value if isinstance(value, dict) else {key: value}
+    set_head(msg, 'plugin_name', name)
+    set_head(msg, 'plugin_version', version)
     return msg
 
 
@@ -69,6 +109,65 @@ def dump_stack(label, err):
     else:
         return _.flatten_deep([label, str(err)])
 
+# (id(schema), prop) -> (schema, validator), oldest first
+_validators = {}
+MAX_VALIDATORS = 256
+
+
+def get_validator(schema, prop=None):
+    """
+    Return a compiled validator for schema (or for one of its properties),
+    cached by schema object so it is only checked and built once
+    """
+    key = (id(schema), prop)
+    cached, validator = _validators.get(key, (None, None))
+    if cached is not schema:
+        target = schema
+        if prop is not None:
+            target = dict(_.get(schema, ['properties', prop]) or {})
+            # Keep local $refs resolvable from the property schema
+            for defs in ['definitions', '$defs']:
+                if defs in schema:
+                    target.setdefault(defs, schema[defs])
+        cls = validators.validator_for(target)
+        cls.check_schema(target)
+        validator = cls(target)
+        if len(_validators) >= MAX_VALIDATORS:
+            del _validators[next(iter(_validators))]
+        # Keeps schema alive, so its id is not reused while cached
+        _validators[key] = (schema, validator)
+    return validator
+
+
+def forget_validators(schema):
+    """ Drop the cached validators of schema (after modifying it in place) """
+    for key in [key for key in _validators if key[0] == id(schema)]:
+        del _validators[key]
+
+
+def validate(validator, payload):
+    error = exceptions.best_match(validator.iter_errors(payload))
+    if error is not None:
+        raise error
+
+
+def call_with_payload(handler, message, params):
+    return handler(message.payload, params)
+
+
+def chain_futures(futures, f):
+    """ Resolve every future in futures the same way as f """
+    for future in futures:
+        if future.done():
+            continue
+        if f.cancelled():
+            future.cancel()
+        elif f.exception() is not None:
+            future.set_exception(f.exception())
+        else:
+            future.set_result(f.result())
+
+
 def channel_to_route_path(channel):
     return channel
 
@@ -80,6 +179,21 @@ def channel_to_subscription(channel):
 def generate_client_id(name, app_name, path='unknown'):
     return f'{name}>>{path}>>{app_name}>>{uuid.uuid1()}-{uuid.uuid4()}'
 
+def start_loop_thread():
+    """ Create an event loop running forever in its own thread """
+    def start_loop(x):
+        x.loop = asyncio.new_event_loop()
+        x.loop.call_soon_threadsafe(x.ready_event.set)
+        x.loop.run_forever()
+
+    # Initialize loop and pass reference to main thread
+    class X(object): pass
+    X.ready_event = threading.Event()
+    t = Thread(target=start_loop, args=(X,))
+    t.start()
+    X.ready_event.wait()
+    return X.loop
+
 def safe(loop):
     def __safe(function):
         @functools.wraps(function)
@@ -100,10 +214,48 @@ class MicropedeClient(Topics):
        Python based client for Micropede Application Framework
        Used with the following broker:
        https://github.com/sci-bots/microdrop-3.0/blob/master/MoscaServer.js
+
+       transport: 'paho' (default) runs paho's network thread and hands
+       every callback over to the client loop; 'asyncio' speaks MQTT
+       directly on the client loop (see transport.AsyncioClient). A
+       callable(client_id, loop) can return any other paho compatible
+       client whose callbacks run on the loop (see host.PluginHost).
+
+       max_inflight: at most this many publishes await acknowledgement;
+       further messages wait in a backlog and are sent in order as slots
+       free up. Once max_backlog messages wait, send_message fails at once.
+
+       offline_queue: True (or an outbox.OfflineQueue) buffers publishes
+       made while disconnected and replays them in order on reconnect.
+
+       reconnect: retry a lost connection, waiting from min_reconnect_delay
+       up to max_reconnect_delay seconds (doubling after each attempt).
+       Subscriptions are restored with one SUBSCRIBE and routes are kept;
+       see reconnect_stats.
+
+       metrics: True (or a metrics.MetricsRegistry) counts and times
+       message decoding, routing, handlers and publish acks; see
+       get_metrics and the get-metrics trigger.
+
+       worker_group: True (or a group name) lets several processes run
+       this plugin, each on_trigger_msg / on_put_msg request being handled
+       by one of them. worker_mode is 'shared' (MQTT shared subscriptions),
+       'hash' (client side) or 'auto'; see workers.WorkerGroup.
+
+       scheduler: True (or a scheduler.InboundScheduler) dispatches
+       received triggers before puts and replies, and those before state
+       and signals, collapsing queued state messages per topic.
     """
 
     def __init__(self, app_name, host="localhost", port=None, name=None,
-                 version='0.0.0', loop=None):
+                 version='0.0.0', loop=None, max_inflight=DEFAULT_MAX_INFLIGHT,
+                 max_backlog=DEFAULT_MAX_BACKLOG,
+                 content_type=codecs.JSON, transport='paho', offline_queue=None,
+                 reconnect=True,
+                 min_reconnect_delay=DEFAULT_MIN_RECONNECT_DELAY,
+                 max_reconnect_delay=DEFAULT_MAX_RECONNECT_DELAY,
+                 metrics=True, worker_group=None, worker_mode=AUTO,
+                 scheduler=None):
         if (app_name is None):
             raise("app_name is undefined")
 
@@ -113,54 +265,181 @@ class MicropedeClient(Topics):
         if (name is None):
             name = get_class_name(self)
 
-        self.router = PathRouter()
+        self.router = TopicRouter()
         client_id = generate_client_id(name, app_name)
-        self.__listen = _.noop
+        self.__listen = noop
 
         self.app_name = app_name
         self.client_id = client_id
         self.name = name
         self.schema = {}
-        self.subscriptions = []
+        self._schema_validators = {}
+        # Subscribed filters in order (a dict, for cheap membership tests)
+        self.subscriptions = {}
         self.host = host
         self.port = port
         self.version = version
+        # __head__ and topic prefixes of the messages this client sends
+        self._head = {'plugin_name': name, 'plugin_version': version}
+        self._state_prefix = f'{app_name}/{name}/state/'
+        self._notify_prefix = f'{app_name}/{name}/notify/'
+        self._trigger_prefix = f'{app_name}/trigger/{name}/'
+        self._put_prefix = f'{app_name}/put/{name}/'
+        self.content_type = content_type
+        self.transport = transport
         self.last_message = None
+        self.recorders = []
+        # Put batches being applied (see batch.PutBatch)
+        self._put_batches = {}
+        self._state_hold = None
         self.loop = None
         self.safe = None
         self.client = None
 
+        # Publishes awaiting acknowledgement (keyed by paho mid)
+        self.max_inflight = max_inflight
+        self.max_backlog = max_backlog
+        self._inflight = {}
+        # Futures holding a slot of the in-flight window
+        self._reserved = set()
+        self._backlog = collections.deque()
+        self._inflight_lock = threading.Lock()
+
+        # Pending SUBACK / UNSUBACK futures (keyed by paho mid)
+        self._subacks = {}
+        self._sub_batch = None
+        self._blocked_executors = set()
+        # HandlerExecutors created for executor='thread' / 'process', keyed
+        # by kind and options
+        self._executors = {}
+
+        # Publishes made while disconnected (see outbox.OfflineQueue)
+        if offline_queue is True:
+            offline_queue = OfflineQueue()
+        elif offline_queue is False:
+            offline_queue = None
+        self.outbox = offline_queue
+        self.connected = False
+        self._disconnect_callback = None
+
+        self.reconnect = reconnect
+        self.min_reconnect_delay = min_reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self._disconnected_at = None
+        self._reconnect_stats = collections.Counter()
+        self._reconnect_latencies = collections.deque(maxlen=100)
+        self._resubscribe_latency = None
+
+        if metrics is True:
+            metrics = MetricsRegistry()
+        elif metrics is False:
+            metrics = None
+        self.metrics = metrics
+
         if (loop == None):
-            # Create thread to run event loop
-            def start_loop(x):
-                x.loop = asyncio.new_event_loop()
-                x.loop.call_soon_threadsafe(x.ready_event.set)
-                x.loop.run_forever()
-
-            # Initialize loop and pass reference to main thread
-            class X(object): pass
-            X.ready_event = threading.Event()
-            t = Thread(target=start_loop, args=(X,))
-            t.start()
-            X.ready_event.wait()
-            self.loop = X.loop
+            self.loop = start_loop_thread()
         else:
             self.loop = loop
         self.safe = safe(self.loop)
+        self.timers = TimerWheel(self.loop)
+        self.coalescer = PublishCoalescer(self)
+        self.deltas = DeltaPublisher(self)
+
+        # Dispatch by priority class (see scheduler.InboundScheduler)
+        if scheduler is True:
+            scheduler = InboundScheduler()
+        elif scheduler is False:
+            scheduler = None
+        self.scheduler = scheduler
+        if scheduler is not None:
+            scheduler.attach(self)
+
+        # Processes sharing this plugin name (see workers.WorkerGroup)
+        self.workers = None
+        if worker_group:
+            group = None if worker_group is True else worker_group
+            self.workers = WorkerGroup(self, group, worker_mode)
 
         # Start client
         self.wait_for(self.connect_client(client_id, host, port))
 
     def wait_for(self, f):
         if (isinstance(f, (asyncio.Future, types.CoroutineType) )):
-            asyncio.ensure_future(f, loop=self.loop)
+            return asyncio.ensure_future(f, loop=self.loop)
 
     def wrap(self, func):
         return lambda *args, **kwargs: self.wait_for(func(*args, **kwargs))
 
+    def wrap_handler(self, handler, raw=False, executor=None, channel=None,
+                     executor_options=None):
+        """ Adapt a subscription handler to receive codecs.Message objects """
+        if executor is None or executor == INLINE:
+            handler = self.wrap(handler)
+        else:
+            if isinstance(executor, str):
+                executor = self.executor(executor, **(executor_options or {}))
+            executor.check(handler)
+            if executor.on_backpressure is None:
+                executor.on_backpressure = self._backpressure
+            handler = functools.partial(executor.submit, handler)
+        if not raw:
+            handler = functools.partial(call_with_payload, handler)
+        if self.metrics is not None and channel is not None:
+            handler = self.metrics.instrument(channel, handler, not raw)
+        return handler
+
+    def executor(self, kind, **options):
+        """
+        The client's shared HandlerExecutor of kind ('thread', 'process')
+        options: max_workers, max_queue and overflow (see HandlerExecutor);
+                 subscriptions using the same options share the executor
+        """
+        key = (kind, tuple(sorted(options.items())))
+        if key not in self._executors:
+            self._executors[key] = HandlerExecutor(kind, **options)
+        return self._executors[key]
+
+    def _shutdown_executors(self):
+        # Running handlers finish, their pools are then released
+        for executor in self._executors.values():
+            self._blocked_executors.discard(executor)
+            executor.shutdown(wait=False)
+        self._executors = {}
+
+    def _backpressure(self, executor, blocked):
+        # Stop reading from the broker while a blocking executor is full
+        if blocked:
+            self._blocked_executors.add(executor)
+        else:
+            self._blocked_executors.discard(executor)
+        if hasattr(self.client, 'pause_reading'):
+            if self._blocked_executors:
+                self.client.pause_reading()
+            else:
+                self.client.resume_reading()
+
+    def set_timeout(self, callback, timeout=DEFAULT_TIMEOUT, future=None):
+        """
+        Call callback on the client loop after timeout ms. If a future is
+        given, the timer is cancelled as soon as the future is done.
+        """
+        timer = self.timers.call_later(timeout, callback)
+        if future is not None:
+            future.add_done_callback(lambda f: timer.cancel())
+        return timer
+
+    @property
+    def pending_timers(self):
+        return self.timers.pending
+
     @property
     def is_plugin(self):
-        return not _.is_equal(self.listen, _.noop)
+        listen = self.listen
+        if listen is noop:
+            return False
+        # pydash's noop can only be the listener if pydash is imported
+        pydash = sys.modules.get('pydash')
+        return pydash is None or listen is not pydash.noop
 
     @property
     def listen(self):
@@ -173,7 +452,17 @@ class MicropedeClient(Topics):
     def exit(self, *args, **kwargs):
         pass
 
-    def add_binding(self, channel, event, retain=False, qos=0, dup=False):
+    def add_binding(self, channel, event, retain=False, qos=0, dup=False,
+                    coalesce=False, max_rate=None, debounce=None, merge=False):
+        """
+        Publish on channel whenever event is triggered. With coalesce (or
+        any of max_rate (Hz), debounce (ms) or merge) only the newest value
+        is published per flush, see PublishCoalescer.
+        """
+        if (coalesce or max_rate or debounce or merge):
+            self.coalescer.configure(channel, max_rate, debounce, merge)
+            return self.on(event, lambda d: self.coalescer.publish(
+                channel, d, retain, qos, dup))
         return self.on(event, lambda d: self.send_message(
             channel, d, retain, qos, dup))
 
@@ -181,43 +470,107 @@ class MicropedeClient(Topics):
         LABEL = f'{self.app_name}::get_schema'
         return self.notify_sender(payload, self.schema, 'get-schema')
 
+    def get_validator(self, prop=None):
+        """ Compiled validator for self.schema (rebuilt if it is replaced) """
+        schema, validator = self._schema_validators.get(prop, (None, None))
+        if schema is not self.schema:
+            validator = get_validator(self.schema, prop)
+            self._schema_validators[prop] = (self.schema, validator)
+        return validator
+
+    def invalidate_schema(self):
+        """ Call after modifying self.schema in place """
+        self._schema_validators = {}
+        forget_validators(self.schema)
+
     def validate_schema(self, payload):
-        return validate(payload, self.schema)
+        return validate(self.get_validator(), payload)
+
+    def validate_put(self, prop, payload):
+        """ Validate a put payload against the schema of prop """
+        if not _.get(self.schema, ['properties', prop]):
+            return
+        if not _.is_dict(payload):
+            raise exceptions.ValidationError(
+                f'put payload must be an object, not {type(payload).__name__}')
+        if prop in payload:
+            value = payload[prop]
+        else:
+            value = {k: v for k, v in payload.items() if k != '__head__'}
+        return validate(self.get_validator(prop), value)
+
+    def validated(self, prop, handler):
+        """ Wrap a put handler so invalid payloads are rejected first """
+        def _handler(payload, params):
+            try:
+                self.validate_put(prop, payload)
+            except Exception as e:
+                stack = dump_stack(self.name, e)
+                if get_receiver(payload) is None:
+                    # Nobody to reply to
+                    return stack
+                return self.notify_sender(payload, stack, prop, 'failed')
+            return handler(payload, params)
+        return _handler
 
     def ping(self, payload, params):
         return self.notify_sender(payload, "pong", "ping")
 
-    def add_subscription(self, channel, handler):
-        path = channel_to_route_path(channel)
-        sub = channel_to_subscription(channel)
-        route_name = f'{uuid.uuid1()}-{uuid.uuid4()}'
+    def add_subscription(self, channel, handler, raw=False, executor=None,
+                         balanced=False, executor_options=None):
+        return self.add_subscriptions([(channel, handler)], raw=raw,
+                                      executor=executor, balanced=balanced,
+                                      executor_options=executor_options)
+
+    def add_subscriptions(self, subscriptions, qos=0, timeout=DEFAULT_TIMEOUT,
+                          raw=False, executor=None, balanced=False,
+                          executor_options=None):
+        """
+        Subscribe to several channels using a single SUBSCRIBE packet
+        subscriptions: list of (channel, handler) pairs
+        raw: pass handlers the undecoded codecs.Message instead of the payload
+        executor: 'inline' (default), 'thread', 'process' or a
+                  HandlerExecutor to run the handlers in ('thread' and
+                  'process' use one pool per client and options, see
+                  executor()); 'process' handlers must be picklable
+        executor_options: max_workers, max_queue and overflow of that pool
+        balanced: in a worker group, deliver each message to one worker
+        """
+        balanced = balanced and self.workers is not None
         future = asyncio.Future(loop=self.loop)
 
         try:
             if self.client._state != mqtt_cs_connected:
                 if (future.done() == False):
                     future.set_exception(Exception(
-                        f'Failed to add subscription. '+
-                        +'Client is not connected {self.name}, {self.channel}'
+                        f'Failed to add subscription. '
+                        f'Client is not connected {self.name}, '
+                        f'{[channel for channel, handler in subscriptions]}'
                         ))
                 return future
 
-            def add_sub(*args, **kwargs):
-                self.client.on_unsubscribe = _.noop
-                def on_sub(client, userdata, mid, granted_qos):
-                    self.client.on_subscribe = _.noop
-                    if (future.done() == False):
-                        future.set_result('done')
-                self.client.on_subscribe = self.safe(on_sub)
-                self.client.subscribe(sub)
-
-            if sub in self.subscriptions:
-                self.client.on_unsubscribe = self.safe(add_sub)
-                self.client.unsubscribe(sub)
+            filters = {}
+            for channel, handler in subscriptions:
+                path = channel_to_route_path(channel)
+                sub = channel_to_subscription(channel)
+                handler = self.wrap_handler(handler, raw, executor, channel,
+                                            executor_options)
+                if balanced:
+                    self.workers.balanced.add(sub)
+                    sub = self.workers.subscription(sub)
+                    handler = self.workers.wrap(handler)
+                # Subscribing to an existing filter again replaces it (and
+                # re-sends its retained messages), so no unsubscribe is needed
+                self.subscriptions[sub] = None
+                # Re-adding a channel replaces its previous handler
+                self.router.remove_route(path)
+                self.router.add_route(path, handler)
+                filters[sub] = None
+
+            if self._sub_batch is not None:
+                self._sub_batch.append((filters, future))
             else:
-                self.subscriptions.append(sub)
-                self.router.add_route(path, self.wrap(handler))
-                add_sub()
+                self._subscribe(list(filters), [future], qos, timeout)
 
         except Exception as e:
             if (future.done() == False):
@@ -225,74 +578,232 @@ class MicropedeClient(Topics):
 
         return future
 
-    def remove_subscription(self, channel):
-        sub = channel_to_subscription(channel)
-        future = asyncio.Future(loop=self.loop)
+    @contextlib.contextmanager
+    def batch_subscriptions(self, qos=0, timeout=DEFAULT_TIMEOUT):
+        """
+        Send every subscription added inside the with block as one SUBSCRIBE
+        (nested blocks are part of the outermost one)
+        """
+        if self._sub_batch is not None:
+            yield self._sub_batch
+            return
+        self._sub_batch = batch = []
+        try:
+            yield batch
+        finally:
+            self._sub_batch = None
+            filters = {}
+            for subs, future in batch:
+                filters.update(subs)
+            if filters:
+                self._subscribe(list(filters), [f for subs, f in batch], qos,
+                                timeout)
+
+    def _subscribe(self, filters, futures, qos=0, timeout=DEFAULT_TIMEOUT):
+        if not in_loop(self.loop):
+            # Register the mid on the loop, before its ack can be handled
+            self.loop.call_soon_threadsafe(
+                self._subscribe, filters, futures, qos, timeout)
+            return
+
+        (rc, mid) = self.client.subscribe([(sub, qos) for sub in filters])
+        self._subacks[mid] = (filters, futures)
+        for future in futures:
+            self._ack_timeout(mid, future, timeout)
+
+    def _ack_timeout(self, mid, future, timeout):
+        def on_timeout():
+            self._subacks.pop(mid, None)
+            if self.metrics is not None:
+                self.metrics.count('subscribe_timeouts')
+            if (future.done() == False):
+                future.set_exception(Exception(f'timeout {timeout}ms'))
+        self.set_timeout(on_timeout, timeout, future)
+
+    def _on_subscribe(self, client, userdata, mid, granted_qos):
+        (filters, futures) = self._subacks.pop(mid, (None, []))
+        # 0x80 in a SUBACK means the broker refused that filter
+        failed = [sub for sub, q in zip(filters or [], granted_qos) if q == 0x80]
+        for future in futures:
+            if future.done():
+                continue
+            if failed:
+                future.set_exception(Exception(f'subscription refused {failed}'))
+            else:
+                future.set_result('done')
 
-        def on_unsub(client, userdata, mid):
-            self.client.on_unsubscribe = _.noop
-            _.pull(self.subscriptions, sub)
+    def _on_unsubscribe(self, client, userdata, mid):
+        (subs, futures) = self._subacks.pop(mid, (None, []))
+        for future in futures:
             if (future.done() == False):
                 future.set_result('done')
 
-        self.client.unsubscribe(sub)
+    def remove_subscription(self, channel, timeout=DEFAULT_TIMEOUT):
+        sub = channel_to_subscription(channel)
+        future = asyncio.Future(loop=self.loop)
+        self.router.remove_route(channel_to_route_path(channel))
+
+        # Other channels may still be routed through the same filter
+        if self.router.has_filter(sub):
+            future.set_result('done')
+            return future
+        if self.workers is not None and sub in self.workers.balanced:
+            self.workers.balanced.discard(sub)
+            sub = self.workers.subscription(sub)
+
+        self.subscriptions.pop(sub, None)
+
+        def unsubscribe():
+            (rc, mid) = self.client.unsubscribe(sub)
+            self._subacks[mid] = ([sub], [future])
+            self._ack_timeout(mid, future, timeout)
+
+        if in_loop(self.loop):
+            unsubscribe()
+        else:
+            self.loop.call_soon_threadsafe(unsubscribe)
         return future
 
+    def _default_subscriptions(self):
+        trigger = self._trigger_prefix
+        return [
+            (f'{trigger}ping', self.ping),
+            (f'{trigger}update-version', self.update_version),
+            (f'{trigger}get-schema', self.get_schema),
+            (f'{trigger}get-subscriptions', self._get_subscriptions),
+            (f'{trigger}get-metrics', self._get_metrics),
+            (f'{trigger}resync-state', self._resync_state),
+            (f'{trigger}exit', self.exit),
+        ]
+
+    def _apply_put_batch(self, payload, params):
+        return PutBatch(self, payload).apply()
+
     def _get_subscriptions(self, payload, name):
         LABEL = f'{self.app_name}::get_subscriptions'
-        return self.notify_sender(payload, self.subscriptions, 'get-subscriptions')
+        return self.notify_sender(payload, list(self.subscriptions),
+                                  'get-subscriptions')
+
+    def get_metrics(self):
+        """ Snapshot of the client's metrics (see metrics.MetricsRegistry) """
+        metrics = self.metrics.snapshot() if self.metrics is not None else {}
+        metrics.update(
+            inflight=len(self._reserved),
+            backlog=len(self._backlog),
+            offline_queue=len(self.outbox) if self.outbox is not None else None,
+            coalesced=dict(self.coalescer.counters),
+            reconnect=self.reconnect_stats,
+            workers=self.workers.info() if self.workers is not None else None,
+            scheduler=(self.scheduler.info() if self.scheduler is not None
+                       else None))
+        return metrics
+
+    def _get_metrics(self, payload, name):
+        return self.notify_sender(payload, self.get_metrics(), 'get-metrics')
 
     def notify_sender(self, payload, response, endpoint, status='success'):
         if (status != 'success'):
             response = _.flatten_deep(response)
+        if self._put_batches:
+            batch = self._put_batches.get(get_head(payload, 'batch_id'))
+            if batch is not None:
+                # Part of a put batch, replied to as a whole
+                return batch.notify(payload, response, status)
         receiver = get_receiver(payload)
+        head = dict(self._head)
+        msg = {'status': status, 'response': response, '__head__': head}
+
+        # Echo the correlation id so multiplexed callers can match replies
+        request_id = get_head(payload, 'request_id')
+        if request_id is not None:
+            head['request_id'] = request_id
 
-        self.send_message(
-            f'{self.app_name}/{self.name}/notify/{receiver}/{endpoint}',
-            wrap_data(None, {'status': status, 'response': response},
-                      self.name, self.version)
-        )
+        # Reply using the requester's codec when we support it
+        content_type = get_head(payload, 'content_type')
+        if content_type not in codecs.available_codecs():
+            content_type = None
+
+        self.send_message(f'{self._notify_prefix}{receiver}/{endpoint}', msg,
+                          content_type=content_type)
 
         return response
 
     def connect_client(self, client_id, host, port, timeout=DEFAULT_TIMEOUT):
-        self.client = mqtt.Client(client_id)
+        # paho needs a few workarounds in _publish
+        self._paho = False
+        if self.transport == 'asyncio':
+            # Callbacks already run on the client loop
+            self.client = AsyncioClient(client_id, self.loop)
+            self._callback = identity
+        elif callable(self.transport):
+            self.client = self.transport(client_id, self.loop)
+            self._callback = identity
+        else:
+            self.client = mqtt.Client(client_id)
+            self._callback = self.safe
+            self._paho = True
+        if self.workers is not None and hasattr(self.client, 'will_set'):
+            self.client.will_set(*self.workers.will())
+        if hasattr(self.client, 'reconnect_delay_set'):
+            self.client.reconnect_delay_set(self.min_reconnect_delay,
+                                            self.max_reconnect_delay)
         future = asyncio.Future(loop=self.loop)
 
         def on_connect(client, userdata, flags, rc):
+            self.connected = (rc == 0)
             if future.done():
+                # Reconnected, routes are still in place
+                if self.connected:
+                    self._on_reconnect()
                 return
+            if self.connected:
+                self._replay_outbox()
 
-            self.subscriptions = []
+            self.subscriptions = {}
 
             if self.is_plugin:
-                def on_done_1(d):
-                    def on_done_2(d):
-                        if future.done():
-                            return
+                def on_subscribed(d):
+                    if future.done():
+                        return
+                    if d.exception() is not None:
+                        future.set_exception(d.exception())
+                        return
+                    self._disconnect_callback = self.exit
+                    future.set_result('done')
+
+                def subscribe(*args):
+                    # Default and listen() subscriptions share one SUBSCRIBE
+                    with self.batch_subscriptions():
+                        f = self.add_subscriptions(self._default_subscriptions())
+                        self.add_subscription(f'{self._put_prefix}{BATCH}',
+                                              self._apply_put_batch,
+                                              balanced=True)
                         self.listen()
                         self.default_sub_count = len(self.subscriptions)
-                        self.client.on_disconnect = self.safe(self.exit)
-                        future.set_result('done')
-
-                    f2 = self.on_trigger_msg("exit", self.safe(self.exit))
-                    f2.add_done_callback(self.safe(on_done_2))
-
-                # TODO: Run futures sequentially
-                self.on_trigger_msg("ping", self.safe(self.ping))
-                self.on_trigger_msg("update-version", self.safe(self.update_version))
-                f = self.on_trigger_msg("get-schema", self.safe(self.get_schema))
-                self.wait_for(self.set_state('schema', self.schema))
-                f1 = self.on_trigger_msg("get-subscriptions", self.safe(self._get_subscriptions))
-                f1.add_done_callback(self.safe(on_done_1))
+                    f.add_done_callback(on_subscribed)
+                    self.wait_for(self.set_state('schema', self.schema))
+
+                if self.workers is not None:
+                    # Balanced subscriptions depend on the group's mode
+                    self.workers.join().add_done_callback(subscribe)
+                else:
+                    subscribe()
             else:
                 self.listen()
                 self.default_sub_count = 0
                 if (future.done() == False):
                     future.set_result('done')
 
-        self.client.on_connect = self.safe(on_connect)
-        self.client.on_message = self.safe(self.on_message)
+        self.client.on_connect = self._callback(on_connect)
+        self.client.on_disconnect = self._callback(self._on_disconnect)
+        if self.scheduler is not None:
+            # Queued from the transport's thread, dispatched on the loop
+            self.client.on_message = self.scheduler.receive
+        else:
+            self.client.on_message = self._callback(self.on_message)
+        self.client.on_publish = self._callback(self._on_publish)
+        self.client.on_subscribe = self._callback(self._on_subscribe)
+        self.client.on_unsubscribe = self._callback(self._on_unsubscribe)
         self.client.connect(host=self.host, port=self.port)
 
         self.client.loop_start()
@@ -301,13 +812,14 @@ class MicropedeClient(Topics):
             if (future.done() == False):
                 future.set_exception(Exception(f'timeout {timeout}ms'))
 
-        set_timeout(self.safe(on_timeout), timeout)
+        self.set_timeout(on_timeout, timeout, future)
         return future
 
     def disconnect_client(self, timeout=DEFAULT_TIMEOUT):
         future = asyncio.Future(loop=self.loop)
-        self.subscriptions = []
-        self.router = PathRouter()
+        self.subscriptions = {}
+        self.router = TopicRouter()
+        self._shutdown_executors()
 
         def off():
             if hasattr(self, '_on_off_events'):
@@ -330,54 +842,238 @@ class MicropedeClient(Topics):
                 future.set_result('done')
 
             if hasattr(self, 'client'):
-                self.client.on_disconnect = self.safe(on_disconnect)
-                self.client.disconnect()
-                set_timeout(self.safe(on_disconnect), timeout)
+                self._disconnect_callback = on_disconnect
+                left = self.workers.leave() if self.workers else None
+                if left is not None:
+                    # The will only removes workers on a lost connection
+                    client = self.client
+                    left.add_done_callback(lambda f: client.disconnect())
+                else:
+                    self.client.disconnect()
+                self.set_timeout(on_disconnect, timeout, future)
             else:
                 if (future.done() == False):
                     future.set_result('done')
 
         return future
 
-    def on_message(self, client, userdata, msg):
-        try:
-            payload = json.loads(msg.payload)
-        except ValueError:
-            print("Message contains invalid json")
-            print(f'topic: {msg.topic}')
-            payload = None
+    def _on_disconnect(self, client, userdata, rc):
+        self.connected = False
+        if rc != 0 and self.reconnect:
+            # The transport retries the connection, see _on_reconnect
+            if self._disconnected_at is None:
+                self._disconnected_at = self.loop.time()
+                self._reconnect_stats['disconnects'] += 1
+            return
+        if rc != 0:
+            # Stop the transport from reconnecting
+            self.client.disconnect()
+        if self._disconnect_callback is not None:
+            self._disconnect_callback(client, userdata, rc)
+
+    def _on_reconnect(self):
+        started = self._disconnected_at or self.loop.time()
+        self._disconnected_at = None
+        latency = (self.loop.time() - started) * 1000
+        self._reconnect_stats['reconnects'] += 1
+        self._reconnect_latencies.append(latency)
+
+        # Restore every filter with one SUBSCRIBE (clean sessions drop them)
+        if self.subscriptions:
+            f = asyncio.Future(loop=self.loop)
+            self._subscribe(list(self.subscriptions), [f])
+
+            def on_subscribed(f):
+                if f.exception() is None:
+                    self._reconnect_stats['resubscribed'] += 1
+                    self._resubscribe_latency = (
+                        (self.loop.time() - started) * 1000)
+                else:
+                    self._reconnect_stats['resubscribe_failed'] += 1
+            f.add_done_callback(on_subscribed)
+
+        if self.workers is not None:
+            # Our will cleared the presence topic
+            self.workers.announce()
+        self._replay_outbox()
+
+    @property
+    def reconnect_stats(self):
+        """
+        Counts of disconnects and reconnects with reconnect latencies (ms,
+        from losing the connection to CONNACK and to the resubscribe ack)
+        """
+        latencies = list(self._reconnect_latencies)
+        stats = {key: self._reconnect_stats[key] for key in
+                 ('disconnects', 'reconnects', 'resubscribed',
+                  'resubscribe_failed')}
+        stats.update(
+            connected=self.connected,
+            last_latency=latencies[-1] if latencies else None,
+            max_latency=max(latencies) if latencies else None,
+            mean_latency=(sum(latencies) / len(latencies)
+                          if latencies else None),
+            resubscribe_latency=self._resubscribe_latency)
+        return stats
+
+    def _replay_outbox(self):
+        """ Publish everything queued while disconnected, in order """
+        if self.outbox is None or not len(self.outbox):
+            return
+        for (topic, payload, qos, retain, futures) in self.outbox.drain():
+            future = asyncio.Future(loop=self.loop)
+            future.add_done_callback(functools.partial(chain_futures, futures))
+            self._send_encoded(topic, payload, qos, retain, future)
 
+    def on_message(self, client, userdata, msg):
         topic = msg.topic
-        if (topic is None or topic is ''):
+        if (topic is None or topic == ''):
             return
 
-        method, args = self.router.match(topic)
-        if method:
-            method(payload, args)
+        for recorder in self.recorders:
+            recorder.record(topic, msg.payload, msg.qos, msg.retain)
 
-    def send_message(self, topic, msg={}, retain=False, qos=0, dup=False, timeout=DEFAULT_TIMEOUT):
+        # Only decode payloads that some handler is going to receive
+        if self.metrics is not None:
+            start = time.perf_counter()
+            matches = self.router.match(topic)
+            self.metrics.observe_since('route_match', start)
+            if not matches:
+                self.metrics.count('unmatched')
+                return
+        else:
+            matches = self.router.match(topic)
+            if not matches:
+                return
+
+        message = codecs.Message(topic, msg.payload, msg.qos, msg.retain)
+        self.last_message = message
+        # Results let the scheduler track handlers still running
+        return [method(message, args) for method, args in matches]
+
+    def send_message(self, topic, msg={}, retain=False, qos=0, dup=False,
+                     timeout=DEFAULT_TIMEOUT, content_type=None):
         future = asyncio.Future(loop=self.loop)
-        if (_.is_dict(msg) and _.get(msg, '__head__') is None):
-            head = wrap_data(None, None, self.name, self.version)['__head__']
-            _.set_(msg, '__head__', head)
-        message = json.dumps(msg)
-
-        _mid = None
-        def on_publish(client, userdata, mid):
-            if (mid == _mid):
-                if (future.done() == False):
-                    future.set_result('done')
+        content_type = content_type or self.content_type
+        if isinstance(msg, dict):
+            if msg.get('__head__') is None:
+                msg['__head__'] = dict(self._head)
+            if content_type != codecs.JSON:
+                set_head(msg, 'content_type', content_type)
+        message = codecs.encode(msg, content_type)
+
+        if self.outbox is not None and not self.connected:
+            if in_loop(self.loop):
+                self._enqueue(topic, message, qos, retain, future, timeout)
+            else:
+                self.loop.call_soon_threadsafe(
+                    self._enqueue, topic, message, qos, retain, future, timeout)
+            return future
+
+        return self._send_encoded(topic, message, qos, retain, future, timeout)
 
+    def _enqueue(self, topic, message, qos, retain, future, timeout):
+        if self.connected:
+            # Reconnected in the meantime
+            self._send_encoded(topic, message, qos, retain, future, timeout)
+        else:
+            # Timeout starts once the message is replayed
+            self.outbox.append(topic, message, qos, retain, future)
+
+    def _send_encoded(self, topic, message, qos, retain, future,
+                      timeout=DEFAULT_TIMEOUT):
         def on_timeout():
+            if self.metrics is not None:
+                self.metrics.count('publish_timeouts')
             if (future.done() == False):
                 future.set_exception(Exception(f'timeout {timeout}ms'))
 
-        self.client.on_publish = self.safe(on_publish)
-        (qos, _mid) = self.client.publish(topic, payload=message, qos=qos, retain=retain)
-        set_timeout(self.safe(on_timeout), timeout)
+        # Apply backpressure once the in-flight window is full. The slot is
+        # taken here, on the caller's thread: sends from other threads
+        # would overshoot the window if it was only taken in _publish.
+        with self._inflight_lock:
+            queued = (len(self._reserved) >= self.max_inflight or
+                      bool(self._backlog))
+            full = queued and len(self._backlog) >= self.max_backlog
+            if not queued:
+                self._reserved.add(future)
+            elif not full:
+                self._backlog.append((topic, message, qos, retain, future))
+
+        if full:
+            if self.metrics is not None:
+                self.metrics.count('publish_rejected')
+            error = Exception(f'backlog full ({self.max_backlog} messages)')
+            if in_loop(self.loop):
+                future.set_exception(error)
+            else:
+                self.loop.call_soon_threadsafe(future.set_exception, error)
+            return future
+
+        self.set_timeout(on_timeout, timeout, future)
+        if queued:
+            return future
 
+        future.add_done_callback(self._release_slot)
+        if in_loop(self.loop):
+            self._publish(topic, message, qos, retain, future)
+        else:
+            # Register the mid on the loop, before its ack can be handled
+            self.loop.call_soon_threadsafe(
+                self._publish, topic, message, qos, retain, future)
         return future
 
+    def _publish(self, topic, payload, qos, retain, future):
+        if isinstance(payload, memoryview) and self._paho:
+            # paho only accepts bytes (AsyncioClient writes the view as is)
+            payload = payload.tobytes()
+        (rc, mid) = self.client.publish(topic, payload=payload, qos=qos,
+                                        retain=retain)
+        if (rc == err_no_conn and self.outbox is not None and
+                (qos == 0 or not self._paho)):
+            # Connection dropped before we noticed (paho itself keeps
+            # QoS > 0 messages for its reconnect)
+            self.outbox.append(topic, payload, qos, retain, future)
+            # Not from here: _drain_backlog would recurse for every message
+            self.loop.call_soon(self._release_slot, future)
+            return
+        with self._inflight_lock:
+            self._inflight[mid] = future
+        future.add_done_callback(functools.partial(self._release_mid, mid))
+        if self.metrics is not None:
+            self.metrics.count('published')
+            future.add_done_callback(functools.partial(
+                self.metrics.observe_since, 'publish_ack', time.perf_counter()))
+
+    def _on_publish(self, client, userdata, mid):
+        future = self._inflight.get(mid)
+        if future is not None and future.done() == False:
+            future.set_result('done')
+
+    def _release_mid(self, mid, future):
+        with self._inflight_lock:
+            if self._inflight.get(mid) is future:
+                del self._inflight[mid]
+
+    def _release_slot(self, future):
+        with self._inflight_lock:
+            self._reserved.discard(future)
+        self._drain_backlog()
+
+    def _drain_backlog(self):
+        while True:
+            with self._inflight_lock:
+                if (not self._backlog or
+                        len(self._reserved) >= self.max_inflight):
+                    return
+                (topic, payload, qos, retain, future) = self._backlog.popleft()
+                if future.done():
+                    # Timed out while waiting for a free slot
+                    continue
+                self._reserved.add(future)
+            future.add_done_callback(self._release_slot)
+            self._publish(topic, payload, qos, retain, future)
+
     async def dangerously_set_state(self, key, value, plugin):
         """
         Dangerously set the state of another plugin (skip validation)
@@ -386,12 +1082,83 @@ class MicropedeClient(Topics):
         plugin: str
         """
         plugin = plugin or self.name
+        if (plugin == self.name and key == 'schema'):
+            self.invalidate_schema()
         topic = f'{self.app_name}/{plugin}/state/{key}'
         await self.send_message(topic, value, True, 0, False)
 
     async def set_state(self, key, value):
-        topic = f'{self.app_name}/{self.name}/state/{key}';
-        await self.send_message(topic, value, True, 0, False)
+        if self._state_hold is not None:
+            # Published once per key when the put batch is applied
+            self._state_hold.hold(key, value)
+            return
+        await self._set_state(key, value)
+
+    async def _set_state(self, key, value):
+        if key == 'schema':
+            self.invalidate_schema()
+        topic = f'{self._state_prefix}{key}'
+        if self.deltas.is_configured(topic):
+            await self.deltas.publish(topic, value)
+        elif self.coalescer.is_configured(topic):
+            await self.coalescer.publish(topic, value, True, 0, False)
+        else:
+            await self.send_message(topic, value, True, 0, False)
+
+    def configure_state(self, key, max_rate=None, debounce=None, merge=False):
+        """
+        Coalesce set_state calls for key: only the newest value is published
+        per flush, limited to max_rate (Hz) and / or debounced (ms)
+        """
+        topic = f'{self._state_prefix}{key}'
+        self.coalescer.configure(topic, max_rate, debounce, merge)
+
+    def configure_state_deltas(self, key, snapshot_every=DEFAULT_SNAPSHOT_EVERY):
+        """
+        Publish changes of key as JSON Patch deltas on .../state/{key}/delta
+        with a full snapshot every snapshot_every changes (see
+        delta.DeltaPublisher). Subscribe with on_state_msg(..., delta=True).
+        """
+        topic = f'{self._state_prefix}{key}'
+        self.deltas.configure(topic, snapshot_every)
+
+    def _resync_state(self, payload, params):
+        key = payload.get('key') if isinstance(payload, dict) else None
+        topic = f'{self._state_prefix}{key}'
+        if self.deltas.is_configured(topic):
+            self.deltas.snapshot(topic)
+
+    async def send_stream(self, topic, data, chunk_size=DEFAULT_CHUNK_SIZE,
+                          window=DEFAULT_WINDOW, flow_control=BROKER, qos=1,
+                          name=None, meta=None, timeout=DEFAULT_STREAM_TIMEOUT):
+        """
+        Send data (bytes-like, mmap, file path or file object) as a stream
+        of binary chunks on {topic}/__stream__/... (see stream.StreamSender).
+        Chunks are memoryview slices of data, returns the stream id.
+        """
+        sender = StreamSender(self, topic, data, chunk_size, window,
+                              flow_control, qos, name, meta, timeout)
+        return await sender.send()
+
+    def stream_receiver(self, topic, timeout=DEFAULT_STREAM_TIMEOUT):
+        """ Async iterator over the streams sent to topic """
+        return StreamReceiver(self, topic, timeout)
+
+    def recorder(self, path, channel=None):
+        """
+        Recorder writing the messages this client receives (or, with a
+        channel such as f'{app_name}/#', the messages of that channel) to
+        the log at path; call start() and stop() on it
+        """
+        return Recorder(self, path, channel)
+
+    async def replay(self, path, speed=1, deliver=False, start=None, end=None):
+        """
+        Publish the messages recorded in path again, with their recorded
+        timing (speed=1), N times faster or as fast as possible (None);
+        see recorder.Replayer. Returns message counts and rate.
+        """
+        return await Replayer(self, path, speed, deliver).replay(start, end)
 
     def update_version(self, payload, params):
         try:
@@ -0,0 +1,123 @@
+"""Last-value-wins, rate limited and debounced publishing"""
+
+import asyncio
+import collections
+
+from .timers import in_loop
+
+
+class Pending(object):
+    __slots__ = ('msg', 'retain', 'qos', 'dup', 'futures', 'timer')
+
+    def __init__(self, msg, retain, qos, dup):
+        self.msg = msg
+        self.retain = retain
+        self.qos = qos
+        self.dup = dup
+        self.futures = []
+        self.timer = None
+
+
+class PublishCoalescer(object):
+    """
+       Holds back publishes on configured topics so that only the newest
+       value per topic is sent when the topic is flushed.
+
+       A topic is flushed on the next loop iteration, or when its options
+       allow it:
+         max_rate: at most this many publishes per second (Hz)
+         debounce: only after no new value arrived for this long (ms)
+         merge: shallow-merge dict values instead of replacing them
+
+       counters / topic_counters record how many messages were published,
+       dropped (replaced by a newer value) or merged.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.options = {}
+        self.pending = {}
+        self.last_sent = {}
+        self.counters = collections.Counter()
+        self.topic_counters = collections.defaultdict(collections.Counter)
+
+    def configure(self, topic, max_rate=None, debounce=None, merge=False):
+        self.options[topic] = (max_rate, debounce, merge)
+
+    def is_configured(self, topic):
+        return topic in self.options
+
+    def publish(self, topic, msg, retain=False, qos=0, dup=False):
+        """
+        Queue msg for topic. The returned future resolves when the value
+        (or the newer value that replaced it) has been published.
+        """
+        future = asyncio.Future(loop=self.client.loop)
+        if in_loop(self.client.loop):
+            self._publish(topic, msg, retain, qos, dup, future)
+        else:
+            self.client.loop.call_soon_threadsafe(
+                self._publish, topic, msg, retain, qos, dup, future)
+        return future
+
+    def _publish(self, topic, msg, retain, qos, dup, future):
+        (max_rate, debounce, merge) = self.options.get(topic, (None, None, False))
+        entry = self.pending.get(topic)
+
+        if entry is None:
+            entry = self.pending[topic] = Pending(msg, retain, qos, dup)
+        elif merge and isinstance(entry.msg, dict) and isinstance(msg, dict):
+            entry.msg = {**entry.msg, **msg}
+            self._count(topic, 'merged')
+        else:
+            entry.msg = msg
+            self._count(topic, 'dropped')
+        (entry.retain, entry.qos, entry.dup) = (retain, qos, dup)
+        entry.futures.append(future)
+
+        if entry.timer is not None:
+            if debounce is None:
+                return
+            # New value restarts the quiet period
+            entry.timer.cancel()
+
+        now = self.client.loop.time()
+        delay = (debounce or 0) / 1000.0
+        if max_rate:
+            next_slot = self.last_sent.get(topic, 0) + 1.0 / max_rate
+            delay = max(delay, next_slot - now)
+
+        if delay <= 0:
+            entry.timer = self.client.loop.call_soon(self.flush, topic)
+        else:
+            entry.timer = self.client.set_timeout(
+                lambda: self.flush(topic), delay * 1000)
+
+    def flush(self, topic):
+        entry = self.pending.pop(topic, None)
+        if entry is None:
+            return
+        entry.timer.cancel()
+        self.last_sent[topic] = self.client.loop.time()
+        self._count(topic, 'published')
+
+        f = self.client.send_message(topic, entry.msg, entry.retain,
+                                     entry.qos, entry.dup)
+
+        def on_done(f):
+            for future in entry.futures:
+                if future.done():
+                    continue
+                if f.exception() is not None:
+                    future.set_exception(f.exception())
+                else:
+                    future.set_result(f.result())
+        f.add_done_callback(on_done)
+
+    def flush_all(self):
+        for topic in list(self.pending):
+            self.flush(topic)
+
+    def _count(self, topic, key):
+        self.counters[key] += 1
+        self.topic_counters[topic][key] += 1
@@ -0,0 +1,129 @@
+"""Payload codecs for micropede messages"""
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+
+
+class Codec(object):
+    """ Converts payloads to and from bytes for a given content type """
+
+    def __init__(self, content_type, dumps, loads, leading_bytes=None):
+        self.content_type = content_type
+        self.dumps = dumps
+        self.loads = loads
+        # First bytes an encoded dict / list can start with (for sniffing)
+        self.leading_bytes = frozenset(leading_bytes or [])
+
+
+_codecs = {}
+
+
+def register_codec(codec):
+    _codecs[codec.content_type] = codec
+    return codec
+
+
+def get_codec(content_type=None):
+    """ Return the codec for content_type (JSON if None or unknown) """
+    return _codecs.get(content_type) or _codecs[JSON]
+
+
+def available_codecs():
+    return list(_codecs)
+
+
+def detect_codec(raw):
+    """ Guess the codec of an encoded payload from its first byte """
+    if len(raw) > 0:
+        first = raw[0]
+        for codec in _codecs.values():
+            if first in codec.leading_bytes:
+                return codec
+    return _codecs[JSON]
+
+
+def encode(value, content_type=None):
+    """
+    Encode a payload. Only dicts and lists use binary codecs, other values
+    are always sent as JSON so every subscriber can read them.
+    """
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return value
+    if not isinstance(value, (dict, list)):
+        content_type = JSON
+    return get_codec(content_type).dumps(value)
+
+
+def decode(raw):
+    return detect_codec(raw).loads(raw)
+
+
+def _json_dumps(value):
+    if orjson is not None:
+        try:
+            return orjson.dumps(value)
+        except TypeError:
+            # e.g. non string dict keys
+            pass
+    return json.dumps(value)
+
+
+def _json_loads(raw):
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(bytes(raw))
+
+
+register_codec(Codec(JSON, _json_dumps, _json_loads))
+
+if msgpack is not None:
+    register_codec(Codec(
+        MSGPACK,
+        lambda value: msgpack.packb(value, use_bin_type=True),
+        lambda raw: msgpack.unpackb(raw, raw=False),
+        # fixmap, fixarray, array 16/32 and map 16/32 markers
+        list(range(0x80, 0xa0)) + [0xdc, 0xdd, 0xde, 0xdf]))
+
+
+class Message(object):
+    """
+       An incoming message. The payload is decoded on first access, so
+       messages nobody reads are never parsed; raw is a zero-copy
+       memoryview of the received bytes.
+    """
+    __slots__ = ('topic', 'raw', 'qos', 'retain', '_payload', '_decoded')
+
+    def __init__(self, topic, raw, qos=0, retain=False):
+        self.topic = topic
+        self.raw = memoryview(raw)
+        self.qos = qos
+        self.retain = retain
+        self._payload = None
+        self._decoded = False
+
+    @property
+    def payload(self):
+        if not self._decoded:
+            self._decoded = True
+            try:
+                self._payload = decode(self.raw)
+            except ValueError:
+                print("Message contains invalid json")
+                print(f'topic: {self.topic}')
+        return self._payload
+
+    @property
+    def content_type(self):
+        return detect_codec(self.raw).content_type
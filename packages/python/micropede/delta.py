@@ -0,0 +1,170 @@
+"""Publish and rebuild large state values as JSON Patch deltas"""
+
+import copy
+import uuid
+
+from .jsonpatch import apply_patch, make_patch
+
+DEFAULT_SNAPSHOT_EVERY = 50
+DELTA_SUFFIX = '/delta'
+RESYNC_TIMEOUT = 5000
+
+
+def delta_topic(topic):
+    return topic + DELTA_SUFFIX
+
+
+class DeltaPublisher(object):
+    """
+       Publishes configured state topics as deltas: a change is sent as an
+       RFC 6902 patch {epoch, seq, patch} (retained) on {topic}/delta, and
+       every snapshot_every changes the full value is published on the
+       state topic itself with __head__.delta = {epoch, seq}.
+
+       Subscribers that do not understand deltas still read the state
+       topic, but only see the value of the latest snapshot. Only dict
+       values are sent as deltas, anything else is always a snapshot.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.epoch = uuid.uuid4().hex[:8]
+        self.options = {}
+        self.values = {}
+        self.seqs = {}
+        self.since_snapshot = {}
+
+    def configure(self, topic, snapshot_every=DEFAULT_SNAPSHOT_EVERY):
+        self.options[topic] = snapshot_every
+
+    def is_configured(self, topic):
+        return topic in self.options
+
+    def publish(self, topic, value):
+        """ Publish value (a delta when possible), returns the send future """
+        previous = self.values.get(topic)
+        state = {k: v for k, v in value.items() if k != '__head__'} \
+            if isinstance(value, dict) else value
+        seq = self.seqs.get(topic, 0) + 1
+        self.seqs[topic] = seq
+
+        if (isinstance(previous, dict) and isinstance(state, dict) and
+                self.since_snapshot[topic] < self.options[topic]):
+            patch = make_patch(previous, state)
+            self.values[topic] = copy.deepcopy(state)
+            self.since_snapshot[topic] += 1
+            msg = {'epoch': self.epoch, 'seq': seq, 'patch': patch}
+            return self.client.send_message(delta_topic(topic), msg, True)
+
+        self.values[topic] = copy.deepcopy(state)
+        return self.snapshot(topic)
+
+    def snapshot(self, topic):
+        """ Publish the full value of topic (also answers resync requests) """
+        state = self.values.get(topic)
+        seq = self.seqs.get(topic, 0)
+        self.since_snapshot[topic] = 0
+        if not isinstance(state, dict):
+            return self.client.send_message(topic, state, True)
+        msg = dict(state)
+        head = {'delta': {'epoch': self.epoch, 'seq': seq}}
+        msg['__head__'] = head
+        return self.client.send_message(topic, msg, True)
+
+
+class DeltaReceiver(object):
+    """
+       Rebuilds state values published by a DeltaPublisher and calls
+       handler(value, params) with the full value after every change.
+
+       Deltas are applied in sequence order; when one is missing (or a
+       delta arrives before any snapshot) the publisher is asked to send a
+       new snapshot through its resync-state trigger. handler is called
+       with None when the state topic is cleared, and must not modify the
+       value it is given (later deltas are applied to it).
+    """
+
+    def __init__(self, client, handler):
+        self.client = client
+        self.handler = handler
+        self.states = {}
+        self.resyncing = set()
+
+    def channels(self, channel):
+        """ (channel, handler) pairs to subscribe for a state channel """
+        return [(channel, self.on_snapshot),
+                (delta_topic(channel), self.on_delta)]
+
+    def on_snapshot(self, message, params):
+        topic = message.topic
+        if len(message.raw) == 0:
+            # An empty retained message clears the topic
+            self.states.pop(topic, None)
+            self.handler(None, params)
+            return
+        value = message.payload
+        head = value.get('__head__') if isinstance(value, dict) else None
+        head = head.get('delta') if isinstance(head, dict) else None
+        current = self.states.get(topic)
+        if (head is not None and current is not None and
+                current['epoch'] == head['epoch'] and
+                current['seq'] >= head['seq']):
+            # Older than what the deltas already built
+            return
+        state = {'epoch': None, 'seq': 0, 'value': value, 'pending': {}}
+        if head is not None:
+            state.update(epoch=head['epoch'], seq=head['seq'])
+            if current is not None and current['epoch'] == head['epoch']:
+                state['pending'] = {seq: patch for seq, patch in
+                                    current['pending'].items()
+                                    if seq > head['seq']}
+        self.states[topic] = state
+        self.resyncing.discard(topic)
+        self._apply_pending(topic, state)
+        if self.states.get(topic) is state:
+            self.handler(state['value'], params)
+
+    def on_delta(self, message, params):
+        topic = message.topic[:-len(DELTA_SUFFIX)]
+        delta = message.payload
+        if not isinstance(delta, dict) or 'patch' not in delta:
+            return
+        state = self.states.get(topic)
+        if state is None or state['epoch'] != delta['epoch']:
+            # No snapshot yet, or the publisher restarted
+            self._resync(topic)
+            return
+        if delta['seq'] <= state['seq']:
+            return
+        state['pending'][delta['seq']] = delta['patch']
+        if self._apply_pending(topic, state):
+            self.handler(state['value'], params)
+        else:
+            self._resync(topic)
+
+    def _apply_pending(self, topic, state):
+        applied = False
+        while state['seq'] + 1 in state['pending']:
+            patch = state['pending'].pop(state['seq'] + 1)
+            try:
+                state['value'] = apply_patch(state['value'], patch,
+                                             in_place=True)
+            except (ValueError, KeyError, IndexError, TypeError):
+                # Value no longer matches the publisher's, wait for a snapshot
+                self.states.pop(topic, None)
+                self._resync(topic)
+                return False
+            state['seq'] += 1
+            applied = True
+        return applied
+
+    def _resync(self, topic):
+        if topic in self.resyncing:
+            return
+        self.resyncing.add(topic)
+        (app_name, sender, state, prop) = topic.split('/', 3)
+        self.client.send_message(f'{app_name}/trigger/{sender}/resync-state',
+                                 {'key': prop})
+        # Ask again on the next gap if the publisher does not answer
+        self.client.set_timeout(lambda: self.resyncing.discard(topic),
+                                RESYNC_TIMEOUT)
@@ -0,0 +1,124 @@
+"""Run subscription handlers in thread or process pools"""
+
+import asyncio
+import collections
+import concurrent.futures
+import pickle
+
+INLINE = 'inline'
+THREAD = 'thread'
+PROCESS = 'process'
+
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+BLOCK = 'block'
+
+
+class HandlerExecutor(object):
+    """
+       Runs handlers in a thread or process pool so slow handlers never
+       stall message dispatch on the client loop.
+
+       At most max_workers handlers run at once and at most max_queue
+       calls wait for a worker. When the queue is full, overflow decides
+       what happens to a new call:
+         drop-oldest: discard the oldest queued call (the new call if none
+                      is queued, with max_queue=0)
+         drop-newest: discard the new call
+         block: keep the call waiting and report backpressure through
+                on_backpressure(executor, blocked) (the asyncio transport
+                stops reading from the broker until the queue drains)
+
+       Process pools need picklable (module level) handlers and payloads;
+       check() rejects other handlers when they are subscribed. Handlers
+       returning a coroutine have it scheduled on the loop.
+    """
+
+    def __init__(self, kind=THREAD, max_workers=4, max_queue=100,
+                 overflow=DROP_OLDEST, pool=None):
+        if kind not in (THREAD, PROCESS):
+            raise ValueError(f'unknown executor kind {kind}')
+        if overflow not in (DROP_OLDEST, DROP_NEWEST, BLOCK):
+            raise ValueError(f'unknown overflow policy {overflow}')
+        if pool is None:
+            if kind == THREAD:
+                pool = concurrent.futures.ThreadPoolExecutor(max_workers)
+            else:
+                pool = concurrent.futures.ProcessPoolExecutor(max_workers)
+
+        self.kind = kind
+        self.pool = pool
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.on_backpressure = None
+        self.loop = None
+
+        self.running = 0
+        self.queue = collections.deque()
+        self.blocked = collections.deque()
+        self.counters = collections.Counter()
+
+    def submit(self, handler, *args):
+        """ Called on the client loop for every message """
+        if self.loop is None:
+            self.loop = asyncio.get_event_loop()
+        self.counters['submitted'] += 1
+
+        if self.running < self.max_workers:
+            self._start(handler, args)
+        elif len(self.queue) < self.max_queue:
+            self.queue.append((handler, args))
+        elif self.overflow == DROP_NEWEST or (
+                self.overflow == DROP_OLDEST and not self.queue):
+            self.counters['dropped'] += 1
+        elif self.overflow == DROP_OLDEST:
+            self.queue.popleft()
+            self.queue.append((handler, args))
+            self.counters['dropped'] += 1
+        else:
+            self.blocked.append((handler, args))
+            if len(self.blocked) == 1:
+                self._backpressure(True)
+
+    def check(self, handler):
+        """ Raise ValueError if handler cannot run in this executor """
+        if self.kind == PROCESS:
+            try:
+                pickle.dumps(handler)
+            except Exception as e:
+                raise ValueError(
+                    f'process executors need picklable (module level) '
+                    f'handlers, {handler!r} is not: {e}') from e
+
+    def _start(self, handler, args):
+        self.running += 1
+        f = self.loop.run_in_executor(self.pool, handler, *args)
+        f.add_done_callback(self._done)
+
+    def _done(self, f):
+        self.running -= 1
+        if f.exception() is not None:
+            self.counters['failed'] += 1
+            self.loop.call_exception_handler({
+                'message': 'Exception in subscription handler',
+                'exception': f.exception(),
+            })
+        else:
+            self.counters['completed'] += 1
+            if asyncio.iscoroutine(f.result()):
+                asyncio.ensure_future(f.result(), loop=self.loop)
+
+        if self.blocked:
+            self.queue.append(self.blocked.popleft())
+            if not self.blocked:
+                self._backpressure(False)
+        if self.queue and self.running < self.max_workers:
+            self._start(*self.queue.popleft())
+
+    def _backpressure(self, blocked):
+        if self.on_backpressure is not None:
+            self.on_backpressure(self, blocked)
+
+    def shutdown(self, wait=True):
+        self.pool.shutdown(wait=wait)
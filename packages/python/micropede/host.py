@@ -0,0 +1,274 @@
+"""Run many MicropedeClient plugins over a single MQTT connection"""
+
+from .client import (DEFAULT_PORT, generate_client_id, identity, safe,
+                     start_loop_thread)
+from .lazy import lazy_import
+from .router import TopicRouter
+from .timers import in_loop
+from .transport import (AsyncioClient, cs_connected, cs_new, err_conn_lost,
+                        err_no_conn, err_success)
+
+mqtt = lazy_import('paho.mqtt.client')
+_ = lazy_import('pydash')
+
+
+class HostedSession(object):
+    """
+       Paho compatible client handed to each hosted plugin. Operations are
+       forwarded to the host's shared connection; mids are local to the
+       session so each plugin keeps its own ack bookkeeping.
+    """
+
+    def __init__(self, host, client_id, loop):
+        self.host = host
+        self.client_id = client_id
+        self.loop = loop
+        (self.name, path, self.app_name, uid) = client_id.split('>>')
+
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_message = None
+        self.on_publish = None
+        self.on_subscribe = None
+        self.on_unsubscribe = None
+
+        self._state = cs_new
+        self._mid = 0
+        self.filters = set()
+
+    def _callback(self, name, *args):
+        callback = getattr(self, name)
+        if callback is not None:
+            callback(self, None, *args)
+
+    def _next_mid(self):
+        self._mid = self._mid % 65535 + 1
+        return self._mid
+
+    def connect(self, host=None, port=None, keepalive=None):
+        self.host.call(self.host.attach, self)
+        return err_success
+
+    def loop_start(self):
+        return err_success
+
+    def loop_stop(self, force=False):
+        return err_success
+
+    def is_connected(self):
+        return self._state == cs_connected
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        mid = self._next_mid()
+        if self._state != cs_connected:
+            return (err_no_conn, mid)
+        self.host.publish(self, mid, topic, payload, qos, retain)
+        return (err_success, mid)
+
+    def subscribe(self, topic, qos=0):
+        if isinstance(topic, str):
+            topics = [(topic, qos)]
+        elif isinstance(topic, tuple):
+            topics = [topic]
+        else:
+            topics = list(topic)
+        mid = self._next_mid()
+        if self._state != cs_connected:
+            return (err_no_conn, mid)
+        self.host.subscribe(self, mid, topics)
+        return (err_success, mid)
+
+    def unsubscribe(self, topic):
+        topics = [topic] if isinstance(topic, str) else list(topic)
+        mid = self._next_mid()
+        if self._state != cs_connected:
+            return (err_no_conn, mid)
+        self.host.unsubscribe(self, mid, topics)
+        return (err_success, mid)
+
+    def disconnect(self):
+        self.host.call(self.host.detach, self)
+        return err_success
+
+
+class PluginHost(object):
+    """
+       Multiplexes many plugins over one MQTT connection and one event loop.
+
+       Every topic filter is subscribed once on the shared connection and
+       incoming messages are fanned out to the plugins subscribed to it.
+       Since the broker only sees the host's connection, the host publishes
+       each plugin's {app}/{name}/signal/connected and .../disconnected
+       signals itself. That connection carries a single will, so when it
+       is lost no disconnected signal goes out for the plugins (only the
+       broker's signal for the host connection). The host publishes the
+       missed signals once it reconnects, before the plugins' connected
+       signals; if the host process dies they are never published.
+
+       Subscribing to a filter another plugin already uses re-sends the
+       SUBSCRIBE so the broker delivers its retained messages again; those
+       go to every plugin subscribed to the filter.
+
+           host = PluginHost('microdrop', port=1884)
+           plugin = host.add_plugin(MyPlugin, name='my-plugin')
+    """
+
+    def __init__(self, app_name, host='localhost', port=None, loop=None,
+                 name='plugin-host', transport='asyncio'):
+        self.app_name = app_name
+        self.host = host
+        self.port = port or DEFAULT_PORT
+        self.name = name
+        self.loop = loop or start_loop_thread()
+        self.plugins = []
+
+        self.sessions = []
+        # Sessions connected when the shared connection was lost
+        self.lost = []
+        self.router = TopicRouter()
+        self.filters = {}
+        self.acks = {}
+
+        client_id = generate_client_id(name, app_name)
+        if transport == 'asyncio':
+            self.connection = AsyncioClient(client_id, self.loop)
+            callback = identity
+            self._paho = False
+        else:
+            self.connection = mqtt.Client(client_id)
+            callback = safe(self.loop)
+            self._paho = True
+
+        self.connection.on_connect = callback(self._on_connect)
+        self.connection.on_disconnect = callback(self._on_disconnect)
+        self.connection.on_message = callback(self._on_message)
+        self.connection.on_publish = callback(self._on_ack)
+        self.connection.on_subscribe = callback(self._on_suback)
+        self.connection.on_unsubscribe = callback(self._on_ack)
+        self.connection.connect(host=self.host, port=self.port)
+        self.connection.loop_start()
+
+    @property
+    def connected(self):
+        return self.connection._state == cs_connected
+
+    def call(self, func, *args):
+        if in_loop(self.loop):
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def add_plugin(self, cls, *args, **kwargs):
+        """ Create a plugin (cls is a MicropedeClient subclass) on the host """
+        kwargs.update(host=self.host, port=self.port, loop=self.loop,
+                      transport=self.session)
+        plugin = cls(self.app_name, *args, **kwargs)
+        self.plugins.append(plugin)
+        return plugin
+
+    def remove_plugin(self, plugin):
+        _.pull(self.plugins, plugin)
+        return plugin.disconnect_client()
+
+    def session(self, client_id, loop):
+        return HostedSession(self, client_id, loop)
+
+    def signal(self, session, topic):
+        self.connection.publish(
+            f'{session.app_name}/{session.name}/signal/{topic}', '{}')
+
+    def attach(self, session):
+        if session not in self.sessions:
+            self.sessions.append(session)
+        if not self.connected:
+            # Completed once the shared connection is up
+            return
+        session._state = cs_connected
+        self.signal(session, 'connected')
+        session._callback('on_connect', {'session present': 0}, 0)
+
+    def detach(self, session):
+        if session in self.sessions:
+            self.sessions.remove(session)
+        unused = [sub for sub in session.filters if self._release(session, sub)]
+        if unused and self.connected:
+            self.connection.unsubscribe(unused)
+        session.filters.clear()
+        if session._state == cs_connected:
+            session._state = cs_new
+            self.signal(session, 'disconnected')
+        session._callback('on_disconnect', err_success)
+
+    def publish(self, session, mid, topic, payload, qos, retain):
+        if isinstance(payload, memoryview) and self._paho:
+            payload = payload.tobytes()
+        (rc, shared_mid) = self.connection.publish(topic, payload, qos, retain)
+        self.acks[shared_mid] = (session, mid, 'on_publish')
+
+    def subscribe(self, session, mid, topics):
+        for (sub, qos) in topics:
+            if sub not in session.filters:
+                session.filters.add(sub)
+                self.filters.setdefault(sub, set()).add(session)
+                self.router.add_route(sub, session)
+        (rc, shared_mid) = self.connection.subscribe(topics)
+        self.acks[shared_mid] = (session, mid, 'on_subscribe')
+
+    def unsubscribe(self, session, mid, topics):
+        unused = [sub for sub in topics if sub in session.filters and
+                  self._release(session, sub)]
+        session.filters.difference_update(topics)
+        if unused:
+            (rc, shared_mid) = self.connection.unsubscribe(unused)
+            self.acks[shared_mid] = (session, mid, 'on_unsubscribe')
+        else:
+            # Still used by other plugins, nothing to tell the broker
+            self.loop.call_soon(session._callback, 'on_unsubscribe', mid)
+
+    def _release(self, session, sub):
+        """ Drop session from sub, True if no session uses sub any more """
+        self.router.remove_route(sub, session)
+        sessions = self.filters.get(sub, set())
+        sessions.discard(session)
+        if not sessions:
+            self.filters.pop(sub, None)
+            return True
+        return False
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            return
+        # Signals the broker could not send for the plugins
+        for session in self.lost:
+            self.signal(session, 'disconnected')
+        self.lost = []
+        for session in list(self.sessions):
+            self.attach(session)
+
+    def _on_disconnect(self, client, userdata, rc):
+        self.acks.clear()
+        for session in list(self.sessions):
+            if session._state == cs_connected:
+                session._state = cs_new
+                self.lost.append(session)
+                session._callback('on_disconnect', rc or err_conn_lost)
+
+    def _on_message(self, client, userdata, msg):
+        delivered = set()
+        for (session, params) in self.router.match(msg.topic):
+            # Overlapping filters of one plugin still deliver once
+            if session not in delivered:
+                delivered.add(session)
+                session._callback('on_message', msg)
+
+    def _on_ack(self, client, userdata, mid):
+        ack = self.acks.pop(mid, None)
+        if ack is not None:
+            (session, local_mid, callback) = ack
+            session._callback(callback, local_mid)
+
+    def _on_suback(self, client, userdata, mid, granted_qos):
+        ack = self.acks.pop(mid, None)
+        if ack is not None:
+            (session, local_mid, callback) = ack
+            session._callback(callback, local_mid, granted_qos)
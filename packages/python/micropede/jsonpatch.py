@@ -0,0 +1,160 @@
+"""JSON Patch (RFC 6902) diffing and patching of decoded JSON values"""
+
+import copy
+
+
+def escape(token):
+    return str(token).replace('~', '~0').replace('/', '~1')
+
+
+def unescape(token):
+    return token.replace('~1', '/').replace('~0', '~')
+
+
+def same(a, b):
+    """ Equality that tells 1, 1.0 and True apart (they encode differently) """
+    if type(a) is not type(b):
+        return False
+    if isinstance(a, dict):
+        return a.keys() == b.keys() and all(same(a[k], b[k]) for k in a)
+    if isinstance(a, list):
+        return len(a) == len(b) and all(map(same, a, b))
+    return a == b
+
+
+def make_patch(old, new, path=''):
+    """ List of operations turning old into new """
+    if isinstance(old, dict) and isinstance(new, dict):
+        ops = []
+        for key in old:
+            if key not in new:
+                ops.append({'op': 'remove', 'path': f'{path}/{escape(key)}'})
+        for key, value in new.items():
+            if key not in old:
+                ops.append({'op': 'add', 'path': f'{path}/{escape(key)}',
+                            'value': value})
+            else:
+                ops.extend(make_patch(old[key], value, f'{path}/{escape(key)}'))
+        return ops
+
+    if isinstance(old, list) and isinstance(new, list):
+        # Only diff the part between the common prefix and suffix, so an
+        # insertion or removal does not rewrite every following item
+        start = 0
+        end = min(len(old), len(new))
+        while start < end and same(old[start], new[start]):
+            start += 1
+        tail = 0
+        while (tail < end - start and
+               same(old[len(old) - 1 - tail], new[len(new) - 1 - tail])):
+            tail += 1
+        old_middle = old[start:len(old) - tail]
+        new_middle = new[start:len(new) - tail]
+        common = min(len(old_middle), len(new_middle))
+
+        ops = []
+        for i in range(common):
+            ops.extend(make_patch(old_middle[i], new_middle[i],
+                                  f'{path}/{start + i}'))
+        for i in range(len(old_middle) - common):
+            ops.append({'op': 'remove', 'path': f'{path}/{start + common}'})
+        for i in range(common, len(new_middle)):
+            ops.append({'op': 'add', 'path': f'{path}/{start + i}',
+                        'value': new_middle[i]})
+        return ops
+
+    if same(old, new):
+        return []
+    return [{'op': 'replace', 'path': path, 'value': new}]
+
+
+def parse_pointer(path):
+    if path == '':
+        return []
+    if not path.startswith('/'):
+        raise ValueError(f'invalid JSON pointer {path!r}')
+    return [unescape(token) for token in path[1:].split('/')]
+
+
+def resolve(doc, tokens):
+    for token in tokens:
+        if isinstance(doc, list):
+            doc = doc[int(token)]
+        elif isinstance(doc, dict):
+            doc = doc[token]
+        else:
+            raise ValueError(f'cannot resolve {token!r} in {type(doc).__name__}')
+    return doc
+
+
+def index(container, token, adding=False):
+    if token == '-' and adding:
+        return len(container)
+    i = int(token)
+    if i < 0 or i > len(container) - (0 if adding else 1):
+        raise ValueError(f'index {token} out of range')
+    return i
+
+
+def apply_patch(doc, patch, in_place=False):
+    """
+    Apply the operations in patch to doc and return the result. Unless
+    in_place is set, doc is copied first.
+    """
+    if not in_place:
+        doc = copy.deepcopy(doc)
+    for op in patch:
+        doc = apply_operation(doc, op)
+    return doc
+
+
+def apply_operation(doc, op):
+    kind = op['op']
+    tokens = parse_pointer(op['path'])
+
+    if kind == 'test':
+        if not same(resolve(doc, tokens), op['value']):
+            raise ValueError(f'test failed at {op["path"]!r}')
+        return doc
+    if kind in ('move', 'copy'):
+        source = parse_pointer(op['from'])
+        value = resolve(doc, source)
+        if kind == 'move':
+            doc = apply_operation(doc, {'op': 'remove', 'path': op['from']})
+        else:
+            value = copy.deepcopy(value)
+        return apply_operation(doc, {'op': 'add', 'path': op['path'],
+                                     'value': value})
+
+    if not tokens:
+        # Operations on the whole document
+        if kind in ('add', 'replace'):
+            return op['value']
+        raise ValueError(f'cannot {kind} the document root')
+
+    parent = resolve(doc, tokens[:-1])
+    token = tokens[-1]
+    if isinstance(parent, list):
+        if kind == 'add':
+            parent.insert(index(parent, token, adding=True), op['value'])
+        elif kind == 'remove':
+            del parent[index(parent, token)]
+        elif kind == 'replace':
+            parent[index(parent, token)] = op['value']
+        else:
+            raise ValueError(f'unknown operation {kind!r}')
+    elif isinstance(parent, dict):
+        if kind == 'add':
+            parent[token] = op['value']
+        elif kind in ('remove', 'replace'):
+            if token not in parent:
+                raise ValueError(f'{op["path"]!r} does not exist')
+            if kind == 'remove':
+                del parent[token]
+            else:
+                parent[token] = op['value']
+        else:
+            raise ValueError(f'unknown operation {kind!r}')
+    else:
+        raise ValueError(f'cannot {kind} {op["path"]!r}')
+    return doc
@@ -0,0 +1,26 @@
+"""Defer importing heavy dependencies until they are first used"""
+
+import importlib
+import sys
+import types
+
+
+class LazyModule(types.ModuleType):
+    """
+       Stands in for a module and imports it on first attribute access.
+       The module's attributes are then copied over, so later lookups
+       cost the same as on the module itself.
+    """
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.__name__)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+
+def lazy_import(name):
+    """ The module name if it is already imported, else a LazyModule """
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    return LazyModule(name)
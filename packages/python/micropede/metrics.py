@@ -0,0 +1,250 @@
+"""Counters and latency histograms for the client's hot paths"""
+
+import collections
+import threading
+import time
+
+from .lazy import lazy_import
+
+# Only needed by serve_prometheus
+http_server = lazy_import('http.server')
+
+# Sub-buckets per power of two (relative error of a bucket is < 1/16)
+SUB_BUCKET_BITS = 4
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+def bucket_index(value):
+    shift = max(0, value.bit_length() - SUB_BUCKET_BITS - 1)
+    return (shift << SUB_BUCKET_BITS) + (value >> shift)
+
+
+def bucket_value(index):
+    """ Upper bound of the values counted in bucket index """
+    if index < 2 * SUB_BUCKETS:
+        return index
+    shift = (index >> SUB_BUCKET_BITS) - 1
+    mantissa = index - (shift << SUB_BUCKET_BITS)
+    return ((mantissa + 1) << shift) - 1
+
+
+class Histogram(object):
+    """
+       Log-linear (HDR style) histogram of durations. Values are recorded
+       in microseconds into buckets whose width grows with their value, so
+       recording is a couple of integer operations and memory stays small
+       for any range of values.
+    """
+
+    def __init__(self):
+        self.buckets = collections.Counter()
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def record(self, seconds):
+        value = int(seconds * 1e6)
+        self.buckets[bucket_index(value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        """ Value (us) below which a fraction q of the recorded values fall """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return min(bucket_value(index), self.max)
+        return self.max
+
+    def snapshot(self):
+        """ Summary in milliseconds """
+        if not self.count:
+            return {'count': 0}
+        summary = {
+            'count': self.count,
+            'mean': self.total / self.count / 1000.0,
+            'min': self.min / 1000.0,
+            'max': self.max / 1000.0,
+        }
+        for q in QUANTILES:
+            summary[f'p{q * 100:g}'] = self.percentile(q) / 1000.0
+        return summary
+
+
+class MetricsRegistry(object):
+    """
+       Counters and histograms kept by MicropedeClient:
+         histograms: decode, route_match, publish_ack
+         patterns: per subscribed channel, the number of messages, handler
+                   errors and a histogram of handler run time (for handlers
+                   run in an executor, the time to submit them)
+         counters: client wide counts (published, publish_timeouts, ...)
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.counters = collections.Counter()
+        self.histograms = collections.defaultdict(Histogram)
+        self.pattern_counters = collections.defaultdict(collections.Counter)
+        self.pattern_histograms = collections.defaultdict(Histogram)
+
+    def count(self, key, n=1, pattern=None):
+        if pattern is None:
+            self.counters[key] += n
+        else:
+            self.pattern_counters[pattern][key] += n
+
+    def observe(self, name, seconds):
+        self.histograms[name].record(seconds)
+
+    def observe_since(self, name, start, future=None):
+        """ Record the time since start (usable as a done callback) """
+        if future is not None and (future.cancelled() or
+                                   future.exception() is not None):
+            return
+        self.histograms[name].record(time.perf_counter() - start)
+
+    def instrument(self, pattern, handler, decode=True):
+        """ Wrap a (message, params) handler to count and time its calls """
+        counters = self.pattern_counters[pattern]
+        histogram = self.pattern_histograms[pattern]
+        decoding = self.histograms['decode']
+
+        def _handler(message, params):
+            start = time.perf_counter()
+            if decode and not message._decoded:
+                message.payload
+                now = time.perf_counter()
+                decoding.record(now - start)
+                start = now
+            counters['messages'] += 1
+            try:
+                return handler(message, params)
+            except Exception:
+                counters['errors'] += 1
+                raise
+            finally:
+                histogram.record(time.perf_counter() - start)
+        return _handler
+
+    def snapshot(self):
+        return {
+            'uptime': time.time() - self.started,
+            'counters': dict(self.counters),
+            'histograms': {name: h.snapshot()
+                           for name, h in list(self.histograms.items())},
+            'patterns': {
+                pattern: {**counters,
+                          'handler': self.pattern_histograms[pattern].snapshot()}
+                for pattern, counters in list(self.pattern_counters.items())
+                if counters['messages']
+            },
+        }
+
+    def to_prometheus(self, prefix='micropede', labels=None):
+        """ Metrics in the Prometheus text exposition format """
+        return to_prometheus({None: self}, prefix, labels)
+
+    def samples(self, prefix='micropede', labels=None):
+        """ Yield (family, type, sample line) for every metric """
+        base = ','.join(f'{k}="{escape(v)}"' for k, v in (labels or {}).items())
+
+        def label(**extra):
+            pairs = [base] if base else []
+            pairs += [f'{k}="{escape(v)}"' for k, v in extra.items()]
+            return '{' + ','.join(pairs) + '}' if pairs else ''
+
+        for key, value in sorted(self.counters.items()):
+            family = f'{prefix}_{key}_total'
+            yield family, 'counter', f'{family}{label()} {value}'
+
+        def summary(family, histogram, **extra):
+            for q in QUANTILES:
+                value = histogram.percentile(q)
+                if value is not None:
+                    yield (family, 'summary',
+                           f'{family}{label(quantile=q, **extra)} {value / 1e6}')
+            yield (family, 'summary',
+                   f'{family}_sum{label(**extra)} {histogram.total / 1e6}')
+            yield (family, 'summary',
+                   f'{family}_count{label(**extra)} {histogram.count}')
+
+        for name, histogram in sorted(list(self.histograms.items())):
+            yield from summary(f'{prefix}_{name}_seconds', histogram)
+
+        for pattern, counters in sorted(list(self.pattern_counters.items())):
+            family = f'{prefix}_messages_total'
+            yield (family, 'counter',
+                   f'{family}{label(pattern=pattern)} {counters["messages"]}')
+            family = f'{prefix}_handler_errors_total'
+            yield (family, 'counter',
+                   f'{family}{label(pattern=pattern)} {counters["errors"]}')
+            yield from summary(f'{prefix}_handler_seconds',
+                               self.pattern_histograms[pattern], pattern=pattern)
+
+
+def to_prometheus(registries, prefix='micropede', labels=None):
+    """
+    Exposition of several registries ({name: MetricsRegistry}): samples
+    are grouped by metric family, each family with a single TYPE line, and
+    told apart by a client="{name}" label (no label for the name None)
+    """
+    families = collections.OrderedDict()
+    for name, registry in registries.items():
+        extra = dict(labels or {})
+        if name is not None:
+            extra['client'] = name
+        for family, kind, line in registry.samples(prefix, extra):
+            families.setdefault(family, (kind, []))[1].append(line)
+
+    lines = []
+    for family, (kind, samples) in families.items():
+        lines.append(f'# TYPE {family} {kind}')
+        lines.extend(samples)
+    return '\n'.join(lines) + '\n'
+
+
+def escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def serve_prometheus(registries, port=9464, host='127.0.0.1'):
+    """
+    Serve the registries ({name: MetricsRegistry}, or a single registry)
+    at http://host:port/metrics from a daemon thread. Returns the server;
+    call server.shutdown() to stop it.
+    """
+    if isinstance(registries, MetricsRegistry):
+        registries = {None: registries}
+
+    class Handler(http_server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = to_prometheus(registries).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type',
+                             'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http_server.ThreadingHTTPServer((host, port), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
@@ -0,0 +1,184 @@
+"""Outbound queue that buffers publishes while the broker is unreachable"""
+
+import collections
+import glob
+import mmap
+import os
+import struct
+import tempfile
+
+# marker, seq, payload length, topic length, flags
+RECORD = struct.Struct('!BQIHB')
+MARKER = 0xa5
+RETAIN = 0x04
+
+DEFAULT_MEMORY_LIMIT = 1 << 20
+DEFAULT_SEGMENT_SIZE = 1 << 24
+
+
+class Segment(object):
+    """ Append-only, memory-mapped file of publish records """
+
+    def __init__(self, path, size=None):
+        self.path = path
+        if size is None:
+            # Existing segment, find the end of the written records
+            self.file = open(path, 'r+b')
+            self.map = mmap.mmap(self.file.fileno(), 0)
+            self.offset = 0
+            for record in self.records():
+                pass
+        else:
+            self.file = open(path, 'w+b')
+            self.file.truncate(size)
+            self.map = mmap.mmap(self.file.fileno(), size)
+            self.offset = 0
+
+    def append(self, seq, topic, payload, flags):
+        end = self.offset + RECORD.size + len(topic) + len(payload)
+        if end > len(self.map):
+            return False
+        RECORD.pack_into(self.map, self.offset, MARKER, seq, len(payload),
+                         len(topic), flags)
+        start = self.offset + RECORD.size
+        self.map[start:start + len(topic)] = topic
+        self.map[start + len(topic):end] = payload
+        self.offset = end
+        return True
+
+    def records(self):
+        """ Yield (seq, topic, payload, flags) in the order they were written """
+        offset = 0
+        size = len(self.map)
+        while offset + RECORD.size <= size:
+            (marker, seq, payload_length, topic_length,
+             flags) = RECORD.unpack_from(self.map, offset)
+            if marker != MARKER:
+                break
+            start = offset + RECORD.size
+            topic = self.map[start:start + topic_length].decode('utf-8')
+            start += topic_length
+            payload = self.map[start:start + payload_length]
+            offset = start + payload_length
+            self.offset = max(self.offset, offset)
+            yield (seq, topic, payload, flags)
+
+    def remove(self):
+        self.map.close()
+        self.file.close()
+        os.remove(self.path)
+
+
+class OfflineQueue(object):
+    """
+       Holds publishes made while disconnected so they can be replayed in
+       order on reconnect. Records are kept in memory until memory_limit
+       bytes are buffered; later records are appended to memory-mapped
+       segment files in directory, which are picked up again if the
+       process restarts before they were replayed.
+
+       When replayed, retained messages are collapsed to the last value of
+       each topic.
+    """
+
+    def __init__(self, directory=None, memory_limit=DEFAULT_MEMORY_LIMIT,
+                 segment_size=DEFAULT_SEGMENT_SIZE):
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix='micropede-outbox-')
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.memory_limit = memory_limit
+        self.segment_size = segment_size
+
+        self.memory = collections.deque()
+        self.memory_bytes = 0
+        self.futures = {}
+        self.count = 0
+        self.seq = 0
+
+        self.segments = []
+        for path in sorted(glob.glob(os.path.join(directory, '*.seg'))):
+            segment = Segment(path)
+            for (seq, topic, payload, flags) in segment.records():
+                self.seq = max(self.seq, seq)
+                self.count += 1
+            self.segments.append(segment)
+
+    def __len__(self):
+        return self.count
+
+    def append(self, topic, payload, qos=0, retain=False, future=None):
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        self.seq += 1
+        self.count += 1
+        flags = qos | (RETAIN if retain else 0)
+        if future is not None:
+            self.futures[self.seq] = [future]
+
+        # Once spilling, keep writing to disk so records stay in order
+        size = len(topic) + len(payload)
+        if not self.segments and self.memory_bytes + size <= self.memory_limit:
+            self.memory.append((self.seq, topic, payload, flags))
+            self.memory_bytes += size
+            return
+
+        topic = topic.encode('utf-8')
+        if not self.segments or not self.segments[-1].append(
+                self.seq, topic, payload, flags):
+            path = os.path.join(self.directory, f'{self.seq:020d}.seg')
+            size = max(self.segment_size, RECORD.size + len(topic) + len(payload))
+            self.segments.append(Segment(path, size))
+            self.segments[-1].append(self.seq, topic, payload, flags)
+
+    def records(self, memory=None, segments=None):
+        memory = self.memory if memory is None else memory
+        segments = self.segments if segments is None else segments
+        for record in memory:
+            yield record
+        for segment in segments:
+            for record in segment.records():
+                yield record
+
+    def drain(self):
+        """
+        Yield (topic, payload, qos, retain, futures) for every record in
+        order. Futures of retained records replaced by a newer value are
+        moved to the record that is sent.
+
+        The queue is emptied before the first record is yielded, so records
+        appended while draining (e.g. the connection dropped again) are
+        kept for the next drain.
+        """
+        memory, segments, futures = self.memory, self.segments, self.futures
+        self.memory = collections.deque()
+        self.segments = []
+        self.futures = {}
+        self.clear()
+
+        last = {}
+        for (seq, topic, payload, flags) in self.records(memory, segments):
+            if flags & RETAIN:
+                if topic in last:
+                    replaced = futures.pop(last[topic], [])
+                    futures.setdefault(seq, []).extend(replaced)
+                last[topic] = seq
+
+        try:
+            for (seq, topic, payload, flags) in self.records(memory, segments):
+                if flags & RETAIN and last[topic] != seq:
+                    continue
+                yield (topic, bytes(payload), flags & 0x3,
+                       bool(flags & RETAIN), futures.pop(seq, []))
+        finally:
+            for segment in segments:
+                segment.remove()
+
+    def clear(self):
+        self.memory.clear()
+        self.memory_bytes = 0
+        self.futures.clear()
+        self.count = 0
+        for segment in self.segments:
+            segment.remove()
+        self.segments = []
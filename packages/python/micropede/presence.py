@@ -0,0 +1,140 @@
+"""Track which plugins are connected, from broker signals and their schema"""
+
+import asyncio
+import time
+
+ONLINE = 'online'
+OFFLINE = 'offline'
+UNKNOWN = 'unknown'
+
+# Connections of MicropedeAsync helpers are not plugins
+IGNORED_PREFIXES = ('micropede-async-',)
+
+
+class PresenceIndex(object):
+    """
+       Follows {app}/{name}/signal/connected and .../disconnected (published
+       by the broker for every client) and the retained schema each plugin
+       publishes on {app}/{name}/state/schema when it connects.
+
+       A plugin is online once it publishes its schema live (not retained),
+       which it does after subscribing to its triggers and puts; the
+       broker's connected signal comes before that, at CONNECT, and only
+       counts the connection. It is offline once it has no connections
+       left. Plugins only known from a retained schema (they connected
+       before the index started) are UNKNOWN: they may have gone away
+       without the index seeing it. Several processes may share a plugin
+       name (worker groups), so connections are counted per name (exactly
+       only for the connections made after the index started).
+    """
+
+    def __init__(self, client, ignored_prefixes=IGNORED_PREFIXES):
+        self.client = client
+        self.ignored_prefixes = tuple(ignored_prefixes)
+        self.plugins = {}
+        self.waiters = {}
+
+    def start(self):
+        """ Subscribe to the signals and schema of every plugin """
+        client = self.client
+        with client.batch_subscriptions():
+            futures = [
+                client.on_signal_msg('{sender}', 'connected', self.on_connected),
+                client.on_signal_msg('{sender}', 'disconnected',
+                                     self.on_disconnected),
+                client.on_state_msg('{sender}', 'schema', self.on_schema,
+                                    raw=True),
+            ]
+        return asyncio.gather(*futures)
+
+    def ignored(self, name):
+        return name.startswith(self.ignored_prefixes)
+
+    def _entry(self, name):
+        if name not in self.plugins:
+            self.plugins[name] = {'name': name, 'status': UNKNOWN,
+                                  'version': None, 'connected_at': None,
+                                  'disconnected_at': None, 'connections': 0}
+        return self.plugins[name]
+
+    def _online(self, entry):
+        if entry['status'] != ONLINE:
+            entry['status'] = ONLINE
+            entry['connected_at'] = time.time()
+        for future in self.waiters.pop(entry['name'], []):
+            if not future.done():
+                future.set_result(dict(entry))
+
+    def on_connected(self, payload, params):
+        name = params['sender']
+        if self.ignored(name):
+            return
+        entry = self._entry(name)
+        # Online once its schema follows (requests sent now could be lost)
+        entry['connections'] += 1
+
+    def on_disconnected(self, payload, params):
+        name = params['sender']
+        if self.ignored(name):
+            return
+        entry = self._entry(name)
+        entry['connections'] = max(entry['connections'] - 1, 0)
+        if entry['connections'] == 0:
+            entry['status'] = OFFLINE
+            entry['disconnected_at'] = time.time()
+
+    def on_schema(self, message, params):
+        name = params['sender']
+        if self.ignored(name) or len(message.raw) == 0:
+            return
+        head = (message.payload or {}).get('__head__') or {}
+        entry = self._entry(name)
+        entry['version'] = head.get('plugin_version', entry['version'])
+        if not message.retain:
+            # Published once the plugin (re)subscribed
+            entry['connections'] = max(entry['connections'], 1)
+            self._online(entry)
+
+    def status(self, name):
+        """ ONLINE, OFFLINE or UNKNOWN """
+        return self.plugins.get(name, {}).get('status', UNKNOWN)
+
+    def is_offline(self, name):
+        return self.status(name) == OFFLINE
+
+    def live(self, include_unknown=False):
+        """
+        [{name, status, version, connected_at, connections}] for the online
+        plugins (and those of unknown status with include_unknown=True)
+        """
+        statuses = (ONLINE, UNKNOWN) if include_unknown else (ONLINE,)
+        return [dict(entry) for name, entry in sorted(self.plugins.items())
+                if entry['status'] in statuses]
+
+    def wait_online(self, name, timeout=None):
+        """ Future resolving to the entry of name once it is not offline """
+        future = asyncio.Future(loop=self.client.loop)
+        if not self.is_offline(name):
+            future.set_result(dict(self.plugins.get(
+                name, {'name': name, 'status': UNKNOWN})))
+            return future
+        waiters = self.waiters.setdefault(name, [])
+        waiters.append(future)
+
+        def on_timeout():
+            if future.done():
+                return
+            if future in waiters:
+                waiters.remove(future)
+            future.set_exception(
+                Exception([name, 'offline', f'timeout {timeout}ms']))
+
+        if timeout is not None and timeout != -1:
+            self.client.set_timeout(on_timeout, timeout, future)
+        return future
+
+    def info(self):
+        counts = {ONLINE: 0, OFFLINE: 0, UNKNOWN: 0}
+        for entry in self.plugins.values():
+            counts[entry['status']] += 1
+        return counts
@@ -0,0 +1,249 @@
+"""Record message traffic to a binary log and replay it"""
+
+import asyncio
+import bisect
+import mmap
+import os
+import struct
+import time
+
+MAGIC = b'MPRL\x01'
+
+# timestamp, topic length, payload length, flags
+RECORD = struct.Struct('!dHIB')
+# record offset, timestamp
+INDEX = struct.Struct('!Qd')
+RETAIN = 0x04
+
+DEFAULT_WINDOW = 100
+
+
+def index_path(path):
+    return path + '.idx'
+
+
+class Record(object):
+    """ A recorded message, shaped like paho's MQTTMessage """
+    __slots__ = ('timestamp', 'topic', 'payload', 'qos', 'retain')
+
+    def __init__(self, timestamp, topic, payload, qos, retain):
+        self.timestamp = timestamp
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+
+
+class Recorder(object):
+    """
+       Appends received messages to a log file:
+         MAGIC, then per message RECORD + topic + payload
+       and the offset and timestamp of every record to {path}.idx.
+
+       With channel=None every message delivered to client is recorded,
+       otherwise channel (e.g. '{app_name}/#') is subscribed and only its
+       messages are recorded.
+    """
+
+    def __init__(self, client, path, channel=None):
+        self.client = client
+        self.path = path
+        self.channel = channel
+        self.count = 0
+        self.log = None
+        self.index = None
+
+    def start(self):
+        exists = os.path.exists(self.path) and os.path.getsize(self.path) > 0
+        self.log = open(self.path, 'ab')
+        self.index = open(index_path(self.path), 'ab')
+        if not exists:
+            self.log.write(MAGIC)
+        self.offset = self.log.tell()
+
+        if self.channel is None:
+            self.client.recorders.append(self)
+            future = asyncio.Future(loop=self.client.loop)
+            future.set_result('done')
+            return future
+        return self.client.add_subscription(self.channel, self.on_message,
+                                            raw=True)
+
+    def stop(self):
+        if self.channel is None:
+            if self in self.client.recorders:
+                self.client.recorders.remove(self)
+        else:
+            self.client.remove_subscription(self.channel)
+        self.close()
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+            self.index.close()
+            self.log = self.index = None
+
+    def on_message(self, message, params):
+        self.record(message.topic, message.raw, message.qos, message.retain)
+
+    def record(self, topic, payload, qos=0, retain=False, timestamp=None):
+        if self.log is None:
+            return
+        if timestamp is None:
+            timestamp = time.time()
+        topic = topic.encode('utf-8')
+        flags = qos | (RETAIN if retain else 0)
+        self.log.write(RECORD.pack(timestamp, len(topic), len(payload), flags))
+        self.log.write(topic)
+        self.log.write(payload)
+        self.index.write(INDEX.pack(self.offset, timestamp))
+        self.offset += RECORD.size + len(topic) + len(payload)
+        self.count += 1
+
+    def flush(self):
+        if self.log is not None:
+            self.log.flush()
+            self.index.flush()
+
+
+class LogReader(object):
+    """
+       Reads a log written by Recorder. Payloads are zero-copy memoryviews
+       of the memory-mapped log, valid until close(). The index is rebuilt
+       from the log when it is missing or incomplete.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        if size < len(MAGIC):
+            self.map = b''
+        else:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            if self.map[:len(MAGIC)] != MAGIC:
+                raise ValueError(f'{path} is not a micropede traffic log')
+        (self.offsets, self.timestamps) = self._load_index()
+
+    def _load_index(self):
+        offsets, timestamps = [], []
+        try:
+            with open(index_path(self.path), 'rb') as f:
+                data = f.read()
+            for (offset, timestamp) in INDEX.iter_unpack(
+                    data[:len(data) - len(data) % INDEX.size]):
+                offsets.append(offset)
+                timestamps.append(timestamp)
+        except FileNotFoundError:
+            pass
+
+        # Records written after the last index entry (e.g. after a crash)
+        offset = len(MAGIC)
+        if offsets:
+            offset = offsets[-1] + self._length(offsets[-1])
+        while offset + RECORD.size <= len(self.map):
+            end = offset + self._length(offset)
+            if end > len(self.map):
+                break
+            offsets.append(offset)
+            timestamps.append(RECORD.unpack_from(self.map, offset)[0])
+            offset = end
+        return offsets, timestamps
+
+    def _length(self, offset):
+        (timestamp, topic_length, payload_length,
+         flags) = RECORD.unpack_from(self.map, offset)
+        return RECORD.size + topic_length + payload_length
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def read(self, i):
+        offset = self.offsets[i]
+        (timestamp, topic_length, payload_length,
+         flags) = RECORD.unpack_from(self.map, offset)
+        start = offset + RECORD.size
+        topic = self.map[start:start + topic_length].decode('utf-8')
+        start += topic_length
+        payload = memoryview(self.map)[start:start + payload_length]
+        return Record(timestamp, topic, payload, flags & 0x3,
+                      bool(flags & RETAIN))
+
+    def position(self, timestamp):
+        """ Index of the first record at or after timestamp """
+        return bisect.bisect_left(self.timestamps, timestamp)
+
+    def records(self, start=None, end=None):
+        """ Yield the records between timestamps start and end """
+        first = 0 if start is None else self.position(start)
+        last = len(self) if end is None else self.position(end)
+        for i in range(first, last):
+            yield self.read(i)
+
+    def close(self):
+        if isinstance(self.map, mmap.mmap):
+            try:
+                self.map.close()
+            except BufferError:
+                # Payloads are still referenced
+                pass
+        self.file.close()
+
+
+class Replayer(object):
+    """
+       Publishes the messages of a log through client again.
+
+       speed: 1 replays with the recorded timing, N is N times faster and
+       None as fast as the in-flight window allows. With deliver=True the
+       messages are handed straight to client.on_message instead of being
+       published, so handlers can be benchmarked without a broker.
+    """
+
+    def __init__(self, client, path, speed=1, deliver=False,
+                 window=DEFAULT_WINDOW, qos=None):
+        self.client = client
+        self.path = path
+        self.speed = speed
+        self.deliver = deliver
+        self.window = window
+        self.qos = qos
+
+    async def replay(self, start=None, end=None):
+        """ Replay the records between timestamps start and end """
+        reader = LogReader(self.path)
+        count = 0
+        size = 0
+        pending = set()
+        began = time.perf_counter()
+        first = None
+        try:
+            for record in reader.records(start, end):
+                if first is None:
+                    first = record.timestamp
+                if self.speed:
+                    delay = ((record.timestamp - first) / self.speed -
+                             (time.perf_counter() - began))
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                count += 1
+                size += len(record.payload)
+                if self.deliver:
+                    self.client.on_message(None, None, record)
+                    if count % self.window == 0:
+                        # Let handler tasks run
+                        await asyncio.sleep(0)
+                    continue
+                qos = record.qos if self.qos is None else self.qos
+                pending.add(self.client.send_message(
+                    record.topic, record.payload, record.retain, qos))
+                if len(pending) >= self.window:
+                    done, pending = await asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED)
+            if pending:
+                await asyncio.gather(*pending)
+        finally:
+            reader.close()
+        seconds = time.perf_counter() - began
+        return {'messages': count, 'bytes': size, 'seconds': seconds,
+                'rate': count / seconds if seconds else None}
@@ -0,0 +1,148 @@
+"""MQTT topic trie used to dispatch incoming messages to handlers"""
+
+import re
+
+_param = re.compile(r'^\{(.+)\}$')
+
+
+class Route(object):
+    """ A handler registered for a channel such as {app}/trigger/{action} """
+    __slots__ = ('channel', 'handler', 'params')
+
+    def __init__(self, channel, handler, params):
+        self.channel = channel
+        self.handler = handler
+        self.params = params
+
+
+class Node(object):
+    __slots__ = ('children', 'plus', 'hash', 'routes')
+
+    def __init__(self):
+        self.children = {}
+        self.plus = None
+        self.hash = None
+        self.routes = []
+
+    def is_empty(self):
+        return not (self.children or self.plus or self.hash or self.routes)
+
+
+class TopicRouter(object):
+    """
+       Indexes channels by topic level. Channels use the same syntax as
+       add_subscription: "{name}" matches one level and is returned as a
+       param, "+" matches one level and "#" matches the remaining levels.
+
+       Matching walks one trie level per topic level, so its cost depends
+       on the topic depth and not on how many routes are registered.
+    """
+
+    def __init__(self):
+        self.root = Node()
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    @staticmethod
+    def parse(channel):
+        """ Split a channel into trie keys and (level, name) params """
+        keys, params = [], []
+        for i, level in enumerate(channel.split('/')):
+            m = _param.match(level)
+            if m:
+                keys.append('+')
+                params.append((i, m.group(1)))
+            else:
+                keys.append(level)
+        if '#' in keys[:-1]:
+            raise ValueError(f'"#" must be the last level: {channel}')
+        return keys, tuple(params)
+
+    def _node(self, keys, create=False):
+        node, path = self.root, []
+        for key in keys:
+            path.append(node)
+            if key == '+':
+                child = node.plus
+                if child is None and create:
+                    child = node.plus = Node()
+            elif key == '#':
+                child = node.hash
+                if child is None and create:
+                    child = node.hash = Node()
+            else:
+                child = node.children.get(key)
+                if child is None and create:
+                    child = node.children[key] = Node()
+            if child is None:
+                return None, path
+            node = child
+        return node, path
+
+    def add_route(self, channel, handler):
+        """ Add a handler (a channel may have several handlers) """
+        keys, params = self.parse(channel)
+        node, path = self._node(keys, create=True)
+        node.routes.append(Route(channel, handler, params))
+        self.count += 1
+
+    def remove_route(self, channel, handler=None):
+        """
+        Remove handler from channel (or every handler of channel if handler
+        is None). Returns the number of routes removed.
+        """
+        keys, params = self.parse(channel)
+        node, path = self._node(keys)
+        if node is None:
+            return 0
+
+        before = len(node.routes)
+        node.routes = [r for r in node.routes if r.channel != channel or
+                       (handler is not None and r.handler != handler)]
+        removed = before - len(node.routes)
+        self.count -= removed
+
+        # Prune empty branches
+        for parent, key in zip(reversed(path), reversed(keys)):
+            if not node.is_empty():
+                break
+            if key == '+':
+                parent.plus = None
+            elif key == '#':
+                parent.hash = None
+            else:
+                del parent.children[key]
+            node = parent
+        return removed
+
+    def has_filter(self, sub):
+        """ True if any route is registered for the subscription filter """
+        node, path = self._node(sub.split('/'))
+        return node is not None and len(node.routes) > 0
+
+    def match(self, topic):
+        """ Return a list of (handler, params) for every matching route """
+        levels = topic.split('/')
+        depth = len(levels)
+        matches = []
+        stack = [(self.root, 0)]
+
+        while stack:
+            node, i = stack.pop()
+            # "#" also matches the parent level ("a/#" matches "a")
+            if node.hash is not None and not (i == 0 and topic[:1] == '$'):
+                matches.extend(node.hash.routes)
+            if i == depth:
+                matches.extend(node.routes)
+                continue
+            child = node.children.get(levels[i])
+            if child is not None:
+                stack.append((child, i + 1))
+            # Wildcards never match topics starting with "$"
+            if node.plus is not None and not (i == 0 and topic[:1] == '$'):
+                stack.append((node.plus, i + 1))
+
+        return [(r.handler, {name: levels[i] for i, name in r.params})
+                for r in matches]
@@ -0,0 +1,186 @@
+"""Dispatch inbound messages by priority class instead of arrival order"""
+
+import asyncio
+import collections
+import threading
+import time
+
+from .timers import in_loop
+
+CONTROL = 'control'
+RPC = 'rpc'
+DATA = 'data'
+
+# Highest priority first
+CLASSES = (CONTROL, RPC, DATA)
+
+DEFAULT_MAX_QUEUED = 10000
+DEFAULT_BATCH = 100
+
+
+def classify(topic):
+    """
+    control: triggers ({app}/trigger/...)
+    rpc: puts and replies ({app}/put/..., {app}/{sender}/notify/...)
+    data: everything else (state, signal, status, ...)
+    """
+    parts = topic.split('/', 3)
+    if len(parts) > 1:
+        if parts[1] == 'trigger':
+            return CONTROL
+        if parts[1] == 'put':
+            return RPC
+    if len(parts) > 2 and parts[2] == 'notify':
+        return RPC
+    return DATA
+
+
+def is_state(topic):
+    parts = topic.split('/', 3)
+    return len(parts) > 3 and parts[2] == 'state'
+
+
+class InboundScheduler(object):
+    """
+       Queues received messages per priority class (control, rpc, data)
+       and dispatches them to the client on its loop, highest class first,
+       batch messages per loop iteration. With the paho transport messages
+       are queued from paho's thread, so a flood of state messages never
+       sits in front of a ping in the loop's callback queue.
+
+       limits: {class: n} handlers returning a coroutine that may run at
+       once per class (messages of a class at its limit stay queued).
+
+       collapse: a state message still queued is replaced by a newer one
+       for the same topic (it keeps its place in the queue).
+
+       At most max_queued messages wait; beyond that the oldest message of
+       the lowest non-empty class is dropped (control messages only when
+       nothing else is queued).
+    """
+
+    def __init__(self, limits=None, max_queued=DEFAULT_MAX_QUEUED,
+                 collapse=True, batch=DEFAULT_BATCH, classifier=classify):
+        self.limits = dict(limits or {})
+        self.max_queued = max_queued
+        self.collapse = collapse
+        self.batch = batch
+        self.classifier = classifier
+        self.client = None
+        self.loop = None
+
+        self.queues = {c: collections.deque() for c in CLASSES}
+        self.states = {}
+        self.running = collections.Counter()
+        self.queued = 0
+        self.scheduled = False
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()
+        self.max_depth = 0
+
+    def attach(self, client):
+        self.client = client
+        self.loop = client.loop
+
+    def receive(self, client, userdata, msg):
+        """ on_message callback of the transport, from any thread """
+        topic = msg.topic
+        if not topic:
+            return
+        kind = self.classifier(topic)
+        with self.lock:
+            if self.collapse and kind == DATA and topic in self.states:
+                # Newest value, same place in the queue
+                self.states[topic][1] = msg
+                self.counters['collapsed'] += 1
+            else:
+                entry = [topic, msg, time.perf_counter(), kind]
+                self.queues[kind].append(entry)
+                if self.collapse and kind == DATA and is_state(topic):
+                    self.states[topic] = entry
+                self.queued += 1
+                self.counters[f'{kind}_queued'] += 1
+                if self.queued > self.max_queued:
+                    self._drop()
+                self.max_depth = max(self.max_depth, self.queued)
+            if self.scheduled:
+                return
+            self.scheduled = True
+        if in_loop(self.loop):
+            self.loop.call_soon(self.drain)
+        else:
+            self.loop.call_soon_threadsafe(self.drain)
+
+    def _drop(self):
+        for kind in reversed(CLASSES):
+            if self.queues[kind]:
+                entry = self.queues[kind].popleft()
+                self._forget(entry)
+                self.counters['dropped'] += 1
+                return
+
+    def _forget(self, entry):
+        self.queued -= 1
+        if self.states.get(entry[0]) is entry:
+            del self.states[entry[0]]
+
+    def _next(self):
+        for kind in CLASSES:
+            queue = self.queues[kind]
+            if queue and self.running[kind] < self.limits.get(kind, 1 << 30):
+                entry = queue.popleft()
+                self._forget(entry)
+                return entry
+        return None
+
+    def drain(self):
+        """ Dispatch up to batch messages, then yield to the loop """
+        metrics = self.client.metrics
+        empty = False
+        try:
+            for i in range(self.batch):
+                with self.lock:
+                    entry = self._next()
+                    if entry is None:
+                        self.scheduled = False
+                        empty = True
+                        return
+                (topic, msg, queued_at, kind) = entry
+                if metrics is not None:
+                    metrics.observe_since(f'queue_wait_{kind}', queued_at)
+                self.counters[f'{kind}_dispatched'] += 1
+                self._dispatch(topic, msg, kind)
+        finally:
+            # Still scheduled: keep draining, even after an error
+            if not empty:
+                self.loop.call_soon(self.drain)
+
+    def _dispatch(self, topic, msg, kind):
+        try:
+            results = self.client.on_message(None, None, msg) or []
+        except Exception as e:
+            # A failing handler must not stop the queue
+            self.counters['errors'] += 1
+            self.loop.call_exception_handler({
+                'message': f'handler of {topic} failed',
+                'exception': e,
+            })
+            return
+        for result in results:
+            if isinstance(result, asyncio.Future) and not result.done():
+                self.running[kind] += 1
+                result.add_done_callback(
+                    lambda f, kind=kind: self._release(kind))
+
+    def _release(self, kind):
+        self.running[kind] -= 1
+        with self.lock:
+            if self.queued and not self.scheduled:
+                self.scheduled = True
+                self.loop.call_soon(self.drain)
+
+    def info(self):
+        with self.lock:
+            depth = {kind: len(queue) for kind, queue in self.queues.items()}
+        return dict(self.counters, queued=depth, running=dict(self.running),
+                    max_depth=self.max_depth)
@@ -0,0 +1,106 @@
+"""Local mirror of the retained state published by plugins"""
+
+import asyncio
+import collections
+
+
+class Decoded(object):
+    """ Stands in for a codecs.Message holding an already decoded value """
+    __slots__ = ('payload',)
+
+    def __init__(self, payload):
+        self.payload = payload
+
+
+class StateCache(object):
+    """
+       Keeps the latest retained value of every {app}/{sender}/state/{prop}
+       topic so reads need no network round-trip. Values are stored as
+       received and only decoded when read.
+
+       max_size: optional number of (sender, prop) keys to keep; the least
+       recently used keys are evicted first
+       deltas: also follow state published as deltas (see delta.py)
+    """
+
+    def __init__(self, client, max_size=None, deltas=False):
+        self.client = client
+        self.max_size = max_size
+        self.deltas = deltas
+        self.messages = collections.OrderedDict()
+        self.watchers = {}
+
+    def start(self):
+        """ Subscribe to the state of every plugin """
+        if self.deltas:
+            return self.client.on_state_msg('{sender}', '{prop}',
+                                            self.on_value, delta=True)
+        return self.client.on_state_msg('{sender}', '{prop}', self.on_state,
+                                        raw=True)
+
+    def on_value(self, value, params):
+        """ Store a value rebuilt by a delta.DeltaReceiver """
+        key = (params['sender'], params['prop'])
+        if value is None:
+            self.messages.pop(key, None)
+            return
+        self.store(key, Decoded(value))
+
+    def __contains__(self, key):
+        return key in self.messages
+
+    def __len__(self):
+        return len(self.messages)
+
+    def keys(self):
+        return list(self.messages)
+
+    def get(self, sender, prop, default=None):
+        key = (sender, prop)
+        if key not in self.messages:
+            return default
+        self.messages.move_to_end(key)
+        return self.messages[key].payload
+
+    def on_state(self, message, params):
+        key = (params['sender'], params['prop'])
+
+        # An empty retained message clears the topic
+        if len(message.raw) == 0:
+            self.messages.pop(key, None)
+            return
+
+        self.store(key, message)
+
+    def store(self, key, message):
+        self.messages[key] = message
+        self.messages.move_to_end(key)
+        if self.max_size is not None:
+            while len(self.messages) > self.max_size:
+                self.messages.popitem(last=False)
+
+        for queue in self.watchers.get(key, []):
+            if queue.full():
+                # Slow watchers skip to the newest value
+                queue.get_nowait()
+            queue.put_nowait(message)
+
+    async def watch(self, sender, prop, maxsize=1):
+        """
+        Async iterator over the values of a state topic, starting with the
+        cached value (if any). With the default maxsize=1 a slow consumer
+        only sees the newest value.
+        """
+        key = (sender, prop)
+        queue = asyncio.Queue(maxsize=maxsize)
+        self.watchers.setdefault(key, set()).add(queue)
+        try:
+            if key in self.messages:
+                queue.put_nowait(self.messages[key])
+            while True:
+                message = await queue.get()
+                yield message.payload
+        finally:
+            self.watchers[key].discard(queue)
+            if not self.watchers[key]:
+                del self.watchers[key]
@@ -0,0 +1,324 @@
+"""Send large payloads as a stream of binary chunks"""
+
+import asyncio
+import hashlib
+import io
+import mmap
+import os
+import uuid
+
+from .lazy import lazy_import
+
+_ = lazy_import('pydash')
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+DEFAULT_WINDOW = 16
+DEFAULT_STREAM_TIMEOUT = 30000
+
+# Flow control: wait for the broker's acks, or for the receiver to read
+BROKER = 'broker'
+RECEIVER = 'receiver'
+
+STREAM = '__stream__'
+
+
+def stream_topic(topic, stream_id, part):
+    return f'{topic}/{STREAM}/{stream_id}/{part}'
+
+
+def as_buffer(data):
+    """
+    Return (memoryview, closer) for bytes-like objects, mmaps, file paths
+    and file objects (files are memory-mapped, so nothing is read ahead)
+    """
+    if isinstance(data, str):
+        data = open(data, 'rb')
+        if os.fstat(data.fileno()).st_size == 0:
+            data.close()
+            return memoryview(b''), _.noop
+        view = mmap.mmap(data.fileno(), 0, access=mmap.ACCESS_READ)
+        data.close()
+        return memoryview(view), view.close
+    if isinstance(data, io.IOBase):
+        try:
+            fileno = data.fileno()
+        except (OSError, io.UnsupportedOperation):
+            return memoryview(data.read()), _.noop
+        if os.fstat(fileno).st_size == 0:
+            return memoryview(b''), _.noop
+        view = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+        return memoryview(view), view.close
+    view = memoryview(data)
+    if view.format != 'B' or view.ndim != 1:
+        view = view.cast('B')
+    return view, _.noop
+
+
+class StreamSender(object):
+    """
+       Publishes data as a stream on {topic}/__stream__/{stream_id}/...:
+         start: JSON {size, chunks, chunk_size, name, meta, flow_control, window}
+         0, 1, 2, ...: the raw chunks, sliced from a memoryview of data
+         end: JSON {size, chunks, sha256}
+
+       At most window chunks are in flight: with flow_control 'broker'
+       until the broker acknowledged them, with 'receiver' until a
+       receiver read them (receivers report progress on .../ack).
+    """
+
+    def __init__(self, client, topic, data, chunk_size=DEFAULT_CHUNK_SIZE,
+                 window=DEFAULT_WINDOW, flow_control=BROKER, qos=1, name=None,
+                 meta=None, timeout=DEFAULT_STREAM_TIMEOUT):
+        self.client = client
+        self.topic = topic
+        self.data = data
+        self.chunk_size = chunk_size
+        self.window = window
+        self.flow_control = flow_control
+        self.qos = qos
+        self.name = name
+        self.meta = meta
+        self.timeout = timeout
+        self.id = uuid.uuid4().hex[:12]
+        self.acked = -1
+        self.progress = None
+
+    async def send(self):
+        view, close = as_buffer(self.data)
+        try:
+            return await self._send(view)
+        finally:
+            try:
+                view.release()
+                close()
+            except BufferError:
+                # A chunk is still referenced (e.g. queued offline), the
+                # mapping is closed once it is collected
+                pass
+
+    async def _send(self, view):
+        size = len(view)
+        chunks = (size + self.chunk_size - 1) // self.chunk_size
+        digest = hashlib.sha256()
+
+        if self.flow_control == RECEIVER:
+            self.progress = asyncio.Event()
+            await self.client.add_subscription(
+                stream_topic(self.topic, self.id, 'ack'), self._on_ack)
+
+        try:
+            await self.client.send_message(
+                stream_topic(self.topic, self.id, 'start'),
+                {'size': size, 'chunks': chunks, 'chunk_size': self.chunk_size,
+                 'name': self.name, 'meta': self.meta,
+                 'flow_control': self.flow_control, 'window': self.window},
+                qos=self.qos)
+
+            pending = set()
+            for seq in range(chunks):
+                chunk = view[seq * self.chunk_size:(seq + 1) * self.chunk_size]
+                digest.update(chunk)
+                pending.add(self.client.send_message(
+                    stream_topic(self.topic, self.id, seq), chunk,
+                    qos=self.qos, timeout=self.timeout))
+                pending = await self._throttle(pending, seq)
+
+            if pending:
+                await asyncio.gather(*pending)
+
+            await self.client.send_message(
+                stream_topic(self.topic, self.id, 'end'),
+                {'size': size, 'chunks': chunks, 'sha256': digest.hexdigest()},
+                qos=self.qos)
+        finally:
+            if self.flow_control == RECEIVER:
+                self.client.remove_subscription(
+                    stream_topic(self.topic, self.id, 'ack'))
+        return self.id
+
+    async def _throttle(self, pending, seq):
+        if self.flow_control == RECEIVER:
+            await self._wait_for_receiver(seq - self.window)
+        while len(pending) >= self.window:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED)
+            for f in done:
+                f.result()
+        return pending
+
+    async def _wait_for_receiver(self, seq):
+        while self.acked < seq:
+            self.progress.clear()
+            try:
+                await asyncio.wait_for(self.progress.wait(),
+                                       self.timeout / 1000.0)
+            except asyncio.TimeoutError:
+                raise Exception(f'stream {self.id}: no receiver progress '
+                                f'for {self.timeout}ms')
+
+    def _on_ack(self, payload, params):
+        seq = payload.get('seq', -1) if isinstance(payload, dict) else -1
+        if seq > self.acked:
+            self.acked = seq
+            self.progress.set()
+
+
+class IncomingStream(object):
+    """
+       A stream being received. Iterate over its chunks in order:
+
+           async for chunk in stream: ...
+
+       or collect it with read() / write_to(path, file or writable buffer).
+       The sha256 and size announced by the sender are checked at the end
+       (ValueError on mismatch).
+    """
+
+    def __init__(self, receiver, prefix, stream_id, info):
+        self.receiver = receiver
+        self.prefix = prefix
+        self.id = stream_id
+        self.info = info
+        self.size = info.get('size')
+        self.name = info.get('name')
+        self.meta = info.get('meta')
+        self.chunks = {}
+        self.next_seq = 0
+        self.end = None
+        self.ready = asyncio.Event()
+        self.acked = -1
+
+    def add(self, seq, chunk):
+        if seq >= self.next_seq:
+            self.chunks[seq] = chunk
+            self.ready.set()
+
+    def finish(self, info):
+        self.end = info
+        self.ready.set()
+
+    async def __aiter__(self):
+        digest = hashlib.sha256()
+        received = 0
+        ack_every = max(1, self.info.get('window', DEFAULT_WINDOW) // 2)
+        timeout = self.receiver.timeout / 1000.0
+        try:
+            while True:
+                if self.next_seq in self.chunks:
+                    chunk = self.chunks.pop(self.next_seq)
+                    self.next_seq += 1
+                    digest.update(chunk)
+                    received += len(chunk)
+                    if self.next_seq % ack_every == 0:
+                        self._ack()
+                    yield chunk
+                    continue
+                if self.end is not None and self.next_seq >= self.end['chunks']:
+                    break
+                self.ready.clear()
+                try:
+                    await asyncio.wait_for(self.ready.wait(), timeout)
+                except asyncio.TimeoutError:
+                    raise Exception(f'stream {self.id}: no data for '
+                                    f'{self.receiver.timeout}ms')
+            self._ack()
+        finally:
+            self.receiver.streams.pop((self.prefix, self.id), None)
+
+        if received != self.end['size']:
+            raise ValueError(f'stream {self.id}: received {received} bytes, '
+                             f'expected {self.end["size"]}')
+        if digest.hexdigest() != self.end['sha256']:
+            raise ValueError(f'stream {self.id}: sha256 mismatch')
+
+    def _ack(self):
+        if self.info.get('flow_control') != RECEIVER:
+            return
+        if self.next_seq - 1 > self.acked:
+            self.acked = self.next_seq - 1
+            self.receiver.client.send_message(
+                stream_topic(self.prefix, self.id, 'ack'), {'seq': self.acked})
+
+    async def read(self):
+        buffer = bytearray()
+        async for chunk in self:
+            buffer += chunk
+        return bytes(buffer)
+
+    async def write_to(self, target):
+        """
+        Write the stream to a path, a file object or a writable buffer
+        (bytearray, memoryview or mmap of at least self.size bytes).
+        Returns the number of bytes written.
+        """
+        if isinstance(target, str):
+            with open(target, 'wb') as f:
+                return await self.write_to(f)
+        written = 0
+        if hasattr(target, 'write') and not isinstance(target, mmap.mmap):
+            async for chunk in self:
+                target.write(chunk)
+                written += len(chunk)
+            return written
+        view = memoryview(target).cast('B')
+        async for chunk in self:
+            view[written:written + len(chunk)] = chunk
+            written += len(chunk)
+        return written
+
+
+class StreamReceiver(object):
+    """
+       Receives the streams sent to topic (see StreamSender):
+
+           receiver = client.stream_receiver(topic)
+           async for stream in receiver:
+               await stream.write_to(f'/tmp/{stream.name}')
+    """
+
+    def __init__(self, client, topic, timeout=DEFAULT_STREAM_TIMEOUT,
+                 maxsize=0):
+        self.client = client
+        self.topic = topic
+        self.timeout = timeout
+        self.streams = {}
+        self.queue = asyncio.Queue(maxsize)
+        self.subscribed = None
+
+    def start(self):
+        if self.subscribed is None:
+            self.subscribed = self.client.add_subscription(
+                f'{self.topic}/{STREAM}/{{stream_id}}/{{part}}',
+                self.on_message, raw=True)
+        return self.subscribed
+
+    def stop(self):
+        self.subscribed = None
+        return self.client.remove_subscription(
+            f'{self.topic}/{STREAM}/{{stream_id}}/{{part}}')
+
+    def on_message(self, message, params):
+        prefix = message.topic.rsplit(f'/{STREAM}/', 1)[0]
+        key = (prefix, params['stream_id'])
+        part = params['part']
+        if part == 'start':
+            stream = IncomingStream(self, prefix, key[1], message.payload)
+            self.streams[key] = stream
+            if self.queue.full():
+                self.queue.get_nowait()
+            self.queue.put_nowait(stream)
+        elif part == 'ack':
+            return
+        elif key not in self.streams:
+            # Started before we subscribed
+            return
+        elif part == 'end':
+            self.streams[key].finish(message.payload)
+        else:
+            # Keep a reference to the received bytes, no copy
+            self.streams[key].add(int(part), message.raw)
+
+    async def __aiter__(self):
+        await self.start()
+        while True:
+            yield await self.queue.get()
@@ -0,0 +1,130 @@
+"""Hashed timer wheel driven by an asyncio event loop"""
+
+import asyncio
+import math
+import threading
+
+DEFAULT_RESOLUTION = 10
+DEFAULT_SLOTS = 512
+
+
+def in_loop(loop):
+    """ True if called from the thread currently running loop """
+    try:
+        return asyncio.get_running_loop() is loop
+    except RuntimeError:
+        return False
+
+
+class Timer(object):
+    """ Handle returned by TimerWheel.call_later """
+    __slots__ = ('wheel', 'tick', 'callback', 'args', 'cancelled')
+
+    def __init__(self, wheel, tick, callback, args):
+        self.wheel = wheel
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.wheel.cancel(self)
+
+
+class TimerWheel(object):
+    """
+       Schedules timeouts on a single event loop instead of a thread per
+       timeout. Timers are hashed into slots by their expiry tick, so adding
+       and cancelling is O(1); the loop only wakes up once per tick while
+       timers are pending.
+
+       resolution: tick length (ms)
+       slots: number of slots in the wheel
+    """
+
+    def __init__(self, loop, resolution=DEFAULT_RESOLUTION, slots=DEFAULT_SLOTS):
+        self.loop = loop
+        self.resolution = resolution / 1000.0
+        self.slots = [set() for i in range(slots)]
+        self._base = loop.time()
+        self._tick = 0
+        self._count = 0
+        self._handle = None
+        self._scheduled = False
+        self._lock = threading.Lock()
+
+    @property
+    def pending(self):
+        """ Number of timers that have neither fired nor been cancelled """
+        return self._count
+
+    def call_later(self, timeout, callback, *args):
+        """
+        Call callback(*args) on the loop after timeout ms (thread safe)
+        """
+        with self._lock:
+            now = self.loop.time()
+            if self._count == 0:
+                # Wheel was idle, skip over the empty ticks
+                self._tick = int((now - self._base) / self.resolution)
+            tick = math.ceil((now + timeout / 1000.0 - self._base) / self.resolution)
+            tick = max(tick, self._tick + 1)
+            timer = Timer(self, tick, callback, args)
+            self.slots[tick % len(self.slots)].add(timer)
+            self._count += 1
+            start = not self._scheduled
+            self._scheduled = True
+
+        if start:
+            if in_loop(self.loop):
+                self._schedule()
+            else:
+                self.loop.call_soon_threadsafe(self._schedule)
+        return timer
+
+    def cancel(self, timer):
+        """ Cancel a pending timer (thread safe, no-op if already fired) """
+        with self._lock:
+            if timer.cancelled:
+                return
+            timer.cancelled = True
+            slot = self.slots[timer.tick % len(self.slots)]
+            if timer in slot:
+                slot.remove(timer)
+                self._count -= 1
+
+    def _schedule(self):
+        self._handle = self.loop.call_at(
+            self._base + (self._tick + 1) * self.resolution, self._run)
+
+    def _run(self):
+        expired = []
+        with self._lock:
+            now = self.loop.time()
+            target = int((now - self._base) / self.resolution)
+            n = len(self.slots)
+            # Visiting more than one full turn of the wheel is pointless
+            start = max(self._tick + 1, target - n + 1)
+            for tick in range(start, target + 1):
+                slot = self.slots[tick % n]
+                for timer in [t for t in slot if t.tick <= target]:
+                    slot.remove(timer)
+                    timer.cancelled = True
+                    expired.append(timer)
+            self._tick = max(self._tick, target)
+            self._count -= len(expired)
+            reschedule = self._scheduled = self._count > 0
+
+        for timer in expired:
+            try:
+                timer.callback(*timer.args)
+            except Exception as e:
+                self.loop.call_exception_handler({
+                    'message': 'Exception in timer callback',
+                    'exception': e,
+                })
+
+        if reschedule:
+            self._schedule()
+        else:
+            self._handle = None
@@ -0,0 +1,441 @@
+"""MQTT 3.1.1 client speaking directly on asyncio (no network thread)"""
+
+import asyncio
+import logging
+import struct
+
+from .timers import in_loop
+
+logger = logging.getLogger(__name__)
+
+(CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP, SUBSCRIBE,
+ SUBACK, UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT) = range(1, 15)
+
+# Connection states (same values as paho's mqtt_cs_*)
+cs_new = 0
+cs_connected = 1
+cs_disconnecting = 2
+
+# Return codes (same values as paho's MQTT_ERR_*)
+err_success = 0
+err_no_conn = 4
+err_conn_lost = 7
+
+
+def encode_length(n):
+    out = bytearray()
+    while True:
+        byte = n % 128
+        n //= 128
+        if n:
+            byte |= 0x80
+        out.append(byte)
+        if not n:
+            return bytes(out)
+
+
+def encode_string(s):
+    if isinstance(s, str):
+        s = s.encode('utf-8')
+    return struct.pack('!H', len(s)) + s
+
+
+def decode_string(body, offset):
+    (length,) = struct.unpack_from('!H', body, offset)
+    end = offset + 2 + length
+    return bytes(body[offset + 2:end]).decode('utf-8'), end
+
+
+def fixed_header(packet_type, flags, length):
+    return bytes([packet_type << 4 | flags]) + encode_length(length)
+
+
+def packet(packet_type, flags=0, body=b''):
+    return fixed_header(packet_type, flags, len(body)) + body
+
+
+def to_bytes(payload):
+    """ Convert a publish payload the same way paho does """
+    if payload is None:
+        return b''
+    if isinstance(payload, str):
+        return payload.encode('utf-8')
+    if isinstance(payload, memoryview):
+        return payload.cast('B') if payload.format != 'B' else payload
+    if isinstance(payload, (bytes, bytearray)):
+        return payload
+    if isinstance(payload, (int, float)):
+        return str(payload).encode('ascii')
+    raise TypeError('payload must be a string, bytearray, int, float or None.')
+
+
+class PacketReader(object):
+    """ Splits a byte stream into (packet_type, flags, body) tuples """
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer += data
+        buf = self.buffer
+        size = len(buf)
+        pos = 0
+        packets = []
+
+        while size - pos >= 2:
+            length, multiplier, i = 0, 1, pos + 1
+            while i < size:
+                byte = buf[i]
+                length += (byte & 0x7f) * multiplier
+                multiplier *= 128
+                i += 1
+                if not byte & 0x80:
+                    break
+                if multiplier > 128 ** 4:
+                    raise ValueError('malformed remaining length')
+            else:
+                break
+            if i + length > size:
+                break
+            packets.append((buf[pos] >> 4, buf[pos] & 0x0f,
+                            bytes(buf[i:i + length])))
+            pos = i + length
+
+        if pos:
+            del buf[:pos]
+        return packets
+
+
+class MQTTMessage(object):
+    __slots__ = ('topic', 'payload', 'qos', 'retain', 'mid')
+
+    def __init__(self, topic, payload, qos=0, retain=False, mid=0):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+        self.mid = mid
+
+
+class MQTTProtocol(asyncio.Protocol):
+
+    def __init__(self, client):
+        self.client = client
+        self.reader = PacketReader()
+
+    def connection_made(self, transport):
+        self.client._connection_made(transport)
+
+    def data_received(self, data):
+        for (packet_type, flags, body) in self.reader.feed(data):
+            self.client._handle(packet_type, flags, body)
+
+    def connection_lost(self, exc):
+        self.client._connection_lost(exc)
+
+
+class AsyncioClient(object):
+    """
+       Drop-in replacement for the subset of paho.mqtt.client.Client used
+       by MicropedeClient. Packets are read and written on the given loop,
+       and callbacks are invoked on that loop directly, so no thread hop is
+       needed between receiving, routing and dispatching a message.
+
+       publish / subscribe / unsubscribe should be called from the loop
+       (MicropedeClient already does so).
+
+       Like paho's loop_start, a lost (or failed) connection is retried
+       with an exponential backoff between min_delay and max_delay
+       seconds (see reconnect_delay_set) until disconnect is called. A
+       connection is considered lost when a PINGREQ gets no PINGRESP
+       within keepalive seconds. QoS > 0 publishes not acknowledged when
+       the connection was lost are sent again (with DUP set) after the
+       next CONNACK.
+
+       Exceptions raised by callbacks are passed to the loop's exception
+       handler, the connection keeps reading.
+    """
+
+    def __init__(self, client_id, loop, keepalive=60, clean_session=True):
+        self.client_id = client_id
+        self.loop = loop
+        self.keepalive = keepalive
+        self.clean_session = clean_session
+        self.host = None
+        self.port = None
+
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_message = None
+        self.on_publish = None
+        self.on_subscribe = None
+        self.on_unsubscribe = None
+
+        self._state = cs_new
+        self._transport = None
+        self._mid = 0
+        # mid: (qos, topic, payload, retain) of unacknowledged publishes
+        self._outgoing = {}
+        self._incoming_qos2 = set()
+        self._ping_handle = None
+        self._ping_pending = False
+
+        self._min_delay = 1
+        self._max_delay = 120
+        self._reconnect_delay = None
+        self._reconnect_handle = None
+        self._will = None
+
+    def _callback(self, name, *args):
+        callback = getattr(self, name)
+        if callback is None:
+            return
+        try:
+            callback(self, None, *args)
+        except Exception as e:
+            self.loop.call_exception_handler({
+                'message': f'AsyncioClient {name} callback failed',
+                'exception': e,
+            })
+
+    def _next_mid(self):
+        self._mid = self._mid % 65535 + 1
+        while self._mid in self._outgoing:
+            # Still waiting to be acknowledged
+            self._mid = self._mid % 65535 + 1
+        return self._mid
+
+    def _write(self, *chunks):
+        if self._transport is not None:
+            self._transport.writelines(chunks)
+
+    # paho compatible API
+
+    def will_set(self, topic, payload=None, qos=0, retain=False):
+        """ Message the broker publishes if the connection is lost """
+        self._will = (topic, to_bytes(payload), qos, retain)
+
+    def connect(self, host, port=1883, keepalive=None):
+        self.host = host
+        self.port = port
+        if keepalive is not None:
+            self.keepalive = keepalive
+        if in_loop(self.loop):
+            self.loop.create_task(self._open())
+        else:
+            asyncio.run_coroutine_threadsafe(self._open(), self.loop)
+        return err_success
+
+    def reconnect_delay_set(self, min_delay=1, max_delay=120):
+        self._min_delay = min_delay
+        self._max_delay = max_delay
+
+    def loop_start(self):
+        # Packets are handled by the event loop, there is no thread to start
+        return err_success
+
+    def loop_stop(self, force=False):
+        return err_success
+
+    def is_connected(self):
+        return self._state == cs_connected
+
+    def pause_reading(self):
+        if self._transport is not None and self._transport.is_reading():
+            self._transport.pause_reading()
+
+    def resume_reading(self):
+        if self._transport is not None and not self._transport.is_reading():
+            self._transport.resume_reading()
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        mid = self._next_mid()
+        if self._state != cs_connected:
+            return (err_no_conn, mid)
+
+        payload = to_bytes(payload)
+        if qos > 0:
+            self._outgoing[mid] = (qos, topic, payload, retain)
+        self._send_publish(mid, topic, payload, qos, retain)
+        if qos == 0:
+            # Like paho, QoS 0 messages count as published once written
+            self.loop.call_soon(self._callback, 'on_publish', mid)
+        return (err_success, mid)
+
+    def _send_publish(self, mid, topic, payload, qos, retain, dup=False):
+        variable = encode_string(topic)
+        if qos > 0:
+            variable += struct.pack('!H', mid)
+        flags = qos << 1 | (1 if retain else 0) | (0x08 if dup else 0)
+        self._write(fixed_header(PUBLISH, flags, len(variable) + len(payload)),
+                    variable, payload)
+
+    def subscribe(self, topic, qos=0):
+        if isinstance(topic, str):
+            topics = [(topic, qos)]
+        elif isinstance(topic, tuple):
+            topics = [topic]
+        else:
+            topics = list(topic)
+        mid = self._next_mid()
+        if self._state != cs_connected:
+            return (err_no_conn, mid)
+        body = struct.pack('!H', mid) + b''.join(
+            encode_string(sub) + bytes([q]) for sub, q in topics)
+        self._write(packet(SUBSCRIBE, 0x2, body))
+        return (err_success, mid)
+
+    def unsubscribe(self, topic):
+        topics = [topic] if isinstance(topic, str) else list(topic)
+        mid = self._next_mid()
+        if self._state != cs_connected:
+            return (err_no_conn, mid)
+        body = struct.pack('!H', mid) + b''.join(map(encode_string, topics))
+        self._write(packet(UNSUBSCRIBE, 0x2, body))
+        return (err_success, mid)
+
+    def disconnect(self):
+        if self._reconnect_handle is not None:
+            self._reconnect_handle.cancel()
+            self._reconnect_handle = None
+        if self._transport is None:
+            self._state = cs_disconnecting
+            return err_no_conn
+
+        def _disconnect():
+            self._state = cs_disconnecting
+            self._write(packet(DISCONNECT))
+            self._transport.close()
+
+        if in_loop(self.loop):
+            _disconnect()
+        else:
+            self.loop.call_soon_threadsafe(_disconnect)
+        return err_success
+
+    # Connection handling
+
+    async def _open(self):
+        try:
+            await self.loop.create_connection(
+                lambda: MQTTProtocol(self), self.host, self.port)
+        except OSError as e:
+            logger.warning('Failed to connect to %s:%s: %s',
+                           self.host, self.port, e)
+            self._schedule_reconnect()
+
+    def _schedule_reconnect(self):
+        if self._state == cs_disconnecting or self._reconnect_handle:
+            return
+        if self._reconnect_delay is None:
+            self._reconnect_delay = self._min_delay
+        else:
+            self._reconnect_delay = min(self._reconnect_delay * 2,
+                                        self._max_delay)
+        self._reconnect_handle = self.loop.call_later(
+            self._reconnect_delay, self._reconnect)
+
+    def _reconnect(self):
+        self._reconnect_handle = None
+        self.loop.create_task(self._open())
+
+    def _connection_made(self, transport):
+        self._transport = transport
+        flags = 0x02 if self.clean_session else 0x00
+        will = b''
+        if self._will is not None:
+            (topic, payload, qos, retain) = self._will
+            flags |= 0x04 | qos << 3 | (0x20 if retain else 0)
+            will = (encode_string(topic) + struct.pack('!H', len(payload)) +
+                    bytes(payload))
+        body = (encode_string('MQTT') + bytes([4, flags]) +
+                struct.pack('!H', self.keepalive) +
+                encode_string(self.client_id) + will)
+        self._write(packet(CONNECT, 0, body))
+
+    def _connection_lost(self, exc):
+        rc = err_success if self._state == cs_disconnecting else err_conn_lost
+        self._state = cs_new
+        self._transport = None
+        if rc == err_success:
+            self._outgoing.clear()
+        # Otherwise unacknowledged publishes are sent again on reconnect
+        self._incoming_qos2.clear()
+        if self._ping_handle is not None:
+            self._ping_handle.cancel()
+            self._ping_handle = None
+        self._callback('on_disconnect', rc)
+        if rc != err_success:
+            self._schedule_reconnect()
+
+    def _ping(self):
+        if self._ping_pending:
+            # No PINGRESP within keepalive: the connection is half-open
+            logger.warning('No PINGRESP from %s:%s, closing the connection',
+                           self.host, self.port)
+            self._ping_handle = None
+            if self._transport is not None:
+                self._transport.abort()
+            return
+        self._ping_pending = True
+        self._write(packet(PINGREQ))
+        self._ping_handle = self.loop.call_later(self.keepalive, self._ping)
+
+    def _resend_outgoing(self):
+        for mid, (qos, topic, payload, retain) in list(self._outgoing.items()):
+            self._send_publish(mid, topic, payload, qos, retain, dup=True)
+
+    # Incoming packets
+
+    def _handle(self, packet_type, flags, body):
+        if packet_type == PUBLISH:
+            self._handle_publish(flags, body)
+        elif packet_type == PUBACK or packet_type == PUBCOMP:
+            (mid,) = struct.unpack_from('!H', body)
+            if self._outgoing.pop(mid, None) is not None:
+                self._callback('on_publish', mid)
+        elif packet_type == PUBREC:
+            self._write(packet(PUBREL, 0x2, body[:2]))
+        elif packet_type == PUBREL:
+            (mid,) = struct.unpack_from('!H', body)
+            self._incoming_qos2.discard(mid)
+            self._write(packet(PUBCOMP, 0, body[:2]))
+        elif packet_type == SUBACK:
+            (mid,) = struct.unpack_from('!H', body)
+            self._callback('on_subscribe', mid, tuple(body[2:]))
+        elif packet_type == UNSUBACK:
+            (mid,) = struct.unpack_from('!H', body)
+            self._callback('on_unsubscribe', mid)
+        elif packet_type == PINGRESP:
+            self._ping_pending = False
+        elif packet_type == CONNACK:
+            rc = body[1]
+            if rc == 0:
+                self._state = cs_connected
+                self._reconnect_delay = None
+                self._ping_pending = False
+                self._resend_outgoing()
+                if self.keepalive:
+                    self._ping_handle = self.loop.call_later(
+                        self.keepalive, self._ping)
+            self._callback('on_connect', {'session present': body[0] & 1}, rc)
+
+    def _handle_publish(self, flags, body):
+        qos = (flags >> 1) & 0x3
+        topic, offset = decode_string(body, 0)
+        mid = 0
+        if qos > 0:
+            (mid,) = struct.unpack_from('!H', body, offset)
+            offset += 2
+            if qos == 1:
+                self._write(packet(PUBACK, 0, body[offset - 2:offset]))
+            else:
+                self._write(packet(PUBREC, 0, body[offset - 2:offset]))
+                if mid in self._incoming_qos2:
+                    # Duplicate delivery of a message we already received
+                    return
+                self._incoming_qos2.add(mid)
+
+        message = MQTTMessage(topic, memoryview(body)[offset:], qos,
+                              bool(flags & 0x1), mid)
+        self._callback('on_message', message)
@@ -0,0 +1,152 @@
+"""Share a plugin's trigger and put handlers between several processes"""
+
+import asyncio
+import uuid
+import zlib
+
+AUTO = 'auto'
+SHARED = 'shared'
+HASH = 'hash'
+
+DEFAULT_PROBE_TIMEOUT = 1000
+
+
+class WorkerGroup(object):
+    """
+       Lets several processes run the same plugin name, each trigger and
+       put being handled by exactly one of them.
+
+       shared: handlers subscribe through an MQTT shared subscription
+       ($share/{group}/{filter}), so the broker picks a worker per message.
+
+       hash: every worker receives every request and only handles the
+       ones that hash (crc32 of topic and payload) to its position among
+       the live workers. Workers announce themselves with a retained
+       message on {app}/{name}/workers/{worker_id}, cleared on disconnect
+       or, for crashed workers, by their will (brokers without wills leave
+       dead workers in the group). While workers join or leave, a request
+       can briefly be handled twice or not at all.
+
+       auto: use shared subscriptions if a probe message published through
+       one comes back within probe_timeout (ms), otherwise hash.
+
+       Only channels subscribed with on_trigger_msg and on_put_msg are
+       balanced; the default triggers (ping, exit, ...) still reach every
+       worker. Replies go out on the usual notify topic.
+    """
+
+    def __init__(self, client, group=None, mode=AUTO,
+                 probe_timeout=DEFAULT_PROBE_TIMEOUT):
+        self.client = client
+        self.group = group or client.name
+        self.mode = None if mode == AUTO else mode
+        self.probe_timeout = probe_timeout
+        self.id = uuid.uuid4().hex[:12]
+        self.prefix = f'{client.app_name}/{client.name}/workers'
+        self.members = set()
+        self.balanced = set()
+        self.handled = 0
+        self.skipped = 0
+        # Set while a put batch owned by this worker is applied
+        self.forced = False
+
+    @property
+    def presence_topic(self):
+        return f'{self.prefix}/{self.id}'
+
+    def will(self):
+        """ (topic, payload, qos, retain) removing this worker on a crash """
+        return (self.presence_topic, b'', 1, True)
+
+    def subscription(self, sub):
+        """ Filter to subscribe for a balanced route filter """
+        if self.mode == SHARED:
+            return f'$share/{self.group}/{sub}'
+        return sub
+
+    def wrap(self, handler):
+        """ Route handler only called for the messages this worker owns """
+        if self.mode != HASH:
+            return handler
+
+        def _handler(message, params):
+            if self.forced or self.owns(message):
+                self.handled += 1
+                return handler(message, params)
+            self.skipped += 1
+        return _handler
+
+    def owns(self, message):
+        members = sorted(self.members | {self.id})
+        key = zlib.crc32(message.raw, zlib.crc32(message.topic.encode()))
+        return members[key % len(members)] == self.id
+
+    def join(self):
+        """ Pick the mode if needed and announce this worker """
+        future = asyncio.Future(loop=self.client.loop)
+
+        def on_mode(f):
+            if self.mode is None:
+                self.mode = SHARED if f.result() else HASH
+            if self.mode == HASH:
+                self.client.add_subscription(
+                    f'{self.prefix}/{{worker_id}}', self.on_presence, raw=True)
+                self.announce()
+            future.set_result(self.mode)
+
+        if self.mode is None:
+            self.probe().add_done_callback(on_mode)
+        else:
+            on_mode(None)
+        return future
+
+    def announce(self):
+        if self.mode == HASH:
+            return self.client.send_message(
+                self.presence_topic, {'id': self.id, 'group': self.group},
+                retain=True, qos=1)
+
+    def leave(self):
+        """ Remove this worker before a clean disconnect """
+        if self.mode == HASH:
+            return self.client.send_message(self.presence_topic, b'',
+                                            retain=True, qos=1)
+
+    def on_presence(self, message, params):
+        worker_id = params['worker_id']
+        if len(message.raw) == 0:
+            self.members.discard(worker_id)
+        else:
+            self.members.add(worker_id)
+
+    def probe(self):
+        """ Resolves to True if the broker supports shared subscriptions """
+        client = self.client
+        result = asyncio.Future(loop=client.loop)
+        topic = f'{self.prefix}/probe/{self.id}'
+
+        def done(supported):
+            if result.done():
+                return
+            result.set_result(supported)
+            client.router.remove_route(topic)
+            client.client.unsubscribe(f'$share/{self.group}/{topic}')
+
+        def on_subscribed(f):
+            if f.exception() is not None:
+                # e.g. 0x80 in the SUBACK
+                done(False)
+            else:
+                client.send_message(topic, b'probe')
+
+        client.router.add_route(topic, lambda message, params: done(True))
+        subscribed = asyncio.Future(loop=client.loop)
+        subscribed.add_done_callback(on_subscribed)
+        client._subscribe([f'$share/{self.group}/{topic}'], [subscribed])
+        client.set_timeout(lambda: done(False), self.probe_timeout, result)
+        return result
+
+    def info(self):
+        return {'group': self.group, 'mode': self.mode, 'worker_id': self.id,
+                'workers': len(self.members | {self.id}),
+                'handled': self.handled, 'skipped': self.skipped}
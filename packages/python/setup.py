@@ -9,5 +9,5 @@ setup(name='micropede',
       author_email='lucas@sci-bots.com',
       url='http://sci-bots.com',
       packages=['micropede'],
-      install_requires=['paho-mqtt', 'wheezy.routing', 'onoff', 'jsonschema']
+      install_requires=['paho-mqtt', 'onoff', 'jsonschema']
 )
@@ -0,0 +1,64 @@
+import asyncio
+import importlib
+
+micropede_async = importlib.import_module('micropede.async')
+
+PING = {'sender': 'p', 'action': 'ping'}
+
+
+def channel():
+    """ A MicropedeAsync holding only the pending requests of persistent mode """
+    rpc = micropede_async.MicropedeAsync.__new__(micropede_async.MicropedeAsync)
+    rpc._pending = {}
+    return rpc
+
+
+def request(loop, rpc, request_id, receiver='p', action='ping'):
+    future = loop.create_future()
+    rpc._pending[request_id] = (future, receiver, action, request_id)
+    return future
+
+
+def reply(request_id=None, **payload):
+    payload['status'] = 'success'
+    if request_id is not None:
+        payload['__head__'] = {'request_id': request_id}
+    return payload
+
+
+def test_replies_resolve_their_own_request():
+    loop = asyncio.new_event_loop()
+    rpc = channel()
+    a = request(loop, rpc, 'a')
+    b = request(loop, rpc, 'b')
+    rpc._on_reply(reply('b', value=2), PING)
+    assert b.result()['value'] == 2
+    assert not a.done()
+    assert list(rpc._pending) == ['a']
+    loop.close()
+
+
+def test_late_reply_does_not_resolve_another_request():
+    loop = asyncio.new_event_loop()
+    rpc = channel()
+    # 'a' timed out and was forgotten; its reply arrives while 'b' waits
+    b = request(loop, rpc, 'b')
+    rpc._on_reply(reply('a', value=1), PING)
+    assert not b.done()
+    assert list(rpc._pending) == ['b']
+    loop.close()
+
+
+def test_replies_without_request_id_resolve_the_oldest_match():
+    loop = asyncio.new_event_loop()
+    rpc = channel()
+    other = request(loop, rpc, 'other', action='pong')
+    a = request(loop, rpc, 'a')
+    b = request(loop, rpc, 'b')
+    rpc._on_reply(reply(value=1), PING)
+    assert a.result()['value'] == 1
+    assert not b.done() and not other.done()
+    # No pending request for this receiver / action
+    rpc._on_reply(reply(), {'sender': 'q', 'action': 'ping'})
+    assert list(rpc._pending) == ['other', 'b']
+    loop.close()
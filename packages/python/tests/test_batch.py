@@ -0,0 +1,111 @@
+import asyncio
+
+from micropede.batch import BATCH, PutBatch
+from micropede.client import MicropedeClient
+from micropede.coalesce import PublishCoalescer
+from micropede.delta import DeltaPublisher
+from micropede.router import TopicRouter
+from micropede.timers import TimerWheel
+
+
+def plugin(loop):
+    """ A MicropedeClient named p that records what it sends """
+    client = MicropedeClient.__new__(MicropedeClient)
+    client.loop = loop
+    client.app_name = 'app'
+    client.name = 'p'
+    client._head = {'plugin_name': 'p', 'plugin_version': '0.0.0'}
+    client._state_prefix = 'app/p/state/'
+    client._notify_prefix = 'app/p/notify/'
+    client.schema = {}
+    client._schema_validators = {}
+    client.router = TopicRouter()
+    client.metrics = None
+    client.workers = None
+    client.timers = TimerWheel(loop)
+    client.deltas = DeltaPublisher(client)
+    client.coalescer = PublishCoalescer(client)
+    client._state_hold = None
+    client._put_batches = {}
+    client.sent = []
+
+    def send_message(topic, msg={}, retain=False, *args, **kwargs):
+        client.sent.append((topic, msg))
+        future = loop.create_future()
+        future.set_result('done')
+        return future
+    client.send_message = send_message
+    return client
+
+
+def on_put(client, prop, handler):
+    client.router.add_route(f'app/put/p/{prop}', client.wrap_handler(handler))
+
+
+def batch(client, puts):
+    payload = {'puts': puts, '__head__': {'plugin_name': 'caller'}}
+    return client.loop.run_until_complete(PutBatch(client, payload).apply())
+
+
+def test_batch_publishes_each_state_once_and_replies_once():
+    loop = asyncio.new_event_loop()
+    client = plugin(loop)
+
+    def put(prop):
+        async def _put(payload, params):
+            await client.set_state(prop, payload[prop])
+            await client.set_state('summary', {prop: payload[prop]})
+            return client.notify_sender(payload, payload[prop], prop)
+        return _put
+    on_put(client, 'voltage', put('voltage'))
+    on_put(client, 'frequency', put('frequency'))
+
+    results = batch(client, {'voltage': {'voltage': 10},
+                             'frequency': {'frequency': 100}})
+    assert results == {
+        'voltage': {'status': 'success', 'response': 10},
+        'frequency': {'status': 'success', 'response': 100}}
+    # One publish per property, with its newest value, then one reply
+    assert client.sent == [
+        ('app/p/state/voltage', 10),
+        ('app/p/state/summary', {'frequency': 100}),
+        ('app/p/state/frequency', 100),
+        ('app/p/notify/caller/__batch__', {
+            'status': 'success', 'response': results,
+            '__head__': client._head}),
+    ]
+    assert client._state_hold is None
+    assert client._put_batches == {}
+    loop.close()
+
+
+def test_failures_are_reported_per_property():
+    loop = asyncio.new_event_loop()
+    client = plugin(loop)
+
+    def fails(payload, params):
+        raise ValueError('out of range')
+
+    def no_reply(payload, params):
+        pass
+    on_put(client, 'voltage', fails)
+    on_put(client, 'frequency', no_reply)
+
+    results = batch(client, {'voltage': {'voltage': -1},
+                             'frequency': {'frequency': 100},
+                             'missing': {'missing': 1},
+                             BATCH: {}})
+    assert results['voltage'] == {'status': 'failed',
+                                  'response': ['out of range']}
+    assert results['frequency'] == {'status': 'success', 'response': None}
+    assert results['missing']['status'] == 'failed'
+    assert results[BATCH]['status'] == 'failed'
+    loop.close()
+
+
+def test_puts_must_be_a_dict():
+    loop = asyncio.new_event_loop()
+    client = plugin(loop)
+    results = batch(client, ['voltage'])
+    assert results[BATCH]['status'] == 'failed'
+    loop.close()
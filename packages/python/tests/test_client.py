@@ -0,0 +1,209 @@
+import asyncio
+import collections
+import threading
+
+import pydash
+
+from micropede.client import MicropedeClient, mqtt_cs_connected, noop
+from micropede.router import TopicRouter
+from micropede.timers import TimerWheel
+
+
+class FakeMQTT(object):
+    """ Records publishes and subscribes, like paho's methods """
+
+    def __init__(self):
+        self._state = mqtt_cs_connected
+        self.published = []
+        self.subscribed = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published.append(topic)
+        return (0, len(self.published))
+
+    def subscribe(self, topics):
+        self.subscribed.append([topic for topic, qos in topics])
+        return (0, len(self.subscribed))
+
+
+def client(loop, max_inflight=100, max_backlog=100):
+    """ A MicropedeClient with only its publishing state (no connection) """
+    client = MicropedeClient.__new__(MicropedeClient)
+    client.loop = loop
+    client.client = FakeMQTT()
+    client._paho = False
+    client.metrics = None
+    client.outbox = None
+    client.timers = TimerWheel(loop)
+    client.max_inflight = max_inflight
+    client.max_backlog = max_backlog
+    client._inflight = {}
+    client._reserved = set()
+    client._backlog = collections.deque()
+    client._inflight_lock = threading.Lock()
+    client.router = TopicRouter()
+    client.workers = None
+    client.subscriptions = {}
+    client._sub_batch = None
+    client._subacks = {}
+    client._executors = {}
+    client._blocked_executors = set()
+    return client
+
+
+def settle(loop):
+    loop.run_until_complete(asyncio.sleep(0.01))
+
+
+def send_from_thread(client, topics):
+    futures = []
+
+    def send():
+        for topic in topics:
+            future = asyncio.Future(loop=client.loop)
+            futures.append(
+                client._send_encoded(topic, b'{}', 1, False, future))
+    thread = threading.Thread(target=send)
+    thread.start()
+    thread.join()
+    return futures
+
+
+def test_inflight_window_holds_for_other_threads():
+    loop = asyncio.new_event_loop()
+    c = client(loop, max_inflight=2)
+    futures = send_from_thread(c, ['a', 'b', 'c', 'd', 'e'])
+    # The slots are taken before the loop publishes anything
+    assert len(c._reserved) == 2
+    assert len(c._backlog) == 3
+    settle(loop)
+    assert c.client.published == ['a', 'b']
+
+    # Each ack lets the next message of the backlog go, in order
+    c._on_publish(None, None, 1)
+    settle(loop)
+    assert futures[0].result() == 'done'
+    assert c.client.published == ['a', 'b', 'c']
+    c._on_publish(None, None, 2)
+    c._on_publish(None, None, 3)
+    settle(loop)
+    assert c.client.published == ['a', 'b', 'c', 'd', 'e']
+    assert len(c._reserved) == 2
+    assert not c._backlog
+    loop.close()
+
+
+def test_full_backlog_fails_the_send():
+    loop = asyncio.new_event_loop()
+    c = client(loop, max_inflight=1, max_backlog=1)
+    futures = send_from_thread(c, ['a', 'b', 'c'])
+    settle(loop)
+    assert c.client.published == ['a']
+    assert not futures[1].done()
+    assert 'backlog full' in str(futures[2].exception())
+    loop.close()
+
+
+def plugin(schema):
+    """ A MicropedeClient with only its schema (no connection) """
+    client = MicropedeClient.__new__(MicropedeClient)
+    client.name = 'plugin'
+    client.schema = schema
+    client._schema_validators = {}
+    client.replies = []
+    client.notify_sender = lambda payload, response, endpoint, status: (
+        client.replies.append((endpoint, status)))
+    return client
+
+
+SCHEMA = {'properties': {'voltage': {'type': 'number', 'minimum': 0}}}
+
+
+def test_validated_put_rejects_invalid_values():
+    client = plugin(SCHEMA)
+    calls = []
+    handler = client.validated('voltage', lambda payload, params: (
+        calls.append(payload)))
+    head = {'plugin_name': 'caller'}
+    handler({'voltage': 10, '__head__': head}, {})
+    handler({'voltage': -1, '__head__': head}, {})
+    assert [payload['voltage'] for payload in calls] == [10]
+    assert client.replies == [('voltage', 'failed')]
+
+
+def test_validated_put_without_payload_is_not_replied_to():
+    client = plugin(SCHEMA)
+    calls = []
+    handler = client.validated('voltage', lambda payload, params: (
+        calls.append(payload)))
+    for payload in (None, [1], 'voltage'):
+        assert 'put payload must be an object' in str(handler(payload, {}))
+    assert calls == []
+    assert client.replies == []
+
+
+def test_validators_are_cached_per_schema_object():
+    client = plugin(SCHEMA)
+    validator = client.get_validator('voltage')
+    assert client.get_validator('voltage') is validator
+    # Replacing the schema rebuilds its validators
+    client.schema = {'properties': {'voltage': {'type': 'string'}}}
+    assert client.get_validator('voltage') is not validator
+    client.validate_put('voltage', {'voltage': 'high'})
+    # Modified in place, the schema must be invalidated
+    client.schema['properties']['voltage'] = {'type': 'number'}
+    client.invalidate_schema()
+    client.validate_put('voltage', {'voltage': 1})
+
+
+def test_nested_subscription_batches_send_one_subscribe():
+    loop = asyncio.new_event_loop()
+    c = client(loop)
+    handler = lambda payload, params: None
+    with c.batch_subscriptions():
+        c.add_subscriptions([('app/{sender}/state/a', handler),
+                             ('app/{sender}/state/b', handler)])
+        with c.batch_subscriptions():
+            c.add_subscription('app/+/state/a', handler)
+            c.add_subscription('app/trigger/p/ping', handler)
+        assert c.client.subscribed == []
+    loop.run_until_complete(asyncio.sleep(0))
+    assert c.client.subscribed == [
+        ['app/+/state/a', 'app/+/state/b', 'app/trigger/p/ping']]
+    assert list(c.subscriptions) == c.client.subscribed[0]
+    loop.close()
+
+
+def test_executor_options_per_subscription():
+    loop = asyncio.new_event_loop()
+    c = client(loop)
+    handler = lambda payload, params: None
+    c.add_subscription('a/b', handler, executor='thread')
+    c.add_subscription('a/c', handler, executor='thread',
+                       executor_options={'max_queue': 1, 'overflow': 'block'})
+    c.add_subscription('a/d', handler, executor='thread',
+                       executor_options={'overflow': 'block', 'max_queue': 1})
+    (default, blocking) = c._executors.values()
+    assert (default.max_queue, default.overflow) == (100, 'drop-oldest')
+    assert (blocking.max_queue, blocking.overflow) == (1, 'block')
+
+    # Lambdas cannot be sent to a process pool
+    f = c.add_subscription('a/e', handler, executor='process')
+    assert 'picklable' in str(f.exception())
+    c._shutdown_executors()
+    loop.close()
+
+
+def test_is_plugin():
+    c = MicropedeClient.__new__(MicropedeClient)
+    for listen, is_plugin in [(noop, False), (pydash.noop, False),
+                              (lambda: None, True)]:
+        c.listen = listen
+        assert c.is_plugin == is_plugin
+
+    # Any other function named noop is still a listener
+    def listen():
+        pass
+    listen.__name__ = 'noop'
+    c.listen = listen
+    assert c.is_plugin
@@ -0,0 +1,46 @@
+import json
+
+import pytest
+
+from micropede import codecs
+
+
+def test_json_is_the_default():
+    assert codecs.get_codec().content_type == codecs.JSON
+    assert codecs.get_codec('text/unknown').content_type == codecs.JSON
+    assert codecs.detect_codec(b'').content_type == codecs.JSON
+    assert codecs.decode(b'{"a": [1, 2]}') == {'a': [1, 2]}
+
+
+@pytest.mark.parametrize('value', [{'a': 1}, [1, 2], {}, list(range(20)),
+                                   {str(i): i for i in range(20)}])
+def test_msgpack_payloads_are_sniffed(value):
+    pytest.importorskip('msgpack')
+    raw = codecs.encode(value, codecs.MSGPACK)
+    assert codecs.detect_codec(raw).content_type == codecs.MSGPACK
+    assert codecs.decode(raw) == value
+
+
+@pytest.mark.parametrize('value', ['text', 5, 1.5, True, None])
+def test_scalars_are_always_json(value):
+    raw = codecs.encode(value, codecs.MSGPACK)
+    assert raw == codecs.encode(value, codecs.JSON)
+    assert json.loads(raw) == value
+
+
+def test_bytes_are_sent_as_is():
+    assert codecs.encode(b'\x00raw', codecs.MSGPACK) == b'\x00raw'
+
+
+def test_message_decodes_on_first_access():
+    message = codecs.Message('a/b', b'{"a": 1}')
+    assert not message._decoded
+    assert message.content_type == codecs.JSON
+    assert message.payload == {'a': 1}
+    assert message._decoded
+    assert bytes(message.raw) == b'{"a": 1}'
+
+
+def test_invalid_payload_decodes_to_none(capsys):
+    assert codecs.Message('a/b', b'{not json').payload is None
+    assert 'a/b' in capsys.readouterr().out
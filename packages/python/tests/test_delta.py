@@ -0,0 +1,115 @@
+import copy
+
+from micropede import codecs
+from micropede.delta import DeltaPublisher, DeltaReceiver
+
+TOPIC = 'app/p/state/steps'
+
+
+class FakeClient(object):
+    """ Records sent messages; timers never fire """
+
+    def __init__(self):
+        self.sent = []
+
+    def send_message(self, topic, msg={}, retain=False, *args):
+        self.sent.append(codecs.Message(topic, codecs.encode(msg), 0, retain))
+
+    def set_timeout(self, callback, timeout):
+        pass
+
+
+def pair(snapshot_every=50):
+    publisher = DeltaPublisher(FakeClient())
+    publisher.configure(TOPIC, snapshot_every)
+    values = []
+    receiver_client = FakeClient()
+    # Later deltas are applied to the value the handler was given
+    receiver = DeltaReceiver(receiver_client, lambda value, params: (
+        values.append(copy.deepcopy(value))))
+    return publisher, receiver, receiver_client, values
+
+
+def deliver(receiver, message):
+    handler = (receiver.on_delta if message.topic.endswith('/delta')
+               else receiver.on_snapshot)
+    handler(message, {})
+
+
+def publish(publisher, value):
+    publisher.publish(TOPIC, value)
+    return publisher.client.sent.pop()
+
+
+def without_head(value):
+    return {k: v for k, v in value.items() if k != '__head__'}
+
+
+def test_deltas_rebuild_the_published_values():
+    publisher, receiver, client, values = pair(snapshot_every=3)
+    messages = [publish(publisher, {'steps': list(range(i))})
+                for i in range(6)]
+    assert [m.topic for m in messages] == [
+        TOPIC] + [TOPIC + '/delta'] * 3 + [TOPIC] + [TOPIC + '/delta']
+    for message in messages:
+        deliver(receiver, message)
+    assert [without_head(v) for v in values] == [
+        {'steps': list(range(i))} for i in range(6)]
+    assert client.sent == []
+
+
+def test_gap_asks_for_a_snapshot_and_resumes():
+    publisher, receiver, client, values = pair()
+    deliver(receiver, publish(publisher, {'a': 0}))
+    publish(publisher, {'a': 1})  # lost
+    deliver(receiver, publish(publisher, {'a': 2}))
+    assert len(values) == 1
+    (resync,) = client.sent
+    assert resync.topic == 'app/trigger/p/resync-state'
+    assert resync.payload['key'] == 'steps'
+
+    # A second gap while waiting does not ask again
+    deliver(receiver, publish(publisher, {'a': 3}))
+    assert len(client.sent) == 1
+
+    # The snapshot answering the resync
+    publisher.snapshot(TOPIC)
+    deliver(receiver, publisher.client.sent.pop())
+    deliver(receiver, publish(publisher, {'a': 4}))
+    assert [v['a'] for v in values] == [0, 3, 4]
+    assert not receiver.resyncing
+
+
+def test_delta_before_any_snapshot_asks_for_one():
+    publisher, receiver, client, values = pair()
+    publish(publisher, {'a': 0})
+    deliver(receiver, publish(publisher, {'a': 1}))
+    assert values == []
+    assert [m.topic for m in client.sent] == ['app/trigger/p/resync-state']
+
+
+def test_restarted_publisher_asks_for_a_snapshot():
+    publisher, receiver, client, values = pair()
+    deliver(receiver, publish(publisher, {'a': 0}))
+    restarted = DeltaPublisher(FakeClient())
+    restarted.configure(TOPIC)
+    restarted.values[TOPIC] = {'a': 0}
+    restarted.since_snapshot[TOPIC] = 0
+    restarted.seqs[TOPIC] = 1
+    deliver(receiver, publish(restarted, {'a': 1}))
+    assert len(values) == 1
+    assert [m.topic for m in client.sent] == ['app/trigger/p/resync-state']
+
+
+def test_older_snapshot_is_ignored_and_empty_one_clears():
+    publisher, receiver, client, values = pair()
+    snapshot = publish(publisher, {'a': 0})
+    deliver(receiver, snapshot)
+    deliver(receiver, publish(publisher, {'a': 1}))
+    # e.g. the retained snapshot re-sent after a resubscribe
+    deliver(receiver, snapshot)
+    assert [v['a'] for v in values] == [0, 1]
+
+    deliver(receiver, codecs.Message(TOPIC, b'', 0, True))
+    assert values[-1] is None
+    assert TOPIC not in receiver.states
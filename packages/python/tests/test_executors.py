@@ -0,0 +1,57 @@
+import asyncio
+import threading
+
+import pytest
+
+from micropede.executors import (BLOCK, DROP_NEWEST, DROP_OLDEST, PROCESS,
+                                 HandlerExecutor)
+
+
+def module_level_handler(payload, params):
+    return payload
+
+
+def run(loop, executor, calls):
+    """ Submit calls while the single worker is busy, then let it go """
+    release = threading.Event()
+    handled = []
+    executor.loop = loop
+    executor.submit(lambda: release.wait(1))
+    for value in calls:
+        executor.submit(handled.append, value)
+    release.set()
+    loop.run_until_complete(asyncio.sleep(0.05))
+    return handled
+
+
+@pytest.mark.parametrize('overflow, max_queue, handled', [
+    (DROP_OLDEST, 2, [2, 3]),
+    (DROP_NEWEST, 2, [0, 1]),
+    (BLOCK, 2, [0, 1, 2, 3]),
+    # Nothing queued to drop, so the new call goes
+    (DROP_OLDEST, 0, []),
+    (DROP_NEWEST, 0, []),
+])
+def test_overflow(overflow, max_queue, handled):
+    loop = asyncio.new_event_loop()
+    executor = HandlerExecutor(max_workers=1, max_queue=max_queue,
+                               overflow=overflow)
+    assert run(loop, executor, range(4)) == handled
+    assert executor.counters['dropped'] == 4 - len(handled)
+    executor.shutdown()
+    loop.close()
+
+
+def test_process_handlers_must_be_picklable():
+    executor = HandlerExecutor(PROCESS, max_workers=1)
+    executor.check(module_level_handler)
+    with pytest.raises(ValueError, match='picklable'):
+        executor.check(lambda payload, params: None)
+    executor.shutdown()
+
+
+def test_invalid_options():
+    with pytest.raises(ValueError):
+        HandlerExecutor('fiber')
+    with pytest.raises(ValueError):
+        HandlerExecutor(overflow='drop-all')
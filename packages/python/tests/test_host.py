@@ -0,0 +1,68 @@
+import asyncio
+
+from micropede.host import HostedSession, PluginHost
+from micropede.router import TopicRouter
+from micropede.transport import cs_connected, cs_new
+
+
+class FakeConnection(object):
+    """ The host's shared connection, recording publishes """
+
+    def __init__(self):
+        self._state = cs_new
+        self.published = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published.append(topic)
+        return (0, len(self.published))
+
+    def unsubscribe(self, topics):
+        return (0, 0)
+
+
+def host(loop):
+    """ A PluginHost over a FakeConnection """
+    host = PluginHost.__new__(PluginHost)
+    host.loop = loop
+    host.connection = FakeConnection()
+    host.sessions = []
+    host.lost = []
+    host.router = TopicRouter()
+    host.filters = {}
+    host.acks = {}
+    return host
+
+
+def session(host, name):
+    return HostedSession(host, f'{name}>>path>>app>>1', host.loop)
+
+
+def connect(host):
+    host.connection._state = cs_connected
+    host._on_connect(None, None, {}, 0)
+
+
+def test_signals_missed_while_disconnected_are_sent_on_reconnect():
+    loop = asyncio.new_event_loop()
+    h = host(loop)
+    a, b = session(h, 'a'), session(h, 'b')
+    h.attach(a)
+    h.attach(b)
+    connect(h)
+    assert h.connection.published == ['app/a/signal/connected',
+                                      'app/b/signal/connected']
+
+    h.connection.published = []
+    h.connection._state = cs_new
+    h._on_disconnect(None, None, 1)
+    assert a._state == b._state == cs_new
+    # Removed while the connection is down
+    h.detach(b)
+    assert h.connection.published == []
+
+    connect(h)
+    assert h.connection.published == ['app/a/signal/disconnected',
+                                      'app/b/signal/disconnected',
+                                      'app/a/signal/connected']
+    assert h.lost == []
+    loop.close()
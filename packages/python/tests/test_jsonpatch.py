@@ -0,0 +1,77 @@
+import pytest
+
+from micropede.jsonpatch import apply_patch, make_patch, same
+
+
+@pytest.mark.parametrize('old, new', [
+    ({'a': 1}, {'a': 2}),
+    ({'a': 1, 'b': 2}, {'b': 2, 'c': 3}),
+    ({'a': {'b': [1, 2, 3]}}, {'a': {'b': [1, 3]}}),
+    ([1, 2, 3], [0, 1, 2, 3]),
+    ([1, 2, 3], [1, 2, 3, 4, 5]),
+    ([1, 2, 3, 4], [1, 4]),
+    ([{'x': 1}, {'x': 2}], [{'x': 1}, {'x': 3}]),
+    ({'a/b': 1, 'c~d': 2}, {'a/b': 2}),
+    ({'a': 1}, [1]),
+    (1, True),
+])
+def test_round_trip(old, new):
+    patch = make_patch(old, new)
+    assert same(apply_patch(old, patch), new)
+
+
+def test_no_changes():
+    assert make_patch({'a': [1, {'b': 2}]}, {'a': [1, {'b': 2}]}) == []
+
+
+def test_insertion_does_not_rewrite_following_items():
+    patch = make_patch(list(range(100)), [-1] + list(range(100)))
+    assert patch == [{'op': 'add', 'path': '/0', 'value': -1}]
+
+
+def test_keys_are_escaped():
+    assert make_patch({}, {'a/b~c': 1}) == [
+        {'op': 'add', 'path': '/a~1b~0c', 'value': 1}]
+
+
+def test_same_tells_numbers_and_booleans_apart():
+    assert not same(1, True)
+    assert not same(1, 1.0)
+    assert same({'a': [1]}, {'a': [1]})
+
+
+def test_apply_copies_unless_in_place():
+    doc = {'a': [1]}
+    result = apply_patch(doc, [{'op': 'add', 'path': '/a/-', 'value': 2}])
+    assert result == {'a': [1, 2]}
+    assert doc == {'a': [1]}
+    apply_patch(doc, [{'op': 'replace', 'path': '/a/0', 'value': 0}],
+                in_place=True)
+    assert doc == {'a': [0]}
+
+
+def test_move_copy_and_test():
+    doc = {'a': {'b': 1}, 'c': []}
+    doc = apply_patch(doc, [
+        {'op': 'test', 'path': '/a/b', 'value': 1},
+        {'op': 'copy', 'from': '/a/b', 'path': '/c/0'},
+        {'op': 'move', 'from': '/a', 'path': '/d'},
+    ])
+    assert doc == {'c': [1], 'd': {'b': 1}}
+
+
+def test_replace_document_root():
+    assert apply_patch({'a': 1}, [{'op': 'replace', 'path': '', 'value': 2}]) == 2
+
+
+@pytest.mark.parametrize('op', [
+    {'op': 'test', 'path': '/a', 'value': 2},
+    {'op': 'remove', 'path': '/missing'},
+    {'op': 'replace', 'path': '/list/5', 'value': 0},
+    {'op': 'remove', 'path': ''},
+    {'op': 'add', 'path': 'no-slash', 'value': 0},
+    {'op': 'frobnicate', 'path': '/a'},
+])
+def test_invalid_operations(op):
+    with pytest.raises(ValueError):
+        apply_patch({'a': 1, 'list': [1]}, [op])
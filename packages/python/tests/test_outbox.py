@@ -0,0 +1,66 @@
+from micropede.outbox import OfflineQueue
+
+
+def drained(queue):
+    return [(topic, payload, qos, retain, sorted(futures))
+            for (topic, payload, qos, retain, futures) in queue.drain()]
+
+
+def test_drain_in_order_and_empties_the_queue(tmp_path):
+    queue = OfflineQueue(str(tmp_path))
+    queue.append('a/1', b'1', qos=1)
+    queue.append('a/2', '2')
+    assert len(queue) == 2
+    assert drained(queue) == [('a/1', b'1', 1, False, []),
+                              ('a/2', b'2', 0, False, [])]
+    assert len(queue) == 0
+    assert drained(queue) == []
+
+
+def test_retained_messages_collapse_to_the_last_value(tmp_path):
+    queue = OfflineQueue(str(tmp_path))
+    queue.append('state/a', b'1', retain=True, future='f1')
+    queue.append('event', b'x', future='f2')
+    queue.append('state/a', b'2', retain=True, future='f3')
+    queue.append('state/b', b'3', retain=True)
+    # Every future resolves with the value that is actually sent
+    assert drained(queue) == [('event', b'x', 0, False, ['f2']),
+                              ('state/a', b'2', 0, True, ['f1', 'f3']),
+                              ('state/b', b'3', 0, True, [])]
+
+
+def test_records_past_the_memory_limit_spill_to_segments(tmp_path):
+    queue = OfflineQueue(str(tmp_path), memory_limit=8, segment_size=64)
+    for i in range(6):
+        queue.append('t', b'%d' % i * 4)
+    assert len(queue.memory) == 1
+    assert len(queue.segments) > 1
+    assert [payload for (t, payload, q, r, f) in drained(queue)] == [
+        b'%d' % i * 4 for i in range(6)]
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_segments_are_picked_up_after_a_restart(tmp_path):
+    queue = OfflineQueue(str(tmp_path), memory_limit=0)
+    queue.append('a', b'1', retain=True)
+    queue.append('b', b'2')
+    queue = OfflineQueue(str(tmp_path), memory_limit=0)
+    assert len(queue) == 2
+    queue.append('c', b'3')
+    assert drained(queue) == [('a', b'1', 0, True, []),
+                              ('b', b'2', 0, False, []),
+                              ('c', b'3', 0, False, [])]
+
+
+def test_appends_while_draining_wait_for_the_next_drain(tmp_path):
+    queue = OfflineQueue(str(tmp_path))
+    queue.append('a', b'1')
+    queue.append('b', b'2')
+    sent = []
+    for (topic, payload, qos, retain, futures) in queue.drain():
+        sent.append(topic)
+        # The connection dropped again
+        queue.append(topic + '/again', payload)
+    assert sent == ['a', 'b']
+    assert [topic for (topic, p, q, r, f) in queue.drain()] == [
+        'a/again', 'b/again']
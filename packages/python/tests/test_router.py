@@ -0,0 +1,138 @@
+import pytest
+
+from micropede.router import TopicRouter
+
+
+def handler(name):
+    def _handler(message, params):
+        return name
+    _handler.__name__ = name
+    return _handler
+
+
+def matched(router, topic):
+    return sorted((h.__name__, params) for h, params in router.match(topic))
+
+
+def test_exact_match():
+    router = TopicRouter()
+    router.add_route('app/trigger/plugin/ping', handler('ping'))
+    assert matched(router, 'app/trigger/plugin/ping') == [('ping', {})]
+    assert matched(router, 'app/trigger/plugin/pong') == []
+    assert matched(router, 'app/trigger/plugin') == []
+    assert matched(router, 'app/trigger/plugin/ping/extra') == []
+
+
+def test_param_capture():
+    router = TopicRouter()
+    router.add_route('app/{sender}/state/{prop}', handler('state'))
+    assert matched(router, 'app/dropbot/state/voltage') == [
+        ('state', {'sender': 'dropbot', 'prop': 'voltage'})]
+    assert matched(router, 'app/dropbot/state') == []
+    assert matched(router, 'app/dropbot/notify/voltage') == []
+
+
+def test_plus_matches_one_level():
+    router = TopicRouter()
+    router.add_route('app/+/signal/connected', handler('plus'))
+    assert matched(router, 'app/a/signal/connected') == [('plus', {})]
+    assert matched(router, 'app/a/b/signal/connected') == []
+
+
+def test_hash_matches_remaining_levels_and_parent():
+    router = TopicRouter()
+    router.add_route('app/#', handler('all'))
+    assert matched(router, 'app/a') == [('all', {})]
+    assert matched(router, 'app/a/b/c') == [('all', {})]
+    # "app/#" also matches "app" itself
+    assert matched(router, 'app') == [('all', {})]
+    assert matched(router, 'other/a') == []
+
+
+def test_hash_must_be_last():
+    with pytest.raises(ValueError):
+        TopicRouter().add_route('app/#/state', handler('bad'))
+
+
+def test_wildcards_skip_dollar_topics():
+    router = TopicRouter()
+    router.add_route('#', handler('all'))
+    router.add_route('+/stats', handler('plus'))
+    router.add_route('$SYS/stats', handler('sys'))
+    assert matched(router, '$SYS/stats') == [('sys', {})]
+    assert matched(router, 'app/stats') == [('all', {}), ('plus', {})]
+
+
+def test_overlapping_routes_all_match():
+    router = TopicRouter()
+    router.add_route('app/{sender}/state/{prop}', handler('any'))
+    router.add_route('app/{sender}/state/schema', handler('schema'))
+    router.add_route('app/#', handler('all'))
+    assert matched(router, 'app/p/state/schema') == [
+        ('all', {}),
+        ('any', {'sender': 'p', 'prop': 'schema'}),
+        ('schema', {'sender': 'p'}),
+    ]
+
+
+def test_several_handlers_per_channel():
+    router = TopicRouter()
+    router.add_route('a/b', handler('one'))
+    router.add_route('a/b', handler('two'))
+    assert len(router) == 2
+    assert matched(router, 'a/b') == [('one', {}), ('two', {})]
+
+
+def test_remove_every_handler_of_channel():
+    router = TopicRouter()
+    router.add_route('a/{x}', handler('one'))
+    router.add_route('a/{x}', handler('two'))
+    router.add_route('a/b', handler('exact'))
+    assert router.remove_route('a/{x}') == 2
+    assert len(router) == 1
+    assert matched(router, 'a/b') == [('exact', {})]
+    assert matched(router, 'a/c') == []
+
+
+def test_remove_one_handler():
+    router = TopicRouter()
+    one, two = handler('one'), handler('two')
+    router.add_route('a/b', one)
+    router.add_route('a/b', two)
+    assert router.remove_route('a/b', one) == 1
+    assert matched(router, 'a/b') == [('two', {})]
+
+
+def test_remove_keeps_routes_with_other_param_names():
+    # Same trie node, different channel
+    router = TopicRouter()
+    router.add_route('a/{x}', handler('x'))
+    router.add_route('a/{y}', handler('y'))
+    assert router.remove_route('a/{x}') == 1
+    assert matched(router, 'a/b') == [('y', {'y': 'b'})]
+
+
+def test_remove_unknown_channel():
+    router = TopicRouter()
+    router.add_route('a/b', handler('one'))
+    assert router.remove_route('a/c') == 0
+    assert router.remove_route('x/y/z') == 0
+    assert len(router) == 1
+
+
+def test_remove_prunes_empty_branches():
+    router = TopicRouter()
+    router.add_route('a/b/c/d', handler('deep'))
+    router.add_route('a/+/#', handler('wild'))
+    router.remove_route('a/b/c/d')
+    router.remove_route('a/+/#')
+    assert router.root.is_empty()
+    assert len(router) == 0
+
+
+def test_has_filter():
+    router = TopicRouter()
+    router.add_route('app/{sender}/state/{prop}', handler('state'))
+    assert router.has_filter('app/+/state/+')
+    assert not router.has_filter('app/+/state')
+    assert not router.has_filter('app/#')
@@ -0,0 +1,109 @@
+import asyncio
+
+from micropede.recorder import Record
+from micropede.scheduler import CONTROL, DATA, RPC, InboundScheduler, classify
+
+
+class FakeClient(object):
+    """ Records the topics dispatched by the scheduler """
+
+    def __init__(self, loop, fail=()):
+        self.loop = loop
+        self.metrics = None
+        self.fail = set(fail)
+        self.topics = []
+
+    def on_message(self, client, userdata, msg):
+        self.topics.append(msg.topic)
+        if msg.topic in self.fail:
+            raise KeyError(msg.topic)
+        return []
+
+
+def message(topic):
+    return Record(0, topic, b'{}', 0, False)
+
+
+def scheduler(loop, fail=(), **options):
+    client = FakeClient(loop, fail)
+    scheduler = InboundScheduler(**options)
+    scheduler.attach(client)
+    return client, scheduler
+
+
+def settle(loop):
+    loop.run_until_complete(asyncio.sleep(0.01))
+
+
+def test_classify():
+    assert classify('app/trigger/plugin/ping') == CONTROL
+    assert classify('app/put/plugin/value') == RPC
+    assert classify('app/plugin/notify/caller/ping') == RPC
+    assert classify('app/plugin/state/value') == DATA
+    assert classify('app/plugin/signal/connected') == DATA
+
+
+def test_priority_order():
+    loop = asyncio.new_event_loop()
+    client, s = scheduler(loop)
+    for topic in ('app/p/state/a', 'app/put/p/x', 'app/trigger/p/ping'):
+        s.receive(None, None, message(topic))
+    settle(loop)
+    assert client.topics == ['app/trigger/p/ping', 'app/put/p/x',
+                             'app/p/state/a']
+    loop.close()
+
+
+def test_collapses_queued_state():
+    loop = asyncio.new_event_loop()
+    client, s = scheduler(loop)
+    for i in range(5):
+        s.receive(None, None, message('app/p/state/a'))
+    s.receive(None, None, message('app/p/state/b'))
+    settle(loop)
+    assert client.topics == ['app/p/state/a', 'app/p/state/b']
+    assert s.info()['collapsed'] == 4
+    loop.close()
+
+
+def test_bounded_queue_drops_lowest_class_first():
+    loop = asyncio.new_event_loop()
+    client, s = scheduler(loop, max_queued=2, collapse=False)
+    s.receive(None, None, message('app/p/state/a'))
+    s.receive(None, None, message('app/trigger/p/ping'))
+    s.receive(None, None, message('app/put/p/x'))
+    settle(loop)
+    assert client.topics == ['app/trigger/p/ping', 'app/put/p/x']
+    assert s.info()['dropped'] == 1
+    loop.close()
+
+
+def test_handler_errors_do_not_stop_dispatch():
+    loop = asyncio.new_event_loop()
+    errors = []
+    loop.set_exception_handler(lambda l, context: errors.append(context))
+    topics = [f'app/p/state/{i}' for i in range(4)]
+    client, s = scheduler(loop, fail=[topics[1]])
+    for topic in topics:
+        s.receive(None, None, message(topic))
+    settle(loop)
+    assert client.topics == topics
+    assert isinstance(errors[0]['exception'], KeyError)
+    assert s.info()['errors'] == 1
+
+    # Still scheduling messages received afterwards
+    s.receive(None, None, message('app/p/state/later'))
+    settle(loop)
+    assert client.topics[-1] == 'app/p/state/later'
+    loop.close()
+
+
+def test_drains_in_batches():
+    loop = asyncio.new_event_loop()
+    client, s = scheduler(loop, batch=2, collapse=False)
+    for i in range(5):
+        s.receive(None, None, message(f'app/p/state/{i}'))
+    settle(loop)
+    assert len(client.topics) == 5
+    assert not s.scheduled
+    loop.close()
@@ -0,0 +1,75 @@
+import asyncio
+
+from micropede.timers import TimerWheel, in_loop
+
+
+def run(loop, seconds):
+    loop.run_until_complete(asyncio.sleep(seconds))
+
+
+def test_fires_in_order_after_timeout():
+    loop = asyncio.new_event_loop()
+    wheel = TimerWheel(loop, resolution=5)
+    fired = []
+    wheel.call_later(30, fired.append, 'late')
+    wheel.call_later(10, fired.append, 'early')
+    assert wheel.pending == 2
+    run(loop, 0.005)
+    assert fired == []
+    run(loop, 0.1)
+    assert fired == ['early', 'late']
+    assert wheel.pending == 0
+    loop.close()
+
+
+def test_cancel():
+    loop = asyncio.new_event_loop()
+    wheel = TimerWheel(loop, resolution=5)
+    fired = []
+    timer = wheel.call_later(10, fired.append, 'cancelled')
+    wheel.call_later(10, fired.append, 'kept')
+    timer.cancel()
+    # Cancelling twice is a no-op
+    timer.cancel()
+    assert wheel.pending == 1
+    run(loop, 0.05)
+    assert fired == ['kept']
+    loop.close()
+
+
+def test_timeouts_longer_than_a_turn_of_the_wheel():
+    loop = asyncio.new_event_loop()
+    # One turn is 4 slots * 5ms
+    wheel = TimerWheel(loop, resolution=5, slots=4)
+    fired = []
+    wheel.call_later(50, fired.append, 'long')
+    run(loop, 0.025)
+    assert fired == []
+    run(loop, 0.06)
+    assert fired == ['long']
+    loop.close()
+
+
+def test_callback_errors_reach_the_exception_handler():
+    loop = asyncio.new_event_loop()
+    errors = []
+    loop.set_exception_handler(lambda l, context: errors.append(context))
+    wheel = TimerWheel(loop, resolution=5)
+    fired = []
+    wheel.call_later(5, lambda: 1 / 0)
+    wheel.call_later(5, fired.append, 'next')
+    run(loop, 0.05)
+    assert fired == ['next']
+    assert isinstance(errors[0]['exception'], ZeroDivisionError)
+    loop.close()
+
+
+def test_in_loop():
+    loop = asyncio.new_event_loop()
+
+    async def check():
+        return in_loop(loop)
+
+    assert loop.run_until_complete(check())
+    assert not in_loop(loop)
+    loop.close()
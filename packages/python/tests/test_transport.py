@@ -0,0 +1,116 @@
+import asyncio
+import struct
+
+from micropede.transport import (CONNACK, PINGRESP, PUBACK, PUBLISH,
+                                 AsyncioClient, MQTTProtocol, cs_connected,
+                                 encode_string, packet)
+
+
+class FakeTransport(object):
+    """ Collects the packets written by AsyncioClient """
+
+    def __init__(self):
+        self.written = []
+        self.aborted = False
+        self.closed = False
+
+    def writelines(self, chunks):
+        self.written.append(b''.join(bytes(c) for c in chunks))
+
+    def abort(self):
+        self.aborted = True
+
+    def close(self):
+        self.closed = True
+
+    def is_reading(self):
+        return True
+
+
+def connect(client):
+    transport = FakeTransport()
+    client._connection_made(transport)
+    client._handle(CONNACK, 0, b'\x00\x00')
+    return transport
+
+
+def publish_packet(topic, payload):
+    return packet(PUBLISH, 0, encode_string(topic) + payload)
+
+
+def test_callback_errors_do_not_drop_the_connection():
+    loop = asyncio.new_event_loop()
+    errors = []
+    loop.set_exception_handler(lambda l, context: errors.append(context))
+    client = AsyncioClient('id', loop, keepalive=0)
+    protocol = MQTTProtocol(client)
+    protocol.connection_made(FakeTransport())
+    client._handle(CONNACK, 0, b'\x00\x00')
+
+    received = []
+
+    def on_message(client, userdata, message):
+        received.append(bytes(message.payload))
+        if message.payload == b'1':
+            raise KeyError('handler failed')
+    client.on_message = on_message
+
+    # Several messages in one read
+    protocol.data_received(b''.join(
+        publish_packet('a/b', str(i).encode()) for i in range(4)))
+    assert received == [b'0', b'1', b'2', b'3']
+    assert isinstance(errors[0]['exception'], KeyError)
+    assert client._state == cs_connected
+    loop.close()
+
+
+def test_missing_pingresp_closes_the_connection():
+    loop = asyncio.new_event_loop()
+    client = AsyncioClient('id', loop, keepalive=0)
+    transport = connect(client)
+    client._ping()
+    client._handle(PINGRESP, 0, b'')
+    client._ping()
+    assert not transport.aborted
+    # No PINGRESP for the last PINGREQ
+    client._ping()
+    assert transport.aborted
+    loop.close()
+
+
+def test_unacknowledged_publishes_are_resent_after_reconnect():
+    loop = asyncio.new_event_loop()
+    client = AsyncioClient('id', loop, keepalive=0)
+    published = []
+    client.on_publish = lambda client, userdata, mid: published.append(mid)
+    connect(client)
+    (rc, acked) = client.publish('a/b', b'acked', qos=1)
+    (rc, lost) = client.publish('a/b', b'lost', qos=1)
+    client._handle(PUBACK, 0, struct.pack('!H', acked))
+    assert published == [acked]
+
+    client._connection_lost(ConnectionResetError())
+    assert lost in client._outgoing
+    client._reconnect_handle.cancel()
+    transport = connect(client)
+
+    (resent,) = transport.written[-1:]
+    # PUBLISH, DUP, QoS 1
+    assert resent[0] == PUBLISH << 4 | 0x08 | 0x02
+    assert resent.endswith(struct.pack('!H', lost) + b'lost')
+    client._handle(PUBACK, 0, struct.pack('!H', lost))
+    assert published == [acked, lost]
+    loop.close()
+
+
+def test_clean_disconnect_forgets_unacknowledged_publishes():
+    loop = asyncio.new_event_loop()
+    client = AsyncioClient('id', loop, keepalive=0)
+    connect(client)
+    client.publish('a/b', b'x', qos=1)
+    client.disconnect()
+    # Called from outside the loop, the DISCONNECT is sent from the loop
+    loop.run_until_complete(asyncio.sleep(0))
+    client._connection_lost(None)
+    assert client._outgoing == {}
+    loop.close()